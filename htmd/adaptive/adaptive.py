@@ -194,30 +194,57 @@ class AdaptiveBase(abc.ABC, ProtocolInterface):
             raise NameError('Input dirs of epoch ' + str(epoch) + ' already exists.')
 
         from htmd.parallelprogress import ParallelExecutor
+        from htmd.framereader import readFrames
         from htmd.config import _config
+        from htmd.util import ensurelist
         from joblib import delayed
 
-        aprun = ParallelExecutor(n_jobs=_config['njobs'])
+        if len(simsframes) == 0:
+            return
+
+        # Read all spawning frames in one pass over their source trajectories and parse each topology only once
+        sources = [_sourceSim(f) for f in simsframes]
+        trajfiles = [sim.trajectory[f.piece] for sim, f in zip(sources, simsframes)]
+        frames = [f.frame for f in simsframes]
+        framedata = readFrames(trajfiles, frames, desc='Reading spawning frames')
+        # Auto-detected topologies are lists of files which cannot be used as keys
+        molkeys = [tuple(ensurelist(sim.molfile)) for sim in sources]
+        topologies = {}
+        for key, sim in zip(molkeys, sources):
+            if key not in topologies:
+                topologies[key] = Molecule(sim.molfile)  # Always read the mol file, otherwise it does not work if we need to save a PDB as coorname
+
+        # Writing is I/O bound so threads avoid sending the topologies to other processes
+        aprun = ParallelExecutor(n_jobs=_config['njobs'], prefer='threads')
         aprun(total=len(simsframes), desc='Writing inputs')(
-            delayed(_writeInputsFunction)(i, f, epoch, self.inputpath, self.coorname) for i, f in enumerate(simsframes))
+            delayed(_writeInputsFunction)(i, f, epoch, self.inputpath, self.coorname, topologies[key],
+                                          {k: v[..., i:i+1] for k, v in framedata.items()})
+            for i, (f, key) in enumerate(zip(simsframes, molkeys)))
 
     @abc.abstractmethod
     def _algorithm(self):
         return
 
 
-def _writeInputsFunction(i, f, epoch, inputpath, coorname):
-    regex = re.compile('(e\d+s\d+)_')
-    frameNum = f.frame
-    piece = f.piece
+def _sourceSim(f):
     if f.sim.parent is None:
         currSim = f.sim
     else:
         currSim = f.sim.parent
-
-    traj = currSim.trajectory[piece]
     if currSim.input is None:
         raise NameError('Could not find input folder in simulation lists. Cannot create new simulations.')
+    return currSim
+
+
+def _writeInputsFunction(i, f, epoch, inputpath, coorname, topology, framedata):
+    """ Writes the input folder of a new simulation starting from frame `f`, of which the coordinates are given in
+    `framedata` as read by :func:`readFrames <htmd.framereader.readFrames>` and the topology in `topology` """
+    from htmd.framereader import setFrames
+    regex = re.compile('(e\d+s\d+)_')
+    frameNum = f.frame
+    piece = f.piece
+    currSim = _sourceSim(f)
+    traj = currSim.trajectory[piece]
 
     wuName = _simName(traj)
     res = regex.search(wuName)
@@ -231,11 +258,9 @@ def _writeInputsFunction(i, f, epoch, inputpath, coorname):
     # copy previous input directory including input files
     copytree(currSim.input, newDir, symlinks=False, ignore=ignore_patterns('*.coor', '*.rst', '*.out', *_IGNORE_EXTENSIONS))
 
-    # overwrite input file with new one. frameNum + 1 as catdcd does 1 based indexing
-
-    mol = Molecule(currSim.molfile)  # Always read the mol file, otherwise it does not work if we need to save a PDB as coorname
-    mol.read(traj)
-    mol.dropFrames(keep=frameNum)  # Making sure only specific frame to write is kept
+    # overwrite input file with new one
+    mol = topology.copy()
+    setFrames(mol, framedata, [0], [traj], [frameNum])
     mol.write(path.join(newDir, coorname))
 
 
@@ -389,6 +414,43 @@ def _findprevioustraj(simlist, simname):
     return sim, prevpiece, prevframe, epo
 
 
+import unittest
+
+
+class _TestAdaptive(unittest.TestCase):
+    def test_write_inputs(self):
+        import os
+        from htmd.simlist import Frame, simlist
+        from htmd.util import tempname
+        from htmd.util import synthesizeSimulations
+
+        tmpdir = tempname()
+        synthesizeSimulations(tmpdir, numatoms=5, numframes=20, numtrajs=3)
+        for i in (2, 3):  # Every simulation needs its own input folder
+            shutil.copytree(path.join(tmpdir, 'input', 'e1s1'), path.join(tmpdir, 'input', 'e1s{}'.format(i)))
+        inputs = sorted(glob(path.join(tmpdir, 'input', '*', '')))
+        sims = simlist(sorted(glob(path.join(tmpdir, 'data', '*', ''))), inputs, inputs)
+        assert isinstance(sims[0].molfile, list)  # Auto-detected topology
+
+        class _Adaptive(AdaptiveBase):
+            def _algorithm(self):
+                return True
+
+        ad = _Adaptive()
+        ad.inputpath = path.join(tmpdir, 'newinput')
+        os.makedirs(ad.inputpath)
+        # Two frames are taken twice from the same trajectory
+        requests = [(0, 3), (1, 10), (0, 3), (2, 0), (1, 10)]
+        ad._writeInputs([Frame(sims[s], 0, f) for s, f in requests], epoch=2)
+
+        for i, (s, f) in enumerate(requests):
+            ref = Molecule(sims[s].molfile)
+            ref.read(sims[s].trajectory[0])
+            mol = Molecule(sims[s].molfile)
+            mol.read(path.join(ad.inputpath, 'e2s{}_e1s{}p0f{}'.format(i + 1, s + 1, f), 'input.coor'))
+            assert np.allclose(mol.coords[:, :, 0], ref.coords[:, :, f], atol=1e-3)
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
 
 if __name__ == "__main__":
     import htmd
@@ -404,8 +466,9 @@ if __name__ == "__main__":
     outf = tempname()
     os.makedirs(outf)
 
+    from htmd.framereader import readFrames
     f = Frame(sims[0], 0, 5)
-    _writeInputsFunction(1, f, 2, outf, 'input.coor')
+    _writeInputsFunction(1, f, 2, outf, 'input.coor', Molecule(sims[0].molfile), readFrames([sims[0].trajectory[0]], [5]))
 
     mol = Molecule(sims[0])
     mol.read(os.path.join(outf, 'e2s2_e1s1p0f5', 'input.coor'))
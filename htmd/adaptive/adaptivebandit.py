@@ -74,6 +74,8 @@ class AdaptiveBandit(AdaptiveBase):
         The number of macrostates to produce
     save : bool, default=False
         Save the model generated
+    cachepath : str, default=None
+        Directory in which projected trajectories are cached between epochs so that only new simulations are projected. Set to None to disable caching.
     save_qval : bool, default=False
         Save the Q(a) and N values for every epoch
     actionspace : str, default='metric'
@@ -111,6 +113,7 @@ class AdaptiveBandit(AdaptiveBase):
         self._arg('clustmethod', ':class:`ClusterMixin <sklearn.base.ClusterMixin>` class', 'Clustering algorithm used to cluster the contacts or distances', MiniBatchKMeans, val.Class(ClusterMixin))
         self._arg('macronum', 'int', 'The number of macrostates to produce', 8, val.Number(int, 'POS'))
         self._arg('save', 'bool', 'Save the model generated', False, val.Boolean())
+        self._arg('cachepath', 'str', 'Directory in which projected trajectories are cached between epochs so that only new simulations are projected. Set to None to disable caching.', None, val.String())
         self._arg('save_qval', 'bool', 'Save the Q(a) and N values for every epoch', False, val.Boolean())
         self._arg('actionspace', 'str', 'The action space', 'tica', val.String())
         self._arg('recluster', 'bool', 'If to recluster the action space.', False, val.Boolean())
@@ -121,11 +124,12 @@ class AdaptiveBandit(AdaptiveBase):
     def _algorithm(self):
         from htmd.kinetics import Kinetics
         sims = self._getSimlist()
-        metr = Metric(sims, skip=self.skip)
+        metr = Metric(sims, skip=self.skip, cachedir=self.cachepath)
+        metr.dropTraj()  # Drop before projecting so that broken trajectories are never loaded and cannot affect TICA
         metr.set(self.projection)
 
         data = metr.project()
-        data.dropTraj()  # Drop before TICA to avoid broken trajectories
+        data.dropTraj()  # Trajectories of unknown length or which failed projection can only be dropped here
 
         if self.goalfunction is not None:
             goaldata = self._getGoalData(data.simlist)
@@ -228,8 +232,10 @@ class AdaptiveBandit(AdaptiveBase):
         from htmd.simlist import simlist, simfilter
         logger.info('Postprocessing new data')
 
+        # The index keeps the contents of already scanned simulation folders between epochs
         sims = simlist(glob(path.join(self.datapath, '*', '')), glob(path.join(self.inputpath, '*', '')),
-                       glob(path.join(self.inputpath, '*', '')))
+                       glob(path.join(self.inputpath, '*', '')), index=path.join(self.datapath, '.simlist.index'),
+                       probe=True)
 
         if self.filter:
             sims = simfilter(sims, self.filteredpath, filtersel=self.filtersel)
@@ -274,7 +280,7 @@ class AdaptiveBandit(AdaptiveBase):
 
     def conformationStationaryDistribution(self, model):
         statdist = np.zeros(model.data.numFrames) # zero for disconnected set
-        dataconcatSt = np.concatenate(model.data.St)
+        dataconcatSt = model.data._concat('cluster')
         for i in range(model.micronum):
             microframes = np.where(model.micro_ofcluster[dataconcatSt] == i)[0]
             statdist[microframes] = model.msm.stationary_distribution[i]
@@ -81,6 +81,8 @@ class AdaptiveGoal(AdaptiveMD):
         Contact symmetry
     save : bool, default=False
         Save the model generated
+    cachepath : str, default=None
+        Directory in which projected trajectories are cached between epochs so that only new simulations are projected. Set to None to disable caching.
     goalfunction : function, default=None
         This function will be used to convert the goal-projected simulation data to a ranking whichcan be used for the directed component of FAST.
     ucscale : float, default=0.5
@@ -6,6 +6,7 @@
 from glob import glob
 from os import path, makedirs
 import numpy as np
+import random
 from htmd.adaptive.adaptive import AdaptiveBase
 from htmd.simlist import simlist, simfilter
 from htmd.model import Model, macroAccumulate
@@ -83,6 +84,12 @@ class AdaptiveMD(AdaptiveBase):
         Contact symmetry
     save : bool, default=False
         Save the model generated
+    incremental : bool, default=False
+        Keep the projected data, TICA and clustering between epochs and only fold in the newly retrieved simulations instead of rebuilding them from scratch. They are only kept in memory, so the first epoch after restarting an adaptive run rebuilds them from all simulations and restarts the `rebuildperiod` count. Use `cachepath` to avoid projecting all simulations again on restart.
+    rebuildperiod : int, default=10
+        When `incremental` is enabled, rebuild the TICA and clustering from all data every `rebuildperiod` epochs
+    cachepath : str, default=None
+        Directory in which projected trajectories are cached between epochs so that only new simulations are projected. Set to None to disable caching.
 
     Example
     -------
@@ -120,6 +127,10 @@ class AdaptiveMD(AdaptiveBase):
         self._arg('ticadim', 'int', 'Number of TICA dimensions to use. When set to 0 it disables TICA', 3, val.Number(int, '0POS'))
         self._arg('contactsym', 'str', 'Contact symmetry', None, val.String())
         self._arg('save', 'bool', 'Save the model generated', False, val.Boolean())
+        self._arg('incremental', 'bool', 'Keep the projected data, TICA and clustering between epochs and only fold in the newly retrieved simulations instead of rebuilding them from scratch. They are only kept in memory, so the first epoch after restarting an adaptive run rebuilds them from all simulations and restarts the `rebuildperiod` count. Use `cachepath` to avoid projecting all simulations again on restart.', False, val.Boolean())
+        self._arg('rebuildperiod', 'int', 'When `incremental` is enabled, rebuild the TICA and clustering from all data every `rebuildperiod` epochs', 10, val.Number(int, 'POS'))
+        self._arg('cachepath', 'str', 'Directory in which projected trajectories are cached between epochs so that only new simulations are projected. Set to None to disable caching.', None, val.String())
+        self._incstate = None
 
     def _algorithm(self):
         data = self._getData(self._getSimlist())
@@ -141,14 +152,20 @@ class AdaptiveMD(AdaptiveBase):
 
     def _getSimlist(self):
         logger.info('Postprocessing new data')
+        # The index keeps the contents of already scanned simulation folders between epochs
         sims = simlist(glob(path.join(self.datapath, '*', '')), glob(path.join(self.inputpath, '*', '')),
-                       glob(path.join(self.inputpath, '*', '')))
+                       glob(path.join(self.inputpath, '*', '')), index=path.join(self.datapath, '.simlist.index'),
+                       probe=True)
         if self.filter:
             sims = simfilter(sims, self.filteredpath, filtersel=self.filtersel)
         return sims
 
     def _getData(self, sims):
-        metr = Metric(sims, skip=self.skip)
+        if self.incremental:
+            return self._getDataIncremental(sims)
+
+        metr = Metric(sims, skip=self.skip, cachedir=self.cachepath)
+        metr.dropTraj()  # Drop before projecting so that broken trajectories are never loaded and cannot affect TICA
         metr.set(self.projection)
 
         # if self.contactsym is not None:
@@ -157,18 +174,148 @@ class AdaptiveMD(AdaptiveBase):
         if self.ticadim > 0:
             # tica = TICA(metr, int(max(2, np.ceil(self.ticalag))))  # gianni: without project it was tooooo slow
             data = metr.project()
-            data.dropTraj()  # Drop before TICA to avoid broken trajectories
+            data.dropTraj()  # Trajectories of unknown length or which failed projection can only be dropped here
             ticalag = int(
                 np.ceil(max(2, min(np.min(data.trajLengths) / 2, self.ticalag))))  # 1 < ticalag < (trajLen / 2)
             tica = TICA(data, ticalag)
             datadr = tica.project(self.ticadim)
         else:
             datadr = metr.project()
-        datadr.dropTraj()  # Preferably we should do this before any projections. Corrupted sims can affect TICA
+        datadr.dropTraj()
         return datadr
 
+    def _getDataIncremental(self, sims):
+        state = self._incstate
+        keys = [tuple(s.trajectory) for s in sims]
+        rebuild = state is None or state.updates + 1 >= self.rebuildperiod
+        if state is not None:
+            missing = set(tuple(t.sim.trajectory) for t in state.rawdata.trajectories) - set(keys)
+            if len(missing):
+                logger.info('{} previously analyzed simulations are missing. Rebuilding from scratch.'.format(len(missing)))
+                state = None
+                rebuild = True
+        if state is None:
+            state = _IncrementalState()
+
+        # Update the Sim objects of known trajectories to the ones of the current simlist
+        known = {tuple(t.sim.trajectory): t for t in state.rawdata.trajectories}
+        newsims = []
+        for k, s in zip(keys, sims):
+            if k in known:
+                known[k].sim = s
+            elif k not in state.keys:  # Simulations which failed projection are also in the keys and are not retried
+                newsims.append(s)
+
+        newtrajs = []
+        if len(newsims) != 0:
+            metr = Metric(np.array(newsims, dtype=object), skip=self.skip, cachedir=self.cachepath)
+            metr.set(self.projection)
+            try:
+                newdata = metr.project()
+                newtrajs = newdata.trajectories
+                state.fstep = newdata.fstep
+                if state.description is None:
+                    state.description = newdata.description
+            except NameError as e:
+                logger.warning('None of the new simulations could be projected. "{}"'.format(e))
+        state.rawdata.trajectories += newtrajs
+        if len(state.rawdata.trajectories) == 0:
+            raise NameError('None of the simulations could be projected. Check your simulations and projection.')
+        state.keys.update(tuple(s.trajectory) for s in newsims)
+        logger.info('Incremental analysis: {} known and {} new trajectories'.format(len(known), len(newtrajs)))
+
+        if rebuild:
+            self._rebuildIncremental(state)
+        else:
+            self._foldIncremental(state, newtrajs)
+        self._incstate = state
+        return state.view()
+
+    def _rebuildIncremental(self, state):
+        from scipy import stats
+        from htmd.metricdata import MetricData
+        logger.info('Rebuilding the TICA and clustering from all data')
+        lengths = state.rawdata.trajLengths
+        trajlen = int(np.array(stats.mode(lengths).mode))
+        accepted = [t for t in state.rawdata.trajectories if t.numFrames == trajlen]
+        logger.info('Dropped {} trajectories from {} resulting in {}'.format(len(lengths) - len(accepted), len(lengths), len(accepted)))
+
+        if self.ticadim > 0:
+            ticalag = int(np.ceil(max(2, min(trajlen / 2, self.ticalag))))  # 1 < ticalag < (trajLen / 2)
+            # The running covariances can be reused if they were accumulated on a subset of the kept trajectories
+            acceptedkeys = set(tuple(t.sim.trajectory) for t in accepted)
+            if state.tic is None or ticalag != state.ticalag or trajlen != state.trajlen or not state.fitted <= acceptedkeys:
+                from pyemma.coordinates.transform.tica import TICA as TICApyemma
+                state.tic = TICApyemma(ticalag)
+                state.fitted = set()
+            tofit = [t.projection for t in accepted if tuple(t.sim.trajectory) not in state.fitted]
+            if len(tofit):
+                state.tic.partial_fit(tofit)
+            state.fitted = acceptedkeys
+            state.ticalag = ticalag
+            state.ticamean = state.tic.mean
+            state.ticaevecs = state.tic.eigenvectors[:, :self.ticadim]
+        state.trajlen = trajlen
+
+        parent = MetricData(trajectories=list(accepted), fstep=state.fstep, description=state.description)
+        state.data = MetricData(trajectories=[state.reduce(t) for t in accepted], fstep=state.fstep,
+                                description=state.reducedDescription(), parent=parent)
+        state.data.cluster(self.clustmethod(n_clusters=self._numClusters(state.data.numFrames)))
+
+        # The radius covered by the clustering is used for deciding when new frames need new clusters
+        state.radius = 0
+        for t in state.data.trajectories:
+            state.radius = max(state.radius, np.max(np.linalg.norm(t.projection - state.data.Centers[t.cluster], axis=1)))
+        state.updates = 0
+
+    def _foldIncremental(self, state, newtrajs):
+        from htmd.clustering.nearestcenter import NearestCenter
+        accepted = [t for t in newtrajs if t.numFrames == state.trajlen]
+        if len(newtrajs) != len(accepted):
+            logger.info('Dropped {} new trajectories not of length {}'.format(len(newtrajs) - len(accepted), state.trajlen))
+        state.updates += 1
+        if len(accepted) == 0:
+            return
+        if state.tic is not None:
+            state.tic.partial_fit([t.projection for t in accepted])
+            state.fitted.update(tuple(t.sim.trajectory) for t in accepted)
+
+        reduced = [state.reduce(t) for t in accepted]
+        X = np.concatenate([t.projection for t in reduced])
+        data = state.data
+        centers = data.Centers
+        labels, mindist = NearestCenter(centers, metric='euclidean').query(X)
+
+        # Frames outside the radius of existing clusters seed new clusters by farthest-point selection
+        newcenters = []
+        maxclusters = self._numClusters(data.numFrames + X.shape[0])
+        while data.K + len(newcenters) < maxclusters:
+            far = np.argmax(mindist)
+            if mindist[far] <= state.radius:
+                break
+            newcenters.append(X[far])
+            dists = np.linalg.norm(X - X[far], axis=1)
+            closer = dists < mindist
+            mindist[closer] = dists[closer]
+            labels[closer] = data.K + len(newcenters) - 1
+        if len(newcenters):
+            data.Centers = np.vstack((centers, np.array(newcenters, dtype=centers.dtype)))
+        logger.info('Assigned {} new frames to {} existing clusters and created {} new clusters'.format(
+            X.shape[0], data.K, len(newcenters)))
+
+        for t, l in zip(reduced, np.split(labels, np.cumsum([t.numFrames for t in reduced])[:-1])):
+            t.cluster = l
+        data.K += len(newcenters)
+        data.N = np.append(data.N, np.zeros(len(newcenters), dtype=data.N.dtype)) + np.bincount(labels, minlength=data.K)
+        data.trajectories += reduced
+        data.parent.trajectories += accepted
+        data._dataid = random.random()
+        data.parent._dataid = random.random()
+        data._clusterid = data._dataid
+
     def _createMSM(self, data):
-        data.cluster(self.clustmethod(n_clusters=self._numClusters(data.numFrames)))
+        if data._clusterid is None or data._clusterid != data._dataid:
+            data.cluster(self.clustmethod(n_clusters=self._numClusters(data.numFrames)))
         self._model = Model(data)
         self._model.markovModel(self.lag, self._numMacrostates(data))
         if self.save:
@@ -235,6 +382,121 @@ class AdaptiveMD(AdaptiveBase):
         return macronum
 
 
+class _IncrementalState(object):
+    """ Data kept between epochs by the incremental mode of AdaptiveMD """
+    def __init__(self):
+        from htmd.metricdata import MetricData
+        self.rawdata = MetricData()
+        self.keys = set()  # Trajectories of all analyzed simulations, including the ones which failed projection
+        self.fstep = 0
+        self.description = None
+        self.tic = None
+        self.ticalag = None
+        self.ticamean = None
+        self.ticaevecs = None
+        self.fitted = set()
+        self.trajlen = None
+        self.data = None
+        self.radius = None
+        self.updates = 0
+
+    def reduce(self, traj):
+        from htmd.metricdata import Trajectory
+        if self.ticaevecs is None:
+            projection = traj.projection
+        else:  # Project on the TICA components which were frozen during the last rebuild
+            projection = np.dot(traj.projection - self.ticamean, self.ticaevecs).astype(np.float32)
+        return Trajectory(projection=projection, reference=traj.reference, sim=traj.sim)
+
+    def reducedDescription(self):
+        if self.ticaevecs is None:
+            return self.description
+        from pandas import DataFrame
+        ndim = self.ticaevecs.shape[1]
+        return DataFrame({'type': ['tica'] * ndim, 'atomIndexes': [-1] * ndim,
+                          'description': ['TICA dimension {}'.format(i+1) for i in range(ndim)]})
+
+    def view(self):
+        """ Returns a shallow MetricData copy so that callers can drop trajectories without altering the state """
+        from htmd.metricdata import MetricData
+        parent = self.data.parent
+        parentview = MetricData(trajectories=list(parent.trajectories), fstep=parent.fstep, description=parent.description)
+        view = MetricData(trajectories=list(self.data.trajectories), fstep=self.data.fstep,
+                          description=self.data.description, parent=parentview)
+        view.K = self.data.K
+        view.N = self.data.N.copy()
+        view.Centers = self.data.Centers
+        view._clusterid = view._dataid
+        return view
+
+
+import unittest
+
+
+class _TestAdaptiveMD(unittest.TestCase):
+    def test_incremental(self):
+        import os
+        from unittest import mock
+        from htmd.util import tempname
+        from htmd.util import synthesizeSimulations
+        from moleculekit.projections.metricdistance import MetricSelfDistance
+
+        tmpdir = tempname()
+        synthesizeSimulations(tmpdir, numatoms=8, numframes=200, numtrajs=8)
+        # A simulation which cannot be projected
+        os.makedirs(path.join(tmpdir, 'data', 'e9s1'))
+        with open(path.join(tmpdir, 'data', 'e9s1', 'traj.xtc'), 'wb') as f:
+            f.write(b'notatrajectory' * 100)
+        sims = simlist(sorted(glob(path.join(tmpdir, 'data', '*', ''))), path.join(tmpdir, 'input', 'e1s1', 'structure.pdb'))
+        good = [s for s in sims if 'e9s1' not in s.trajectory[0]]
+
+        md = AdaptiveMD()
+        md.projection = MetricSelfDistance('name CA', periodic=None)
+        md.incremental = True
+        md.ticalag = 5
+        md.ticadim = 2
+        md.skip = 1
+
+        view1 = md._getData(np.array(good[:4], dtype=object))
+        assert view1.numTrajectories == 4
+        with mock.patch.object(Metric, 'project', autospec=True, side_effect=Metric.project) as project:
+            view2 = md._getData(sims)
+            assert project.call_count == 1
+        state = md._incstate
+        assert state.updates == 1  # Folded into the existing TICA and clustering instead of rebuilding
+        assert tuple(sims[-1].trajectory) in state.keys
+
+        # The view matches a full projection of all simulations
+        metr = Metric(np.array(good, dtype=object))
+        metr.set(MetricSelfDistance('name CA', periodic=None))
+        ref = {tuple(t.sim.trajectory): t.projection for t in metr.project().trajectories}
+        assert view2.numTrajectories == len(good)
+        for i, (raw, red) in enumerate(zip(view2.parent.trajectories, view2.trajectories)):
+            assert np.allclose(raw.projection, ref[tuple(raw.sim.trajectory)])
+            assert np.allclose(red.projection, np.dot(ref[tuple(raw.sim.trajectory)] - state.ticamean, state.ticaevecs), atol=1e-4)
+            if i < view1.numTrajectories:  # Known frames keep their clusters
+                assert np.array_equal(red.cluster, view1.trajectories[i].cluster)
+            else:  # New frames are assigned to their nearest center
+                dists = np.linalg.norm(red.projection[:, np.newaxis, :] - view2.Centers[np.newaxis, :, :], axis=2)
+                assert np.allclose(dists[np.arange(len(dists)), red.cluster], np.min(dists, axis=1), atol=1e-4)
+        assert view2.K == len(view2.Centers)
+        assert np.array_equal(view2.N, np.bincount(np.concatenate(view2.St), minlength=view2.K))
+
+        # Neither known simulations nor the one which failed are projected again
+        with mock.patch.object(Metric, 'project', autospec=True, side_effect=Metric.project) as project:
+            view3 = md._getData(sims)
+            assert project.call_count == 0
+        assert view3.numTrajectories == len(good)
+
+        # Without any projected simulation there is nothing to analyze
+        md = AdaptiveMD()
+        md.projection = MetricSelfDistance('name CA', periodic=None)
+        md.incremental = True
+        with self.assertRaises(NameError):
+            md._getData(np.array([sims[-1]], dtype=object))
+        assert md._incstate is None
+
+
 if __name__ == "__main__":
     import htmd.home
     import os
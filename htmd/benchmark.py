@@ -0,0 +1,344 @@
+# (c) 2015-2018 Acellera Ltd http://www.acellera.com
+# All Rights Reserved
+# Distributed under HTMD Software License Agreement
+# No redistribution in whole or part
+#
+""" Performance benchmark of the analysis pipeline
+
+Synthesizes a set of simulations of configurable size and times the stages of the analysis pipeline (projection,
+TICA, clustering, Markov model and kinetics) as well as their peak memory usage. The results are stored as JSON
+together with the commit they were obtained on so that they can be compared across commits.
+
+From the command line::
+
+    python -m htmd.benchmark --atoms 50 --frames 1000 --trajectories 20 --output bench.json
+    python -m htmd.benchmark --atoms 50 --frames 1000 --trajectories 20 --compare bench.json
+"""
+import os
+import time
+import json
+import shutil
+import tempfile
+import numpy as np
+import logging
+logger = logging.getLogger(__name__)
+
+
+_STAGES = ('project', 'tica', 'cluster', 'markovModel', 'getRates')
+
+
+class _PeakRSS:
+    """ Samples the resident memory of this process and its child processes in a background thread
+
+    Unlike tracemalloc this includes the memory allocated by native code (numba, BLAS, C extensions) and by joblib
+    worker processes. The peak is only as accurate as the sampling interval. Requires psutil; `peak` is None without it.
+    """
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = None
+
+    def _rss(self):
+        import psutil
+        total = self._proc.memory_info().rss
+        for child in self._proc.children(recursive=True):
+            try:
+                total += child.memory_info().rss
+            except psutil.Error:
+                pass
+        return total
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self._rss())
+
+    def __enter__(self):
+        import threading
+        try:
+            import psutil
+        except ImportError:
+            return self
+        self._proc = psutil.Process()
+        self.peak = self._rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        if self.peak is not None:
+            self._stop.set()
+            self._thread.join()
+            self.peak = max(self.peak, self._rss())
+
+
+def _runPipeline(sims, params, stagefunc):
+    from htmd.projections.metric import Metric
+    from htmd.projections.tica import TICA
+    from htmd.model import Model
+    from htmd.kinetics import Kinetics
+    from moleculekit.projections.metricdistance import MetricSelfDistance
+    from sklearn.cluster import MiniBatchKMeans
+
+    def project():
+        metr = Metric(sims)
+        metr.set(MetricSelfDistance('name CA', periodic=None))
+        data = metr.project()
+        data.fstep = 0.1
+        return data
+
+    def tica(data):
+        tic = TICA(data, params['ticalag'])
+        return tic.project(params['ticadim'])
+
+    def cluster(data):
+        data.cluster(MiniBatchKMeans(n_clusters=params['clusters'], random_state=params['seed']))
+        return data
+
+    def markovModel(data):
+        model = Model(data)
+        model.markovModel(params['lag'], params['macronum'])
+        return model
+
+    def getRates(model):
+        kin = Kinetics(model, temperature=298, source=0, sink=model.macronum - 1)
+        return kin.getRates()
+
+    data = stagefunc('project', project)
+    data = stagefunc('tica', tica, data)
+    data = stagefunc('cluster', cluster, data)
+    model = stagefunc('markovModel', markovModel, data)
+    stagefunc('getRates', getRates, model)
+
+
+def _gitCommit():
+    import subprocess
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def benchmark(numatoms=50, numframes=1000, numtrajs=20, ticalag=10, ticadim=3, clusters=100, lag=5, macronum=3,
+              repeats=3, memory=True, seed=0, output=None, workdir=None):
+    """ Times the stages of the analysis pipeline on synthetic simulations
+
+    Each stage is timed `repeats` times and the fastest time is reported. If `memory` is True, the pipeline is run once
+    more with tracemalloc enabled to measure the peak memory allocated by each stage. Memory is measured in a separate
+    run as tracing slows down execution.
+
+    tracemalloc only sees Python allocations of the main process, so `peakmemory` misses joblib workers and native
+    (numba, BLAS) allocations. The memory run therefore also samples the resident memory of the process and all of its
+    child processes and reports the peak as `peakrss`. `peakrss` includes the memory already in use before the stage
+    started and requires psutil; it is None if psutil is not installed.
+
+    Parameters
+    ----------
+    numatoms : int
+        Number of atoms of the synthetic system
+    numframes : int
+        Number of frames of each trajectory
+    numtrajs : int
+        Number of trajectories
+    ticalag : int
+        TICA lag time in frames
+    ticadim : int
+        Number of TICA dimensions to keep
+    clusters : int
+        Number of clusters
+    lag : int
+        Markov model lag time in frames
+    macronum : int
+        Number of macrostates
+    repeats : int
+        Number of times to run each stage
+    memory : bool
+        Measure the peak memory of each stage
+    seed : int
+        Random seed of the synthetic data and clustering
+    output : str
+        A JSON file to which to write the results
+    workdir : str
+        Folder in which to write the synthetic simulations. If None a temporary folder is used and removed afterwards.
+
+    Returns
+    -------
+    results : dict
+        The benchmark results
+
+    Examples
+    --------
+    >>> res = benchmark(numatoms=100, numframes=2000, numtrajs=50, output='bench.json')
+    >>> res['stages']['cluster']['time']
+    """
+    import platform
+    import datetime
+    import tracemalloc
+    from htmd.version import version
+    from htmd.util import _getNjobs, synthesizeSimulations
+
+    params = {'numatoms': numatoms, 'numframes': numframes, 'numtrajs': numtrajs, 'ticalag': ticalag,
+              'ticadim': ticadim, 'clusters': clusters, 'lag': lag, 'macronum': macronum, 'repeats': repeats,
+              'seed': seed}
+    stages = {s: {'times': [], 'time': None, 'peakmemory': None, 'peakrss': None} for s in _STAGES}
+
+    def timeStage(name, func, *args):
+        t = time.perf_counter()
+        res = func(*args)
+        stages[name]['times'].append(time.perf_counter() - t)
+        return res
+
+    def traceStage(name, func, *args):
+        tracemalloc.start()
+        try:
+            with _PeakRSS() as rss:
+                res = func(*args)
+            stages[name]['peakmemory'] = tracemalloc.get_traced_memory()[1]
+            stages[name]['peakrss'] = rss.peak
+        finally:
+            tracemalloc.stop()
+        return res
+
+    tmpdir = workdir
+    if tmpdir is None:
+        tmpdir = tempfile.mkdtemp(prefix='htmdbenchmark')
+    try:
+        t = time.perf_counter()
+        sims = synthesizeSimulations(tmpdir, numatoms=numatoms, numframes=numframes, numtrajs=numtrajs, seed=seed)
+        synthtime = time.perf_counter() - t
+        for _ in range(repeats):
+            _runPipeline(sims, params, timeStage)
+        if memory:
+            _runPipeline(sims, params, traceStage)
+    finally:
+        if workdir is None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    for s in stages.values():
+        s['time'] = min(s['times']) if len(s['times']) else None
+
+    results = {
+        'commit': _gitCommit(),
+        'version': version(),
+        'date': datetime.datetime.now().isoformat(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'njobs': _getNjobs(),
+        'parameters': params,
+        'synthesis': synthtime,
+        'stages': stages,
+    }
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+def compareBenchmarks(old, new):
+    """ Compares two benchmark results
+
+    Parameters
+    ----------
+    old : dict or str
+        The reference results or a JSON file containing them
+    new : dict or str
+        The new results or a JSON file containing them
+
+    Returns
+    -------
+    table : str
+        A table with the time, peak traced memory and peak resident memory of each stage and the ratio new/old
+    """
+    if isinstance(old, str):
+        with open(old, 'r') as f:
+            old = json.load(f)
+    if isinstance(new, str):
+        with open(new, 'r') as f:
+            new = json.load(f)
+    sizes = [{k: v for k, v in res['parameters'].items() if k != 'repeats'} for res in (old, new)]
+    if sizes[0] != sizes[1]:
+        logger.warning('The benchmarks were run with different parameters. Their comparison is not meaningful.')
+
+    def ratio(a, b):
+        return '{:.2f}'.format(b / a) if a and b is not None else '-'
+
+    def mb(x):
+        return '{:.1f}'.format(x / 2 ** 20) if x is not None else '-'
+
+    row = '{:<12} {:>10} {:>10} {:>7} {:>10} {:>10} {:>7} {:>10} {:>10} {:>7}'
+    lines = [row.format('stage', 'old (s)', 'new (s)', 'ratio', 'old (MB)', 'new (MB)', 'ratio', 'old RSS', 'new RSS',
+                        'ratio')]
+    for s in _STAGES:
+        o = old['stages'][s]
+        n = new['stages'][s]
+        # Results written before the resident memory was measured have no peakrss
+        orss = o.get('peakrss')
+        nrss = n.get('peakrss')
+        lines.append(row.format(
+            s, '{:.3f}'.format(o['time']), '{:.3f}'.format(n['time']), ratio(o['time'], n['time']),
+            mb(o['peakmemory']), mb(n['peakmemory']), ratio(o['peakmemory'], n['peakmemory']), mb(orss), mb(nrss),
+            ratio(orss, nrss)))
+    lines.append('old commit: {}, new commit: {}'.format(old['commit'], new['commit']))
+    return '\n'.join(lines)
+
+
+import unittest
+
+
+class _TestBenchmark(unittest.TestCase):
+    def test_benchmark(self):
+        from htmd.util import tempname
+        output = tempname(suffix='.json')
+        res = benchmark(numatoms=6, numframes=100, numtrajs=3, ticalag=2, ticadim=2, clusters=4, lag=2, macronum=2,
+                        repeats=2, output=output)
+        try:
+            with open(output, 'r') as f:
+                self.assertEqual(json.load(f), json.loads(json.dumps(res)))
+        finally:
+            os.remove(output)
+        for s in _STAGES:
+            self.assertEqual(len(res['stages'][s]['times']), 2)
+            self.assertEqual(res['stages'][s]['time'], min(res['stages'][s]['times']))
+            self.assertGreater(res['stages'][s]['peakmemory'], 0)
+
+    def test_compare_benchmarks(self):
+        stages = {s: {'times': [1.0], 'time': 1.0, 'peakmemory': 2 ** 20, 'peakrss': None} for s in _STAGES}
+        old = {'commit': 'a', 'parameters': {'numatoms': 10, 'repeats': 1}, 'stages': stages}
+        new = {'commit': 'b', 'parameters': {'numatoms': 10, 'repeats': 3},
+               'stages': {s: {'times': [0.5], 'time': 0.5, 'peakmemory': 2 ** 21, 'peakrss': 2 ** 22}
+                          for s in _STAGES}}
+        # Old results without peakrss can still be compared
+        del old['stages']['tica']['peakrss']
+        lines = compareBenchmarks(old, new).split('\n')
+        self.assertEqual(len(lines), len(_STAGES) + 2)
+        for line, s in zip(lines[1:], _STAGES):
+            self.assertEqual(line.split(), [s, '1.000', '0.500', '0.50', '1.0', '2.0', '2.00', '-', '4.0', '-'])
+        self.assertEqual(lines[-1], 'old commit: a, new commit: b')
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark of the HTMD analysis pipeline on synthetic simulations')
+    parser.add_argument('--atoms', type=int, default=50, help='Number of atoms')
+    parser.add_argument('--frames', type=int, default=1000, help='Number of frames per trajectory')
+    parser.add_argument('--trajectories', type=int, default=20, help='Number of trajectories')
+    parser.add_argument('--ticalag', type=int, default=10, help='TICA lag in frames')
+    parser.add_argument('--ticadim', type=int, default=3, help='Number of TICA dimensions')
+    parser.add_argument('--clusters', type=int, default=100, help='Number of clusters')
+    parser.add_argument('--lag', type=int, default=5, help='Markov model lag in frames')
+    parser.add_argument('--macronum', type=int, default=3, help='Number of macrostates')
+    parser.add_argument('--repeats', type=int, default=3, help='Number of timing repeats')
+    parser.add_argument('--no-memory', action='store_true', help='Do not measure peak memory')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    parser.add_argument('--output', default=None, help='JSON file to write the results to')
+    parser.add_argument('--compare', default=None, help='JSON file of previous results to compare against')
+    args = parser.parse_args()
+
+    res = benchmark(numatoms=args.atoms, numframes=args.frames, numtrajs=args.trajectories, ticalag=args.ticalag,
+                    ticadim=args.ticadim, clusters=args.clusters, lag=args.lag, macronum=args.macronum,
+                    repeats=args.repeats, memory=not args.no_memory, seed=args.seed, output=args.output)
+    if args.compare is not None:
+        print(compareBenchmarks(args.compare, res))
+    else:
+        print(json.dumps(res['stages'], indent=2))
@@ -0,0 +1,267 @@
+# (c) 2015-2018 Acellera Ltd http://www.acellera.com
+# All Rights Reserved
+# Distributed under HTMD Software License Agreement
+# No redistribution in whole or part
+#
+"""
+Bootstrapping of Markov models for error estimates of their timescales, equilibrium populations and kinetics.
+
+Each bootstrap replica resamples the trajectories of a clustered :class:`MetricData <htmd.metricdata.MetricData>`
+object, reusing its cluster labels, and builds a Markov model on them. The replicas run in a pool of processes which
+receive the cluster labels once instead of a copy of the data with every replica. Since PCCA numbers the macrostates
+of every replica arbitrarily, they are matched to the macrostates of a reference model by their cluster overlap.
+"""
+import numpy as np
+import logging
+logger = logging.getLogger(__name__)
+
+
+def bootstrapModel(model, numboot=100, ratio=0.8, replacement=False, kinetics=None, nits=None, sparse=None,
+                   njobs=None, seed=None):
+    """ Bootstrap a Markov model in parallel
+
+    Parameters
+    ----------
+    model : :class:`Model <htmd.model.Model>` object
+        The reference model. Every replica is built with its lag time and number of macrostates and its macrostates
+        are matched to the ones of this model.
+    numboot : int
+        Number of bootstrap replicas
+    ratio : float
+        What ratio of trajectories to keep in each replica. e.g. 0.8
+    replacement : bool
+        If we should sample the trajectories with replacement
+    kinetics : :class:`Kinetics <htmd.kinetics.Kinetics>` object
+        If given, the rates between all macrostates are calculated for every replica with the temperature,
+        concentration and bulk (source) state of this object
+    nits : int
+        Number of implied timescales to calculate. If None it will use the number of macrostates minus one.
+    sparse : bool
+        Build sparse Markov models. See :func:`Model.markovModel <htmd.model.Model.markovModel>`. If None, the replicas
+        are built like the reference model.
+    njobs : int
+        Number of processes to run the replicas in. If None it will use the default from htmd.config.
+    seed : int
+        Random seed of the trajectory sampling
+
+    Returns
+    -------
+    boot : :class:`BootstrapResults` object
+        The results of all replicas
+
+    Examples
+    --------
+    >>> model.markovModel(100, 5)
+    >>> kin = Kinetics(model, temperature=300, concentration=0.015)
+    >>> boot = bootstrapModel(model, numboot=100, kinetics=kin)
+    >>> mean, low, high = boot.confidenceInterval('koff', ci=95)
+    >>> print(boot)
+    """
+    from htmd.config import _config
+    from htmd.metricdata import _bootstrapTrajectories
+    from scipy.sparse import issparse
+    from htmd.parallelprogress import ParallelExecutor, delayed, SharedState
+    model._integrityCheck(postmsm=True)
+    if kinetics is not None:
+        kinetics._intergrityCheck()
+        if kinetics.model is not model:
+            raise AttributeError('The kinetics object must have been created from the reference model')
+    data = model.data
+    if nits is None:
+        nits = model.macronum - 1
+    if sparse is None:
+        sparse = issparse(model.P)
+    njobs = njobs if njobs is not None else _config['njobs']
+
+    rng = np.random.RandomState(seed)
+    samples = [_bootstrapTrajectories(data.numTrajectories, ratio, replacement, rng) for _ in range(numboot)]
+
+    kinparams = None
+    if kinetics is not None:
+        kinparams = (kinetics.temperature, kinetics.concentration, kinetics.source)
+    # Only the cluster labels are needed to build the replicas. They are sent to each worker process once.
+    state = (list(data.St), data.K, data.fstep, model.lag, model.macronum, model.macro_ofcluster, sparse, nits,
+             kinparams)
+    with SharedState(state, share=(njobs != 1), prefix='htmdbootstrap') as shared:
+        aprun = ParallelExecutor(n_jobs=njobs)
+        results = aprun(total=numboot, desc='Bootstrapping')(delayed(_bootstrapReplica)(shared, s) for s in samples)
+
+    failed = np.array([r is None for r in results])
+    if np.any(failed):
+        logger.warning('{} of {} bootstrap replicas failed to produce a Markov model and were '
+                       'discarded.'.format(np.sum(failed), numboot))
+    results = [r for r in results if r is not None]
+    if len(results) == 0:
+        raise RuntimeError('All bootstrap replicas failed. Please revise your clustering or bootstrap ratio.')
+
+    rates = None
+    if kinetics is not None:
+        rates = np.stack([r[3] for r in results])
+    return BootstrapResults(timescales=np.vstack([r[0] for r in results]), eq=np.vstack([r[1] for r in results]),
+                            clustereq=np.vstack([r[2] for r in results]), rates=rates,
+                            samples=[s for s, f in zip(samples, failed) if not f],
+                            source=None if kinetics is None else kinetics.source,
+                            sink=None if kinetics is None else kinetics.sink)
+
+
+class BootstrapResults(object):
+    """ The results of a set of bootstrap replicas of a Markov model. Constructed by :func:`bootstrapModel`.
+
+    Macrostates follow the numbering of the reference model. Macrostates which could not be matched in a replica
+    (e.g. because PCCA produced fewer macrostates) are NaN in that replica.
+
+    Attributes
+    ----------
+    timescales : np.ndarray
+        The implied timescales in ns of each replica, of shape (numboot, nits)
+    eq : np.ndarray
+        The equilibrium population of each macrostate in each replica, of shape (numboot, macronum)
+    clustereq : np.ndarray
+        The equilibrium population of each cluster in each replica, of shape (numboot, K). NaN for clusters outside the
+        active set of a replica.
+    rates : np.ndarray
+        The rates between all macrostates in each replica, of shape (numboot, macronum, macronum), as returned by
+        :func:`Kinetics.getRateMatrix <htmd.kinetics.Kinetics.getRateMatrix>`. None if no kinetics were calculated.
+    samples : list
+        The trajectory indexes of each replica
+    source : int
+        The source macrostate of the kinetics
+    sink : int
+        The sink macrostate of the kinetics
+    """
+    def __init__(self, timescales, eq, clustereq, rates=None, samples=None, source=None, sink=None):
+        self.timescales = timescales
+        self.eq = eq
+        self.clustereq = clustereq
+        self.rates = rates
+        self.samples = samples
+        self.source = source
+        self.sink = sink
+
+    @property
+    def numBootstraps(self):
+        """ The number of successful replicas """
+        return self.eq.shape[0]
+
+    def confidenceInterval(self, quantity, ci=95, source=None, sink=None):
+        """ Mean and confidence interval of a bootstrapped quantity
+
+        Parameters
+        ----------
+        quantity : str
+            One of 'timescales', 'eq', 'clustereq' or a rate: 'mfpton', 'mfptoff', 'kon', 'koff', 'kdeq', 'g0eq'
+        ci : float
+            The confidence level in percent. The interval is given by the percentiles of the replicas.
+        source : int
+            The source macrostate of a rate. If None it will use the source of the kinetics.
+        sink : int
+            The sink macrostate of a rate. If None it will use the sink of the kinetics.
+
+        Returns
+        -------
+        mean : float or np.ndarray
+            The mean over the replicas
+        lower : float or np.ndarray
+            The lower bound of the confidence interval
+        upper : float or np.ndarray
+            The upper bound of the confidence interval
+
+        Examples
+        --------
+        >>> mean, low, high = boot.confidenceInterval('eq')
+        >>> mean, low, high = boot.confidenceInterval('kon', source=0, sink=3)
+        """
+        from htmd.kinetics import Rates
+        if quantity in ('timescales', 'eq', 'clustereq'):
+            values = getattr(self, quantity)
+        elif quantity in Rates._fields:
+            if self.rates is None:
+                raise AttributeError('No rates were calculated. Pass a Kinetics object to bootstrapModel.')
+            source = self.source if source is None else source
+            sink = self.sink if sink is None else sink
+            values = self.rates[quantity][:, source, sink]
+        else:
+            raise NameError('Unknown quantity {}'.format(quantity))
+        alpha = (100 - ci) / 2
+        with np.errstate(invalid='ignore'):
+            return np.nanmean(values, axis=0), np.nanpercentile(values, alpha, axis=0), \
+                   np.nanpercentile(values, 100 - alpha, axis=0)
+
+    def __repr__(self):
+        return '<{}.{} object at {}>\n'.format(self.__class__.__module__, self.__class__.__name__, hex(id(self))) \
+               + self.__str__()
+
+    def __str__(self):
+        from htmd.kinetics import Rates
+        s = 'Bootstrap of {} replicas (mean and 95% confidence interval)\n'.format(self.numBootstraps)
+        mean, low, high = self.confidenceInterval('eq')
+        for i in range(len(mean)):
+            s += 'macro {} eq = {:.3f} [{:.3f}, {:.3f}]\n'.format(i, mean[i], low[i], high[i])
+        if self.rates is not None:
+            s += 'rates from source {} to sink {}:\n'.format(self.source, self.sink)
+            for f in Rates._fields:
+                mean, low, high = self.confidenceInterval(f)
+                s += '{} = {:.2E} [{:.2E}, {:.2E}]\n'.format(f, mean, low, high)
+        return s
+
+
+def _bootstrapReplica(shared, trajidx):
+    St, K, fstep, lag, macronum, refmacro_ofcluster, sparse, nits, kinparams = shared.get()
+    from htmd.metricdata import MetricData, Trajectory
+    from htmd.model import Model
+
+    # Trajectories only carry the labels. The empty projections give them their lengths without copying any data.
+    trajectories = [Trajectory(projection=np.empty((len(St[i]), 0), dtype=np.float32), cluster=St[i])
+                    for i in trajidx]
+    data = MetricData(trajectories=trajectories, fstep=fstep)
+    data.K = K
+    data.N = np.bincount(np.concatenate([St[i] for i in trajidx]), minlength=K)
+    data._clusterid = data._dataid
+
+    modellogger = logging.getLogger('htmd.model')
+    level = modellogger.level
+    modellogger.setLevel(logging.WARNING)
+    try:
+        model = Model(data)
+        model.markovModel(lag, macronum, sparse=sparse)
+    except (RuntimeError, ValueError, IndexError):
+        # Resampled data can have too few connected states for the estimation or PCCA
+        return None
+    finally:
+        modellogger.setLevel(level)
+
+    timescales = np.full(nits, np.nan)
+    its = model.msm.timescales(min(nits, model.micronum - 1)) * fstep
+    timescales[:len(its)] = its
+
+    clustereq = np.full(K, np.nan)
+    clustereq[model.cluster_ofmicro] = model.msm.stationary_distribution
+
+    # Map the macrostates of the replica to the ones of the reference model
+    tomacro = _matchMacrostates(model.macro_ofcluster, refmacro_ofcluster, data.N, model.macronum, macronum)
+    eq = np.full(macronum, np.nan)
+    eq[tomacro] = model.eqDistribution(plot=False)
+
+    rates = None
+    if kinparams is not None:
+        from htmd.kinetics import Kinetics, Rates
+        temperature, concentration, refsource = kinparams
+        rates = np.full((macronum, macronum), np.nan, dtype=[(f, np.float64) for f in Rates._fields])
+        source = np.where(tomacro == refsource)[0]
+        if len(source):
+            sink = 0 if source[0] != 0 else 1
+            kin = Kinetics(model, temperature, concentration=concentration, source=source[0], sink=sink)
+            rates[np.ix_(tomacro, tomacro)] = kin.getRateMatrix()
+    return timescales, eq, clustereq, rates
+
+
+def _matchMacrostates(macro_ofcluster, refmacro_ofcluster, population, macronum, refmacronum):
+    """ Index of the reference macrostate of each macrostate, matched by the population of the clusters they share """
+    from scipy.optimize import linear_sum_assignment
+    valid = (macro_ofcluster >= 0) & (refmacro_ofcluster >= 0)
+    overlap = np.zeros((macronum, refmacronum))
+    np.add.at(overlap, (macro_ofcluster[valid], refmacro_ofcluster[valid]), population[valid])
+    rows, cols = linear_sum_assignment(-overlap)
+    tomacro = np.empty(macronum, dtype=int)
+    tomacro[rows] = cols
+    return tomacro
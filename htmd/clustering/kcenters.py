@@ -4,6 +4,7 @@
 # No redistribution in whole or part
 #
 import numpy as np
+from numba import jit, prange
 from scipy.spatial.distance import cdist
 from sklearn.base import BaseEstimator, ClusterMixin, TransformerMixin
 import logging
@@ -18,15 +19,27 @@ class KCenter(BaseEstimator, ClusterMixin, TransformerMixin):
     which are closer to the new center than the old one are assigned to the new cluster. This goes on, until K clusters
     have been created.
 
+    The distances to the centers are updated in place in cache-sized chunks of the data which are processed in parallel.
+    float32 data is processed without conversion.
+
     Parameters
     ----------
     n_clusters: int
         desired number of clusters
+    njobs: int
+        Number of threads to use. Negative values count back from all available threads (-1 uses all of them). If None
+        it will use the default from htmd.config.
+    chunksize: int
+        Number of frames processed at once by each thread
 
     Examples
     --------
     >>> cluster = KCenter(n_cluster=200)
     >>> cluster.fit(data)
+    >>> # Or clustering data which does not fit in memory in batches
+    >>> for batch in batches:
+    >>>     cluster.partial_fit(batch)
+    >>> labels = cluster.predict(data)
 
     Attributes
     ----------
@@ -40,10 +53,14 @@ class KCenter(BaseEstimator, ClusterMixin, TransformerMixin):
         list with number of frames in each cluster
     distance : list
         list with the distance of each frame from the nearest center
+
+    After `partial_fit`, `labels_`, `clusterSize` and `distance` refer to the last batch and `centerFrames` is empty.
     """
 
-    def __init__(self, n_clusters):
+    def __init__(self, n_clusters, njobs=None, chunksize=4096):
         self.n_clusters = n_clusters
+        self.njobs = njobs
+        self.chunksize = chunksize
         self.cluster_centers_ = []
         self.centerFrames = []
         self.labels_ = []
@@ -63,42 +80,103 @@ class KCenter(BaseEstimator, ClusterMixin, TransformerMixin):
             self.cluster_centers_ = []
             self.centerFrames = []
             self.clusterSize = []
+        self._fit(data, np.random.randint(np.size(data, 0)))
+        return self
+
+    def partial_fit(self, data):
+        """ Update the centers with a new batch of data.
+
+        New candidate centers are picked from the batch with KCenter, and the final centers are then selected with
+        KCenter among the existing and the candidate centers.
+
+        Parameters
+        ----------
+        data : np.ndarray
+            A 2D array of data. Columns are features and rows are data examples.
+        """
+        if len(self.cluster_centers_) == 0:
+            self._fit(data, np.random.randint(np.size(data, 0)))
+            return self
+
+        candidates = KCenter(self.n_clusters, njobs=self.njobs, chunksize=self.chunksize)
+        candidates._fit(data, np.random.randint(np.size(data, 0)))
+        pool = np.vstack((self.cluster_centers_, candidates.cluster_centers_.astype(self.cluster_centers_.dtype)))
+        merged = KCenter(self.n_clusters, njobs=self.njobs, chunksize=self.chunksize)
+        merged._fit(pool, 0)  # Starting from an existing center keeps the clustering stable between batches
+
+        self.cluster_centers_ = merged.cluster_centers_
+        self.centerFrames = []
+        self.labels_, self.distance = self._assign(data)
+        self.clusterSize = np.bincount(self.labels_, minlength=len(self.cluster_centers_))
+        return self
+
+    def predict(self, data):
+        """ Assign data to the nearest cluster center.
+
+        Parameters
+        ----------
+        data : np.ndarray
+            A 2D array of data. Columns are features and rows are data examples.
+
+        Returns
+        -------
+        labels : np.ndarray
+            The index of the nearest center of each data example
+        """
+        return self._assign(data)[0]
+
+    def _assign(self, data):
+        from htmd.clustering.nearestcenter import NearestCenter
+        return NearestCenter(self.cluster_centers_, metric='euclidean', njobs=self.njobs, chunksize=self.chunksize).query(data)
+
+    def _fit(self, data, idxCenter):
+        self.cluster_centers_ = []
+        self.centerFrames = []
+        import numba
+        from htmd.util import _getNjobs
+        data = np.ascontiguousarray(data)
+        if data.dtype != np.float32 and data.dtype != np.float64:
+            data = data.astype(np.float32)
 
         # Initialization
         # select random point and assign all points to cluster 0
         numpoints = np.size(data, 0)
+        numchunks = int(np.ceil(numpoints / self.chunksize))
 
-        idxCenter = np.random.randint(numpoints)
-        self.cluster_centers_.append(data[idxCenter, :])
+        self.cluster_centers_.append(data[idxCenter, :].copy())
         self.centerFrames.append(idxCenter)
         self.labels_ = np.zeros(numpoints, dtype=int)
 
-        dist = self._dist(self.cluster_centers_, data)
-        countCluster = 1
+        # Squared distances of each point to its nearest center and the maximum of each chunk
+        dist = np.full(numpoints, np.inf)
+        chunkmax = np.zeros(numchunks)
+        chunkargmax = np.zeros(numchunks, dtype=np.int64)
 
-        while len(self.cluster_centers_) < self.n_clusters:
-            if np.max(dist) == 0:
-                break
+        njobs = self.njobs if self.njobs is not None else _getNjobs()
+        oldthreads = numba.get_num_threads()
+        numba.set_num_threads(_numbaThreads(njobs))
+        try:
+            _updateNearestCenter(data, data[idxCenter, :], dist, self.labels_, 0, self.chunksize, chunkmax, chunkargmax)
+            countCluster = 1
 
-            # find point furthest away from all center
-            newCenterIdx = np.argmax(dist)
-            newCenter = data[newCenterIdx, :]
-            self.centerFrames.append(newCenterIdx)
-            self.cluster_centers_.append(newCenter)
+            while len(self.cluster_centers_) < self.n_clusters:
+                maxchunk = np.argmax(chunkmax)
+                if chunkmax[maxchunk] == 0:
+                    break
 
-            # find all points closer to new center than old center
-            newdist = self._dist(newCenter, data)
-            switchIdx = dist > newdist
-
-            # assign them to new cluster
-            self.labels_[switchIdx] = countCluster
-            dist[switchIdx] = newdist[switchIdx]
-
-            countCluster += 1
+                # find point furthest away from all centers and assign to it all points closer to it than their center
+                newCenterIdx = chunkargmax[maxchunk]
+                self.centerFrames.append(newCenterIdx)
+                self.cluster_centers_.append(data[newCenterIdx, :].copy())
+                _updateNearestCenter(data, data[newCenterIdx, :], dist, self.labels_, countCluster, self.chunksize,
+                                     chunkmax, chunkargmax)
+                countCluster += 1
+        finally:
+            numba.set_num_threads(oldthreads)
 
         # update clusterSize
         self.clusterSize = np.bincount(self.labels_)
-        self.distance = dist
+        self.distance = np.sqrt(dist)
         self.cluster_centers_ = np.array(self.cluster_centers_)
 
     @staticmethod
@@ -107,6 +185,103 @@ class KCenter(BaseEstimator, ClusterMixin, TransformerMixin):
         return dist
 
 
+def _numbaThreads(njobs):
+    """ Number of numba threads to use for `njobs`. Negative values count back from all available threads. """
+    import numba
+    maxthreads = numba.config.NUMBA_NUM_THREADS
+    if njobs < 0:
+        njobs = maxthreads + 1 + njobs
+    return max(1, min(njobs, maxthreads))
+
+
+@jit(nopython=True, parallel=True, nogil=True)
+def _updateNearestCenter(data, center, dist, labels, label, chunksize, chunkmax, chunkargmax):
+    """ Assigns to `label` all points closer to `center` than their current center and updates the chunk maxima """
+    numpoints, numdim = data.shape
+    for c in prange(chunkmax.shape[0]):
+        start = c * chunksize
+        end = min(start + chunksize, numpoints)
+        maxdist = -1.0
+        maxidx = start
+        for i in range(start, end):
+            d = 0.0
+            for j in range(numdim):
+                diff = data[i, j] - center[j]
+                d += diff * diff
+            if d < dist[i]:
+                dist[i] = d
+                labels[i] = label
+            if dist[i] > maxdist:
+                maxdist = dist[i]
+                maxidx = i
+        chunkmax[c] = maxdist
+        chunkargmax[c] = maxidx
+
+
+import unittest
+
+
+class _TestKCenter(unittest.TestCase):
+    @staticmethod
+    def _reference(data, idxCenter, n_clusters):
+        centers = [idxCenter]
+        labels = np.zeros(data.shape[0], dtype=int)
+        dist = cdist(data, data[[idxCenter]])[:, 0]
+        for k in range(1, n_clusters):
+            new = np.argmax(dist)
+            newdist = cdist(data, data[[new]])[:, 0]
+            closer = newdist < dist
+            labels[closer] = k
+            dist[closer] = newdist[closer]
+            centers.append(new)
+        return centers, labels, dist
+
+    def test_fit(self):
+        rng = np.random.RandomState(0)
+        for dtype in (np.float64, np.float32):
+            data = rng.rand(3000, 5).astype(dtype)
+            np.random.seed(1)
+            first = np.random.randint(data.shape[0])
+            np.random.seed(1)
+            kc = KCenter(n_clusters=20, njobs=2, chunksize=128).fit(data)  # Many chunks with a partial last one
+            centers, labels, dist = self._reference(data.astype(np.float64), first, 20)
+            assert kc.centerFrames == centers
+            assert np.array_equal(kc.labels_, labels)
+            assert np.allclose(kc.distance, dist, atol=1e-5)
+            assert np.array_equal(kc.cluster_centers_, data[centers])
+            assert np.array_equal(kc.clusterSize, np.bincount(labels))
+            assert np.array_equal(kc.predict(data), np.argmin(cdist(data, kc.cluster_centers_), axis=1))
+
+    def test_njobs(self):
+        import numba
+        maxthreads = numba.config.NUMBA_NUM_THREADS
+        assert _numbaThreads(-1) == maxthreads
+        assert _numbaThreads(-2) == max(1, maxthreads - 1)
+        assert _numbaThreads(-maxthreads - 5) == 1
+        assert _numbaThreads(maxthreads + 5) == maxthreads
+        data = np.random.RandomState(0).rand(1000, 3)
+        labels = []
+        for njobs in (1, -1):
+            np.random.seed(1)
+            labels.append(KCenter(n_clusters=10, njobs=njobs, chunksize=100).fit(data).labels_)
+        assert np.array_equal(labels[0], labels[1])
+
+    def test_partial_fit(self):
+        rng = np.random.RandomState(0)
+        data = rng.rand(2000, 3)
+        np.random.seed(2)
+        kc = KCenter(n_clusters=15, chunksize=100)
+        for chunk in np.array_split(data, 3):
+            kc.partial_fit(chunk)
+        assert len(kc.cluster_centers_) == 15
+        # Centers are points of the data and the last batch is labelled with its nearest center
+        assert np.all(np.min(cdist(kc.cluster_centers_, data), axis=1) == 0)
+        refdist = cdist(chunk, kc.cluster_centers_)
+        assert np.array_equal(kc.labels_, np.argmin(refdist, axis=1))
+        assert np.allclose(kc.distance, np.min(refdist, axis=1))
+        assert np.array_equal(kc.predict(data), np.argmin(cdist(data, kc.cluster_centers_), axis=1))
+
+
 if __name__ == '__main__':
     """
     infile = open("../../clusterdata/R15.txt")
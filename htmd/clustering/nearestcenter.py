@@ -0,0 +1,198 @@
+# (c) 2015-2018 Acellera Ltd http://www.acellera.com
+# All Rights Reserved
+# Distributed under HTMD Software License Agreement
+# No redistribution in whole or part
+#
+import numpy as np
+import logging
+logger = logging.getLogger(__name__)
+
+
+class NearestCenter(object):
+    """ Assigns data to the nearest of a fixed set of cluster centers
+
+    Useful for labelling new frames against an existing clustering without refitting it. For euclidean distances in
+    few dimensions the centers are indexed with a KD-tree, in higher dimensions the distances are calculated in blocks
+    with matrix products. Other metrics (e.g. hamming for boolean contact data) fall back to scipy's cdist. The data is
+    processed in chunks which are distributed over `njobs` threads.
+
+    Parameters
+    ----------
+    centers : np.ndarray or :class:`MetricData <htmd.metricdata.MetricData>` object
+        A 2D array of cluster centers or a clustered MetricData object whose `Centers` will be used
+    metric : str
+        Any metric accepted by scipy's cdist. If None it will use 'hamming' for boolean centers and 'euclidean' otherwise.
+    njobs : int
+        Number of threads to use. Negative values count back from the number of CPUs (-1 uses all of them). If None it
+        will use the default from htmd.config.
+    chunksize : int
+        Number of data points assigned at a time. If None it is chosen based on the number of centers.
+
+    Examples
+    --------
+    >>> data.cluster(MiniBatchKMeans(n_clusters=1000))
+    >>> nc = NearestCenter(data)
+    >>> newlabels = nc.predict(newdata)
+    """
+    _kdtreedims = 16  # KD-trees stop being faster than brute force above this number of dimensions
+
+    def __init__(self, centers, metric=None, njobs=None, chunksize=None):
+        from htmd.metricdata import MetricData
+        if isinstance(centers, MetricData):
+            if centers.Centers is None:
+                raise RuntimeError('The MetricData object has not been clustered yet')
+            centers = centers.Centers
+        centers = np.asarray(centers)
+        if centers.ndim == 1:
+            centers = centers[:, np.newaxis]
+        if metric is None:
+            metric = 'hamming' if centers.dtype == bool else 'euclidean'
+
+        self.centers = centers
+        self.metric = metric
+        self.njobs = njobs
+        if chunksize is None:
+            chunksize = int(np.clip(2 ** 22 // max(len(centers), 1), 256, 65536))
+        self.chunksize = chunksize
+
+        self._tree = None
+        self._sqnorms = None
+        if metric == 'euclidean':
+            if centers.shape[1] <= self._kdtreedims:
+                from scipy.spatial import cKDTree
+                self._tree = cKDTree(centers)
+            else:
+                self._centers = centers.astype(np.float64)
+                self._sqnorms = np.einsum('ij,ij->i', self._centers, self._centers)
+
+    def query(self, data):
+        """ Find the nearest center of each data point
+
+        Parameters
+        ----------
+        data : np.ndarray
+            A 2D array of data. Columns are features and rows are data examples.
+
+        Returns
+        -------
+        labels : np.ndarray
+            The index of the nearest center of each data point
+        dist : np.ndarray
+            The distance of each data point to its nearest center
+        """
+        from htmd.util import _getNjobs
+        data = np.asarray(data)
+        if data.ndim == 1:
+            data = data[:, np.newaxis]
+        numpoints = data.shape[0]
+        labels = np.empty(numpoints, dtype=int)
+        dist = np.empty(numpoints)
+
+        def assignChunk(start):
+            labels[start:start+self.chunksize], dist[start:start+self.chunksize] = self._queryChunk(data[start:start+self.chunksize])
+
+        starts = range(0, numpoints, self.chunksize)
+        njobs = self.njobs if self.njobs is not None else _getNjobs()
+        if njobs < 0:
+            import multiprocessing
+            njobs = multiprocessing.cpu_count() + 1 + njobs
+        if njobs > 1 and len(starts) > 1:
+            # KD-tree queries, BLAS and cdist release the GIL so threads avoid copying the data to other processes
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=njobs) as pool:
+                list(pool.map(assignChunk, starts))
+        else:
+            for start in starts:
+                assignChunk(start)
+        return labels, dist
+
+    def predict(self, data):
+        """ Assign data to the nearest center
+
+        Parameters
+        ----------
+        data : np.ndarray or :class:`MetricData <htmd.metricdata.MetricData>` object
+            A 2D array of data or a MetricData object whose projected frames will be assigned
+
+        Returns
+        -------
+        labels : np.ndarray
+            The index of the nearest center of each data point. For MetricData objects an array containing the labels
+            of each trajectory is returned.
+        """
+        from htmd.metricdata import MetricData
+        if not isinstance(data, MetricData):
+            return self.query(data)[0]
+
+        labels = np.empty(data.numFrames, dtype=int)
+        for start, chunk in data._iterChunks(max(self.chunksize, 2 ** 16)):
+            labels[start:start+chunk.shape[0]] = self.query(chunk)[0]
+        return data.deconcatenate(labels)
+
+    def _queryChunk(self, chunk):
+        if self._tree is not None:
+            dist, labels = self._tree.query(chunk, k=1)
+            return labels, dist
+        if self._sqnorms is not None:
+            chunk = chunk.astype(np.float64)
+            sqdist = np.dot(chunk, self._centers.T)
+            sqdist *= -2
+            sqdist += self._sqnorms
+            labels = np.argmin(sqdist, axis=1)
+            rows = np.arange(chunk.shape[0])
+            sqdist = sqdist[rows, labels] + np.einsum('ij,ij->i', chunk, chunk)
+            return labels, np.sqrt(np.maximum(sqdist, 0))
+        from scipy.spatial.distance import cdist
+        dists = cdist(chunk, self.centers, self.metric)
+        labels = np.argmin(dists, axis=1)
+        return labels, dists[np.arange(dists.shape[0]), labels]
+
+
+
+import unittest
+
+
+class _TestNearestCenter(unittest.TestCase):
+    def test_query(self):
+        from scipy.spatial.distance import cdist
+        rng = np.random.RandomState(0)
+        # KD-tree in few dimensions, matrix products in many dimensions
+        for dims in (3, 40):
+            X = rng.rand(5000, dims)
+            C = rng.rand(300, dims)
+            for njobs in (1, 2, -1):
+                labels, dist = NearestCenter(C, njobs=njobs, chunksize=777).query(X)  # Partial last chunk
+                refdist = cdist(X, C)
+                assert np.array_equal(labels, np.argmin(refdist, axis=1))
+                assert np.allclose(dist, np.min(refdist, axis=1))
+
+        X = rng.rand(3000, 4)
+        C = rng.rand(50, 4)
+        labels, dist = NearestCenter(C, metric='cityblock', chunksize=512).query(X)
+        refdist = cdist(X, C, 'cityblock')
+        assert np.array_equal(labels, np.argmin(refdist, axis=1))
+        assert np.allclose(dist, np.min(refdist, axis=1))
+
+        # Boolean data defaults to hamming distances
+        X = rng.rand(2000, 30) > 0.5
+        C = rng.rand(20, 30) > 0.5
+        nc = NearestCenter(C, chunksize=300)
+        assert nc.metric == 'hamming'
+        labels, dist = nc.query(X)
+        refdist = cdist(X, C, 'hamming')
+        assert np.allclose(dist, np.min(refdist, axis=1))
+        assert np.array_equal(labels, np.argmin(refdist, axis=1))
+
+    def test_predict(self):
+        from scipy.spatial.distance import cdist
+        from htmd.metricdata import MetricData
+        rng = np.random.RandomState(0)
+        dat = np.empty(3, dtype=object)
+        dat[:] = [rng.rand(n, 5).astype(np.float32) for n in (100, 250, 70)]
+        data = MetricData(dat=dat, ref=np.array([np.zeros((len(d), 2), dtype=int) for d in dat], dtype=object))
+        C = rng.rand(10, 5)
+        labels = NearestCenter(C, chunksize=64).predict(data)
+        assert len(labels) == 3
+        for d, l in zip(dat, labels):
+            assert np.array_equal(l, np.argmin(cdist(d, C), axis=1))
+        assert np.array_equal(NearestCenter(C).predict(dat[1]), np.argmin(cdist(dat[1], C), axis=1))
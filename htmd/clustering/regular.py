@@ -30,6 +30,10 @@ class RegCluster(BaseEstimator, ClusterMixin, TransformerMixin):
     --------
     >>> cluster = RegCluster(radius=5.1)
     >>> cluster.fit(data)
+    >>> # Or clustering data which does not fit in memory in batches
+    >>> for batch in batches:
+    >>>     cluster.partial_fit(batch)
+    >>> labels = cluster.predict(data)
 
     Attributes
     ----------
@@ -41,6 +45,9 @@ class RegCluster(BaseEstimator, ClusterMixin, TransformerMixin):
         list with number of cluster of each frame
     clusterSize_ : list
         list with number of frames in each cluster
+
+    After `partial_fit`, `labels_` refers to the last batch while `clusterSize` counts the frames of all batches seen so
+    far. Centers are never moved, so each frame is counted in the cluster it was assigned to when its batch was fitted.
     """
     def __init__(self, radius=None, n_clusters=None):
         if radius is None and n_clusters is None:
@@ -49,6 +56,7 @@ class RegCluster(BaseEstimator, ClusterMixin, TransformerMixin):
         self.radius = radius
         self.n_clusters = n_clusters
         self.labels_ = []
+        self._clusterSize = np.zeros(0, dtype=int)
 
     def fit(self, data):
         """ performs clustering of data
@@ -71,14 +79,92 @@ class RegCluster(BaseEstimator, ClusterMixin, TransformerMixin):
         from pyemma.coordinates.clustering.regspace import RegularSpaceClustering
         self._reg = RegularSpaceClustering(dmin=self.radius)
         self.labels_ = self._reg.fit_transform(data).flatten()
+        self._centers = self._reg.clustercenters
+        self._clusterSize = np.bincount(self.labels_, minlength=len(self._centers))
+        return self
+
+    def partial_fit(self, data):
+        """ Update the clustering with a new batch of data
+
+        Points of the batch which are further than `radius` from all existing centers are visited in order, and each
+        one that is not within `radius` of a center becomes a new center.
+
+        Parameters
+        ----------
+        data: np.ndarray
+                array of data points to cluster
+        """
+        from htmd.clustering.nearestcenter import NearestCenter
+        if getattr(self, '_centers', None) is None:
+            return self.fit(data)
+
+        labels, dist = NearestCenter(self._centers, metric='euclidean').query(data)
+        uncovered = np.where(dist > self.radius)[0]
+        newcenters = []
+        while len(uncovered):
+            newcenters.append(data[uncovered[0]])
+            newdist = cdist(np.atleast_2d(data[uncovered]), np.atleast_2d(newcenters[-1])).flatten()
+            labels[uncovered[newdist <= self.radius]] = len(self._centers) + len(newcenters) - 1
+            uncovered = uncovered[newdist > self.radius]
+        if len(newcenters):
+            self._centers = np.vstack((self._centers, np.array(newcenters, dtype=self._centers.dtype)))
+            logger.info('Added {} new clusters'.format(len(newcenters)))
+        self.labels_ = labels
+        counts = np.bincount(labels, minlength=len(self._centers))
+        counts[:len(self._clusterSize)] += self._clusterSize
+        self._clusterSize = counts
+        return self
+
+    def predict(self, data):
+        """ Assign data to the nearest cluster center
+
+        Parameters
+        ----------
+        data: np.ndarray
+                array of data points to assign
+
+        Returns
+        -------
+        labels : np.ndarray
+            The index of the nearest center of each data point
+        """
+        from htmd.clustering.nearestcenter import NearestCenter
+        return NearestCenter(self._centers, metric='euclidean').predict(data)
 
     @property
     def cluster_centers_(self):
-        return self._reg.clustercenters
+        return self._centers
 
     @property
     def clusterSize(self):
-        return np.bincount(self.labels_)
+        return self._clusterSize
+
+
+import unittest
+
+
+class _TestRegCluster(unittest.TestCase):
+    def test_partial_fit(self):
+        rng = np.random.RandomState(0)
+        data = rng.rand(1500, 2)
+        data = data[np.argsort(data[:, 0])]  # Later batches cover new regions and add centers
+        reg = RegCluster(radius=0.2)
+        batches = np.array_split(data, 3)
+        labels = []
+        ncenters = []
+        for batch in batches:
+            reg.partial_fit(batch)
+            labels.append(reg.labels_.copy())
+            ncenters.append(len(reg.cluster_centers_))
+        assert ncenters[0] < ncenters[1] < ncenters[2]
+        centers = reg.cluster_centers_
+        # Every frame is within radius of the center it was assigned to and all batches are counted
+        for batch, lab in zip(batches, labels):
+            assert np.all(np.linalg.norm(batch - centers[lab], axis=1) <= reg.radius + 1e-6)
+        assert np.array_equal(reg.labels_, labels[-1])
+        assert np.array_equal(reg.clusterSize, np.bincount(np.concatenate(labels), minlength=len(centers)))
+        assert reg.clusterSize.sum() == len(data)
+        assert np.array_equal(reg.predict(data), np.argmin(cdist(data, centers), axis=1))
 
 #
 # class RegCluster:
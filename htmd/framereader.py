@@ -0,0 +1,142 @@
+# (c) 2015-2018 Acellera Ltd http://www.acellera.com
+# All Rights Reserved
+# Distributed under HTMD Software License Agreement
+# No redistribution in whole or part
+#
+"""
+Reading of scattered trajectory frames. The requested frames are grouped by file so that every trajectory file is
+opened only once and read at sorted frame indexes, and the files are distributed over a pool of processes.
+"""
+import numpy as np
+import logging
+logger = logging.getLogger(__name__)
+
+
+_FRAMEFIELDS = ('coords', 'box', 'boxangles', 'step', 'time')
+
+
+def readFrames(trajfiles, frames, njobs=None, desc='Reading frames'):
+    """ Reads a set of frames from a set of trajectory files
+
+    Parameters
+    ----------
+    trajfiles : list of str
+        The trajectory file of each requested frame
+    frames : list of int
+        The index of each requested frame in its trajectory file
+    njobs : int
+        Number of processes to read files in parallel. If None it will use the default from htmd.config.
+    desc : str
+        Description of the progress bar
+
+    Returns
+    -------
+    framedata : dict
+        A dictionary with the 'coords', 'box', 'boxangles', 'step' and 'time' of the requested frames in the order in
+        which they were requested, with the frames in the last dimension as in :class:`Molecule <moleculekit.molecule.Molecule>`
+
+    Examples
+    --------
+    >>> fd = readFrames(['traj1.xtc', 'traj2.xtc', 'traj1.xtc'], [10, 3, 4])
+    >>> fd['coords'].shape
+    (2185, 3, 3)
+    """
+    from htmd.config import _config
+    from htmd.parallelprogress import ParallelExecutor, delayed
+    frames = np.asarray(frames, dtype=int)
+    if len(frames) == 0:
+        raise RuntimeError('No frames were requested')
+    uqfiles, fileidx = np.unique(np.asarray(trajfiles, dtype=str), return_inverse=True)
+    fileidx = fileidx.flatten()
+    byfile = np.split(np.argsort(fileidx, kind='stable'), np.cumsum(np.bincount(fileidx))[:-1])
+    requests = [np.unique(frames[idx]) for idx in byfile]
+
+    aprun = ParallelExecutor(n_jobs=njobs if njobs is not None else _config['njobs'])
+    results = aprun(total=len(uqfiles), desc=desc)(delayed(_readFileFrames)(f, r) for f, r in zip(uqfiles, requests))
+
+    framedata = {}
+    for field in _FRAMEFIELDS:
+        framedata[field] = np.empty(results[0][field].shape[:-1] + (len(frames),), dtype=results[0][field].dtype)
+    for idx, req, res in zip(byfile, requests, results):
+        pos = np.searchsorted(req, frames[idx])
+        for field in _FRAMEFIELDS:
+            framedata[field][..., idx] = res[field][..., pos]
+    return framedata
+
+
+def setFrames(mol, framedata, idx, trajfiles, frames):
+    """ Replaces the frames of a Molecule with a subset of frames read by `readFrames`
+
+    Parameters
+    ----------
+    mol : :class:`Molecule <moleculekit.molecule.Molecule>` object
+        The Molecule whose frames to replace. It is modified in place.
+    framedata : dict
+        The output of `readFrames`
+    idx : list of int
+        Which of the read frames to put into the Molecule
+    trajfiles : list of str
+        The trajectory files that were passed to `readFrames`
+    frames : list of int
+        The frames that were passed to `readFrames`
+    """
+    idx = np.asarray(idx, dtype=int)
+    if framedata['coords'].shape[0] != mol.numAtoms:
+        raise RuntimeError('The frames have {} atoms while the Molecule has {}'.format(framedata['coords'].shape[0],
+                                                                                    mol.numAtoms))
+    for field in _FRAMEFIELDS:
+        setattr(mol, field, np.ascontiguousarray(framedata[field][..., idx]))
+    mol.fileloc = [[trajfiles[i], int(frames[i])] for i in idx]
+    mol.frame = 0
+
+
+def _readFileFrames(trajfile, frames):
+    from moleculekit.molecule import Molecule
+    mol = Molecule()
+    mol.read(trajfile, frames=frames)
+    return {field: getattr(mol, field) for field in _FRAMEFIELDS}
+
+
+import unittest
+
+
+class _TestFrameReader(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        from htmd.util import tempname
+        from htmd.util import synthesizeSimulations
+        from moleculekit.molecule import Molecule
+        self.sims = synthesizeSimulations(tempname(), numatoms=6, numframes=50, numtrajs=3)
+        self.trajs = [Molecule(s.molfile) for s in self.sims]
+        for mol, sim in zip(self.trajs, self.sims):
+            mol.read(sim.trajectory[0])
+
+    def test_read_frames(self):
+        # Frames interleaved across files, out of order and repeated
+        requests = [(2, 10), (0, 5), (1, 49), (0, 0), (2, 3), (0, 5), (1, 7), (2, 10)]
+        trajfiles = [self.sims[s].trajectory[0] for s, _ in requests]
+        frames = [f for _, f in requests]
+        for njobs in (1, 2):
+            framedata = readFrames(trajfiles, frames, njobs=njobs)
+            assert framedata['coords'].shape == (6, 3, len(requests))
+            for i, (s, f) in enumerate(requests):
+                assert np.array_equal(framedata['coords'][:, :, i], self.trajs[s].coords[:, :, f])
+                assert np.array_equal(framedata['box'][:, i], self.trajs[s].box[:, f])
+                assert framedata['step'][i] == self.trajs[s].step[f]
+                assert framedata['time'][i] == self.trajs[s].time[f]
+
+    def test_set_frames(self):
+        from moleculekit.molecule import Molecule
+        trajfiles = [self.sims[1].trajectory[0], self.sims[0].trajectory[0]]
+        frames = [4, 9]
+        framedata = readFrames(trajfiles, frames, njobs=1)
+        mol = Molecule(self.sims[0].molfile)
+        setFrames(mol, framedata, [1, 0], trajfiles, frames)
+        assert mol.numFrames == 2
+        assert np.array_equal(mol.coords[:, :, 0], self.trajs[0].coords[:, :, 9])
+        assert np.array_equal(mol.coords[:, :, 1], self.trajs[1].coords[:, :, 4])
+        assert mol.fileloc == [[trajfiles[1], 9], [trajfiles[0], 4]]
+
+        mol.filter('index 0 1 2', _logger=False)
+        with self.assertRaises(RuntimeError):
+            setFrames(mol, framedata, [0], trajfiles, frames)
@@ -193,8 +193,10 @@ class Kinetics(object):
 
         from msmtools.analysis import mfpt
         r = Rates()
-        r.mfpton = model.data.fstep * model.lag * mfpt(self.model.P, origin=sourcemicros, target=sinkmicros)
-        r.mfptoff = model.data.fstep * model.lag * mfpt(self.model.P, origin=sinkmicros, target=sourcemicros)
+        # Passing the stationary distribution avoids recalculating it for every call. Sparse models use sparse solvers.
+        mu = model.msm.stationary_distribution
+        r.mfpton = model.data.fstep * model.lag * mfpt(self.model.P, origin=sourcemicros, target=sinkmicros, mu=mu)
+        r.mfptoff = model.data.fstep * model.lag * mfpt(self.model.P, origin=sinkmicros, target=sourcemicros, mu=mu)
         r.koff = 1E9 / r.mfptoff
         r.kon = 1E9 / (r.mfpton * conc)
         if conc != 1:
@@ -203,6 +205,57 @@ class Kinetics(object):
         r.kdeq = np.exp(r.g0eq / self._kBT)
         return r
 
+    def getRateMatrix(self):
+        """ Get the rates between all pairs of macrostates
+
+        Equivalent to calling `getRates` for every source and sink macrostate pair but the mean first passage times to
+        each macrostate are calculated with a single linear solve, which is then reused for all sources.
+
+        Returns
+        -------
+        rates : np.ndarray
+            A structured array of shape (macronum, macronum) with fields 'mfpton', 'mfptoff', 'kon', 'koff', 'kdeq' and
+            'g0eq'. Element [i, j] contains the rates with source macrostate i and sink macrostate j as returned by
+            `getRates(source=i, sink=j)`. The diagonal is zero.
+
+        Example
+        -------
+        >>> kin = Kinetics(model, temperature=300, concentration=0.015)
+        >>> rates = kin.getRateMatrix()
+        >>> rates['koff'][kin.source, kin.sink]
+        """
+        self._intergrityCheck()
+        model = self.model
+        macronum = model.macronum
+        eq = model.eqDistribution(plot=False)
+        mu = model.msm.stationary_distribution
+        macrosets = [np.where(model.macro_ofmicro == m)[0] for m in range(macronum)]
+
+        # mfpt[i, j]: mean first passage time from macro i (weighted by the stationary distribution) to macro j
+        tau = _mfptToSets(model.P, macrosets)
+        mfpt = np.zeros((macronum, macronum))
+        for i, micros in enumerate(macrosets):
+            mfpt[i] = mu[micros].dot(tau[micros]) / np.sum(mu[micros])
+        mfpt *= model.data.fstep * model.lag
+
+        # Concentration correction applies when the bulk state is the source and is inverted when it's the sink
+        conc = np.ones((macronum, macronum))
+        conc[self.source, :] = self.concentration
+        conc[:, self.source] = 1 / self.concentration
+        conc[self.source, self.source] = 1
+
+        offdiag = ~np.eye(macronum, dtype=bool)
+        rates = np.zeros((macronum, macronum), dtype=[(f, np.float64) for f in Rates._fields])
+        with np.errstate(divide='ignore'):
+            rates['mfpton'][offdiag] = mfpt[offdiag]
+            rates['mfptoff'][offdiag] = mfpt.T[offdiag]
+            rates['koff'][offdiag] = 1E9 / mfpt.T[offdiag]
+            rates['kon'][offdiag] = (1E9 / (mfpt * conc))[offdiag]
+            g0eq = -self._kBT * np.log(eq[np.newaxis, :] / (conc * eq[:, np.newaxis]))
+        rates['g0eq'][offdiag] = g0eq[offdiag]
+        rates['kdeq'][offdiag] = np.exp(g0eq / self._kBT)[offdiag]
+        return rates
+
     def plotRates(self, rates=('mfptoff', 'mfpton', 'g0eq')):
         """ Plot the MFPT on, off and DG of all the macrostates to the sink state
 
@@ -216,25 +269,13 @@ class Kinetics(object):
         >>> kin = Kinetics(model, temperature=300, concentration=0.015)
         >>> kin.plotRates()
         """
-        self._intergrityCheck()
-        macronum = self.model.macronum
-        mfptoff = np.zeros(macronum)
-        mfpton = np.zeros(macronum)
-        dg = np.zeros(macronum)
-        kon = np.zeros(macronum)
-        koff = np.zeros(macronum)
-        kdeq = np.zeros(macronum)
-
-        for m in range(macronum):
-            if m == self.source:
-                continue
-            r = self.getRates(source=self.source, sink=m, _logger=False)
-            mfptoff[m] = r.mfptoff
-            mfpton[m] = r.mfpton
-            dg[m] = r.g0eq
-            kon[m] = r.kon
-            koff[m] = r.koff
-            kdeq[m] = r.kdeq
+        allrates = self.getRateMatrix()[self.source]
+        mfptoff = allrates['mfptoff']
+        mfpton = allrates['mfpton']
+        dg = allrates['g0eq']
+        kon = allrates['kon']
+        koff = allrates['koff']
+        kdeq = allrates['kdeq']
 
         import matplotlib.pyplot as plt
         plt.ion()  # Interactive figure mode on
@@ -359,6 +400,8 @@ class Rates(object):
     g0eq : float
         The free energy between source and sink, calculated from the equilibrium probability
     """
+    _fields = ('mfpton', 'mfptoff', 'kon', 'koff', 'kdeq', 'g0eq')
+
     def __init__(self, mfpton=None, mfptoff=None, kon=None, koff=None, kdeq=None, g0eq=None):
         if mfpton is None:
             self.mfpton = 0
@@ -400,3 +443,25 @@ class Rates(object):
         s += 'kdeq = {:.2E} (M)\n'.format(self.kdeq)
         s += 'g0eq = {:.2f} (kcal/M)\n'.format(self.g0eq)
         return s
+
+
+def _mfptToSets(P, targets):
+    """ Mean first passage times (in lag steps) from every state to each of a list of target state sets
+
+    For each target set the linear system (I - P) t = 1 over the non-target states is factorized and solved once.
+    """
+    from scipy.sparse import issparse, identity
+    n = P.shape[0]
+    tau = np.zeros((n, len(targets)))
+    for j, target in enumerate(targets):
+        rest = np.setdiff1d(np.arange(n), target)
+        if len(rest) == 0:
+            continue
+        if issparse(P):
+            from scipy.sparse.linalg import splu
+            A = (identity(n, format='csr') - P)[rest][:, rest]
+            tau[rest, j] = splu(A.tocsc()).solve(np.ones(len(rest)))
+        else:
+            A = np.eye(len(rest)) - P[np.ix_(rest, rest)]
+            tau[rest, j] = np.linalg.solve(A, np.ones(len(rest)))
+    return tau
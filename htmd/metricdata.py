@@ -10,6 +10,9 @@ import pickle
 import logging
 logger = logging.getLogger(__name__)
 
+# Caches of derived indexes which are rebuilt on demand and are not saved
+_CACHES = ('_offsetcache', '_clusterindexcache')
+
 
 def _getsizes(x):
     if x is not None:
@@ -259,34 +262,32 @@ class MetricData(object):
             Clusters containing less than `mergesmall` conformations will be joined into their closest well-populated
             neighbour.
         batchsize : int
-            Batch sizes bigger than 0 will enable batching.
+            Batch sizes bigger than 0 will enable batching. The data is then streamed in chunks of at most `batchsize`
+            frames to the `partial_fit` and `predict` methods of `clusterobj` (e.g. MiniBatchKMeans, KCenter,
+            RegCluster) and the full concatenated data array is never built. Combined with a MetricData saved with
+            `save(..., mmap=True)` this allows clustering datasets which do not fit in memory.
 
         Examples
         --------
         >>> from sklearn.cluster import MiniBatchKMeans
         >>> data = MetricDistance.project(sims, 'protein and name CA', 'resname MOL')
         >>> data.cluster(MiniBatchKMeans(n_clusters=1000), mergesmall=5)
+        >>> data.cluster(MiniBatchKMeans(n_clusters=1000), batchsize=100000)
         """
         #cluster_obj = coor.cluster_kmeans(self.dat, k=20, stride=1)
         if batchsize > 0:
-            lengths = self.trajLengths
-            currsum = 0
-            starts = [0]
-            for i, l in enumerate(lengths):
-                currsum += l
-                if currsum > batchsize:
-                    starts.append(i+1)
-                    currsum = 0
-            starts.append(self.numTrajectories)
-            for i in range(len(starts) - 1):
-                clusterobj.partial_fit(np.concatenate(self.dat[starts[i]:starts[i+1]]))
-            labels = []
-            for i in range(self.numTrajectories):
-                labels.append(clusterobj.predict(self.dat[i].astype(np.float32)))
-            # This is retarded
-            labels = np.concatenate(labels)
+            if not hasattr(clusterobj, 'partial_fit'):
+                raise AttributeError('Batched clustering requires a clustering object with a partial_fit method')
+            import warnings
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                for _, chunk in self._iterChunks(batchsize):
+                    clusterobj.partial_fit(chunk)
+                labels = np.empty(self.numFrames, dtype=int)
+                for start, chunk in self._iterChunks(batchsize):
+                    labels[start:start+chunk.shape[0]] = clusterobj.predict(chunk)
         else:
-            datconcat = np.concatenate(self.dat)
+            datconcat = self._concat('projection')
             if np.ndim(datconcat) == 1:
                 datconcat = np.transpose(np.atleast_2d(datconcat))
             import warnings  # Following 3 lines are BS because sklearn refuse to make releases more often than 1 per year...
@@ -309,14 +310,64 @@ class MetricData(object):
 
         if mergesmall is not None:
             oldK = self.K
-            self.K, St, self.Centers, self.N, xxx = _mergeSmallClusters(mergesmall, datconcat, labels, self.Centers, self.N)
+            self.K, St, self.Centers, self.N, xxx = _mergeSmallClusters(mergesmall, self, labels, self.Centers, self.N)
             for i, s in enumerate(self.deconcatenate(St)):
                 self.trajectories[i].cluster = s
             logger.info('Mergesmall removed {} clusters. Original ncluster {}, new ncluster {}.'.format(oldK-self.K, oldK, self.K))
 
         self._dataid = random.random()
         self._clusterid = self._dataid
-    
+
+    def _iterChunks(self, chunksize):
+        """ Yields (absolute start frame, 2D projection chunk) pairs of at most `chunksize` frames
+
+        If the trajectories are views of a single buffer (e.g. a memory-mapped MetricData) the chunks are slices of it,
+        otherwise trajectories are split or joined to fill the chunks. The data is never concatenated as a whole.
+        """
+        chunksize = int(chunksize)
+        arrays = [t.projection for t in self.trajectories]
+        base = _contiguousBase(arrays) if len(arrays) else None
+        if base is not None:
+            for start in range(0, base.shape[0], chunksize):
+                yield start, _as2d(base[start:start+chunksize])
+            return
+
+        start = 0
+        pending = []
+        pendingsize = 0
+        for arr in arrays:
+            arr = _as2d(arr)
+            pos = 0
+            while pos < arr.shape[0]:
+                piece = arr[pos:pos + chunksize - pendingsize]
+                pending.append(piece)
+                pendingsize += piece.shape[0]
+                pos += piece.shape[0]
+                if pendingsize == chunksize:
+                    chunk = pending[0] if len(pending) == 1 else np.concatenate(pending)
+                    yield start, chunk
+                    start += pendingsize
+                    pending = []
+                    pendingsize = 0
+        if pendingsize:
+            yield start, pending[0] if len(pending) == 1 else np.concatenate(pending)
+
+    def _getFrames(self, absFrames):
+        """ Returns the projected data of the given absolute frames without concatenating the whole dataset """
+        absFrames = np.atleast_1d(np.asarray(absFrames, dtype=int))
+        arrays = [t.projection for t in self.trajectories]
+        base = _contiguousBase(arrays)
+        if base is not None:
+            return _as2d(base[absFrames])
+
+        rel = self.abs2rel(absFrames)
+        first = _as2d(arrays[0])
+        frames = np.empty((len(absFrames), first.shape[1]), dtype=first.dtype)
+        for tr in np.unique(rel[:, 0]):
+            idx = np.where(rel[:, 0] == tr)[0]
+            frames[idx] = _as2d(arrays[tr])[rel[idx, 1]]
+        return frames
+
     def combine(self, otherdata):
         """ Combines two different metrics into one by concatenating them.
 
@@ -497,20 +548,26 @@ class MetricData(object):
         if frames is None or isinstance(frames, int):
             frames = np.repeat(frames, len(clusters))
 
-        stConcat = np.concatenate(self.St)
-        absFrames = []
+        keep = [i for i in range(len(clusters)) if not (frames[i] == 0 and not allframes)]
+        clusters = [clusters[i] for i in keep]
+        order, offsets = self._clusterIndex()
+        absFrames = _sampleIndex(order, offsets, clusters, [frames[i] for i in keep], replacement)
         relFrames = []
-        for i in range(len(clusters)):
-            if frames[i] == 0 and not allframes:
-                continue
-            st = clusters[i]
-            absFrames.append(_sampleCluster(st, stConcat, frames[i], replacement))
-            if len(absFrames[-1]) == 0:
+        for st, fr in zip(clusters, absFrames):
+            if len(fr) == 0:
                 raise NameError('No frames could be sampled from cluster {}. Cluster is empty.'.format(st))
-
-            relFrames.append(self.abs2rel(absFrames[-1]))
+            relFrames.append(self.abs2rel(fr))
         return absFrames, relFrames
 
+    def _clusterIndex(self):
+        """ Frames grouped by cluster (see `_frameIndex`). Cached until the data or the clustering change. """
+        key = (self._dataid, self._clusterid, self.K, self.numFrames)
+        cache = getattr(self, '_clusterindexcache', None)
+        if cache is None or cache[0] != key:
+            cache = (key, _frameIndex(self._concat('cluster'), self.K))
+            self._clusterindexcache = cache
+        return cache[1]
+
     def bootstrap(self, ratio, replacement=False):
         """ Randomly sample a set of trajectories
 
@@ -531,13 +588,7 @@ class MetricData(object):
         >>> data = MetricSelfDistance.project(sims, 'protein and name CA')
         >>> databoot = data.bootstrap(0.8)
         """
-        numtraj = self.numTrajectories
-        numtokeep = int(np.floor(numtraj * ratio))
-        if replacement:
-            rndtraj = np.random.randint(numtraj, size=numtokeep)
-        else:
-            rndtraj = np.random.permutation(numtraj)[0:numtokeep]
-        rndtraj = sorted(rndtraj)  # Important to keep the sorting! i.e. for data.dropTraj(keepsims=sims)
+        rndtraj = _bootstrapTrajectories(self.numTrajectories, ratio, replacement)
 
         pp = None
         if self.parent is not None:
@@ -569,11 +620,40 @@ class MetricData(object):
         raise NameError('Not implemented yet')
 
     def deconcatenate(self, array):
-        indeces = np.cumsum(self.trajLengths)
-        if np.ndim(array) == 1:
-            return np.array(np.split(array, indeces[:-1]))
-        else:
-            return np.array(np.vsplit(array, indeces[:-1]))
+        offsets = self._offsets()
+        ret = np.empty(self.numTrajectories, dtype=object)
+        for i in range(self.numTrajectories):
+            ret[i] = array[offsets[i]:offsets[i+1]]
+        return ret
+
+    def _offsets(self):
+        """ Cumulative trajectory lengths starting from 0. Cached until the data changes (see `_dataid`) """
+        cache = getattr(self, '_offsetcache', None)
+        if cache is None or cache[0] != self._dataid or len(cache[1]) != self.numTrajectories + 1:
+            cache = (self._dataid, np.append(0, np.cumsum(self.trajLengths)).astype(np.int64))
+            self._offsetcache = cache
+        return cache[1]
+
+    def _concat(self, field):
+        """ Concatenates the given field ('projection', 'reference' or 'cluster') of all trajectories
+
+        If the trajectories are consecutive views of a single contiguous array, that array is returned without copying.
+        Otherwise the concatenated array is built once and the field of every trajectory is replaced by a view of it so
+        that subsequent calls do not copy the data again. The returned array therefore always shares its memory with
+        the trajectories: modifying one in place modifies the other. Callers which modify it must copy it first.
+        """
+        arrays = [getattr(t, field) for t in self.trajectories]
+        if len(arrays) == 0 or any([a is None for a in arrays]):
+            return None
+        buffer = _contiguousBase(arrays)
+        if buffer is not None:
+            return buffer
+
+        buffer = np.concatenate(arrays)
+        offsets = self._offsets()
+        for i, t in enumerate(self.trajectories):
+            setattr(t, '_' + field, buffer[offsets[i]:offsets[i+1]])
+        return buffer
 
     def abs2rel(self, absFrames):
         """ Convert absolute frame indexes into trajectory index-frame pairs
@@ -595,18 +675,18 @@ class MetricData(object):
         --------
         >>> relidx = data.abs2rel(536)
         """
-        if not hasattr(absFrames, "__len__"):
-            absFrames = [absFrames]
-        endFrames = np.append(0, np.cumsum(self.trajLengths))
-
-        relframe = np.zeros((len(absFrames), 2), dtype=int)
-        for i in range(len(absFrames)):
-            trajIdx = np.where(absFrames[i] < endFrames)[0][0] - 1
-            trajFr = absFrames[i] - endFrames[trajIdx]
-            relframe[i, :] = [trajIdx, trajFr]
+        absFrames = np.atleast_1d(np.asarray(absFrames, dtype=int))
+        offsets = self._offsets()
+        if np.any(absFrames < 0) or np.any(absFrames >= offsets[-1]):
+            raise RuntimeError('Absolute frame indexes must be >= 0 and < {}'.format(offsets[-1]))
+
+        trajIdx = np.searchsorted(offsets, absFrames, side='right') - 1
+        relframe = np.empty((len(absFrames), 2), dtype=int)
+        relframe[:, 0] = trajIdx
+        relframe[:, 1] = absFrames - offsets[trajIdx]
         return relframe
 
-    def rel2sim(self, relFrames, simlist=None):
+    def rel2sim(self, relFrames, simlist=None, structured=False):
         """ Converts trajectory index-frame pairs into Sim-frame pairs
 
         Parameters
@@ -615,6 +695,9 @@ class MetricData(object):
             An array containing in each row trajectory index and frame pairs
         simlist : numpy.ndarray of :class:`Sim <htmd.simlist.Sim>` objects
             Optionally pass a different (but matching, i.e. filtered) simlist for creating the Frames.
+        structured : bool
+            If True it returns a numpy record array with fields `simidx`, `sim`, `piece` and `frame` instead of an array
+            of :class:`Frame <htmd.simlist.Frame>` objects. This is much faster for large numbers of frames.
 
         Returns
         -------
@@ -625,6 +708,8 @@ class MetricData(object):
         Examples
         --------
         >>> simframes = data.rel2sim([100, 56])  # 100th simulation frame 56
+        >>> simframes = data.rel2sim([[100, 56], [20, 3]], structured=True)
+        >>> simframes.sim[0], simframes.piece[0], simframes.frame[0]
         """
         from htmd.simlist import Frame
         if simlist is None:
@@ -633,23 +718,29 @@ class MetricData(object):
             if len(simlist) != len(self.simlist):
                 raise AttributeError('Provided simlist has different number of trajectories than the one used by this object.')
 
-        relFrames = np.array(relFrames)
-        if relFrames.ndim == 1:
-            relFrames = relFrames[np.newaxis, :]
+        relFrames = np.array(relFrames, dtype=int).reshape(-1, 2)
+        trajIdx = relFrames[:, 0]
+        refs = self._concat('reference')[self._offsets()[trajIdx] + relFrames[:, 1]]
 
-        frames = []
-        for trajID, trajFrame in relFrames:
-            ref = self.trajectories[trajID].reference
-            frames.append(Frame(simlist[trajID], ref[trajFrame, 0], ref[trajFrame, 1]))
-        return np.array(frames)
+        frames = np.recarray(len(relFrames), dtype=[('simidx', int), ('sim', object), ('piece', int), ('frame', int)])
+        frames.simidx = trajIdx
+        frames.sim = np.asarray(simlist, dtype=object)[trajIdx]
+        frames.piece = refs[:, 0]
+        frames.frame = refs[:, 1]
+        if structured:
+            return frames
+        return np.array([Frame(sim, piece, frame) for sim, piece, frame in zip(frames.sim, frames.piece, frames.frame)])
 
-    def abs2sim(self, absFrames):
+    def abs2sim(self, absFrames, structured=False):
         """ Converts absolute frame indexes into Sim-frame pairs
 
         Parameters
         ----------
         absFrames : list of int
             A list of absolute index frames
+        structured : bool
+            If True it returns a numpy record array with fields `simidx`, `sim`, `piece` and `frame` instead of an array
+            of :class:`Frame <htmd.simlist.Frame>` objects.
 
         Returns
         -------
@@ -661,7 +752,7 @@ class MetricData(object):
         --------
         >>> simframes = data.abs2sim(563)  # 563rd frame to simulation/frame pairs
         """
-        return self.rel2sim(self.abs2rel(absFrames))
+        return self.rel2sim(self.abs2rel(absFrames), structured=structured)
 
     def copy(self):
         """ Produces a deep copy of the object
@@ -678,26 +769,35 @@ class MetricData(object):
         """
         return deepcopy(self)
 
-    def save(self, filename):
+    def save(self, filename, mmap=False):
         """ Save a :class:`MetricData` object to disk
 
         Parameters
         ----------
         filename : str
             Path of the file in which to save the object
+        mmap : bool
+            If True it will save the object into a directory at `filename`. The projected data, references and cluster
+            assignments of all trajectories are stored there as contiguous arrays which are memory-mapped on loading, so
+            that loading is instant and only the parts of the data which are accessed are read from disk.
 
         Examples
         --------
         >>> data = MetricSelfDistance.project(sims, 'protein and name CA')
         >>> data.save('./data.dat')
+        >>> data.save('./datadir', mmap=True)
         """
+        if mmap:
+            self._saveDirectory(filename)
+            return
+
         #np.save(filename, [self.__dict__[k] for k in self.__dict__])
         parentpointer = self.parent
         if self.parent is not None:
-            self.parent = self.parent.__dict__
+            self.parent = _withoutCaches(self.parent.__dict__)
 
         f = open(filename, 'wb')
-        pickle.dump(self.__dict__, f)
+        pickle.dump(_withoutCaches(self.__dict__), f)
         f.close()
 
         if self.parent is not None:
@@ -715,8 +815,14 @@ class MetricData(object):
         --------
         >>> data = MetricData()
         >>> data.load('./data.dat')
+        >>> data.load('./datadir')  # Memory-mapped directory created with save(..., mmap=True)
         """
         import sys
+        import os
+        if isinstance(filename, str) and os.path.isdir(filename):
+            self._loadDirectory(filename)
+            return
+
         try:
             import pandas.indexes
         except ImportError:
@@ -749,6 +855,69 @@ class MetricData(object):
             self.parent = MetricData()
             self.parent.load(vardict['parent'])
 
+    def _saveDirectory(self, dirname):
+        import os
+        import shutil
+        os.makedirs(dirname, exist_ok=True)
+        offsets = np.append(0, np.cumsum(self.trajLengths)).astype(np.int64)
+        np.save(os.path.join(dirname, 'offsets.npy'), offsets)
+
+        for field in ('projection', 'reference', 'cluster'):
+            fname = os.path.join(dirname, field + '.npy')
+            if os.path.exists(fname):
+                os.remove(fname)
+            arrays = [getattr(t, field) for t in self.trajectories]
+            if len(arrays) == 0 or any([a is None for a in arrays]):
+                continue
+            # Writing through a memory-map avoids building the concatenated array in memory
+            out = np.lib.format.open_memmap(fname, mode='w+', dtype=np.result_type(*arrays),
+                                            shape=(int(offsets[-1]),) + arrays[0].shape[1:])
+            for a, start, end in zip(arrays, offsets[:-1], offsets[1:]):
+                out[start:end] = a
+            out.flush()
+            del out
+
+        metadata = {k: v for k, v in _withoutCaches(self.__dict__).items() if k not in ('trajectories', 'parent')}
+        metadata['simlist'] = [t.sim for t in self.trajectories]
+        with open(os.path.join(dirname, 'metadata.dat'), 'wb') as f:
+            pickle.dump(metadata, f)
+
+        parentdir = os.path.join(dirname, 'parent')
+        if os.path.exists(parentdir):
+            shutil.rmtree(parentdir)
+        if self.parent is not None:
+            self.parent._saveDirectory(parentdir)
+
+    def _loadDirectory(self, dirname):
+        import os
+        with open(os.path.join(dirname, 'metadata.dat'), 'rb') as f:
+            metadata = pickle.load(f)
+        sims = metadata.pop('simlist')
+        offsets = np.load(os.path.join(dirname, 'offsets.npy'))
+
+        # Copy-on-write mapping so that modifications of the data in memory never touch the files on disk
+        arrays = {}
+        for field in ('projection', 'reference', 'cluster'):
+            fname = os.path.join(dirname, field + '.npy')
+            arrays[field] = np.load(fname, mmap_mode='c') if os.path.exists(fname) else None
+
+        def getview(field, start, end):
+            if arrays[field] is None:
+                return None
+            return arrays[field][start:end]
+
+        self.trajectories = [Trajectory(projection=getview('projection', start, end),
+                                        reference=getview('reference', start, end),
+                                        sim=sim,
+                                        cluster=getview('cluster', start, end))
+                             for sim, start, end in zip(sims, offsets[:-1], offsets[1:])]
+        self.__dict__.update(metadata)
+
+        self.parent = None
+        if os.path.isdir(os.path.join(dirname, 'parent')):
+            self.parent = MetricData()
+            self.parent._loadDirectory(os.path.join(dirname, 'parent'))
+
     def _defaultLags(self, minlag=None, maxlag=None, numlags=None, units='frames'):
         from htmd.units import convert as unitconvert
         if maxlag is None:
@@ -1041,7 +1210,7 @@ class MetricData(object):
         >>> abs, rel, mols = data.sampleRegion(limits=np.array([minlims, maxlims]))
         """
         from scipy.spatial.distance import cdist
-        datconcat = np.concatenate(self.dat)
+        datconcat = self._concat('projection')
         numdim = datconcat.shape[1]
         if point is not None:
             if radius is None:
@@ -1081,26 +1250,79 @@ class MetricData(object):
         return confs, self.abs2rel(confs), mol
 
 
-def _sampleCluster(cluster, stConcat, numFrames, replacement):
-    frames = np.where(stConcat == cluster)[0]
-    return _randomSample(frames, numFrames, replacement)
+def _withoutCaches(attributes):
+    return {k: v for k, v in attributes.items() if k not in _CACHES}
+
+
+def _contiguousBase(arrays):
+    """ Returns the array of which `arrays` are consecutive views covering it completely, otherwise None """
+    base = arrays[0].base
+    if not isinstance(base, np.ndarray) or base.ndim == 0 or not base.flags['C_CONTIGUOUS']:
+        return None
+    start = base.__array_interface__['data'][0]
+    pos = 0
+    for a in arrays:
+        if a.base is not base or a.dtype != base.dtype or a.shape[1:] != base.shape[1:] or not a.flags['C_CONTIGUOUS']:
+            return None
+        if a.shape[0] != 0 and a.__array_interface__['data'][0] != start + pos * base.strides[0]:
+            return None
+        pos += a.shape[0]
+    if pos != base.shape[0]:
+        return None
+    return base
+
+
+def _bootstrapTrajectories(numtraj, ratio, replacement=False, rng=np.random):
+    """ Sorted indexes of a random sample of `ratio` of `numtraj` trajectories, drawn with `rng` """
+    numtokeep = int(np.floor(numtraj * ratio))
+    if replacement:
+        rndtraj = rng.randint(numtraj, size=numtokeep)
+    else:
+        rndtraj = rng.permutation(numtraj)[0:numtokeep]
+    return sorted(rndtraj)  # Important to keep the sorting! i.e. for data.dropTraj(keepsims=sims)
+
+
+def _frameIndex(labels, numstates):
+    """ Groups the absolute frames by their state label in CSR fashion
+
+    The frames of state i are `order[offsets[i]:offsets[i+1]]` in increasing order. Frames with negative labels (e.g.
+    clusters not belonging to any microstate) are not included in any state.
+    """
+    labels = np.asarray(labels)
+    order = np.argsort(labels, kind='stable')
+    offsets = np.searchsorted(labels[order], np.arange(numstates + 1), side='left')
+    return order, offsets
+
 
+def _sampleIndex(order, offsets, states, numFrames, replacement):
+    """ Samples frames of several states of a `_frameIndex` at once
 
-def _randomSample(frames, numFr, replacement):
-    if numFr == 0:
+    All frames of a state are returned if its number of frames is None or, when sampling without replacement, larger
+    than the state. Otherwise frames are drawn uniformly. Returns a list with an array of frames per state.
+    """
+    states = np.asarray(states, dtype=int)
+    if len(states) == 0:
         return []
-    if numFr is None or (numFr >= len(frames) and not replacement):
-        rnd = list(range(len(frames)))
-    else:
-        rnd = np.random.randint(len(frames), size=numFr)
-    return frames[rnd]
+    starts = offsets[states]
+    sizes = offsets[states + 1] - starts
+    takeall = np.array([n is None for n in numFrames], dtype=bool)
+    counts = np.array([0 if n is None else n for n in numFrames], dtype=int)
+    if not replacement:
+        takeall |= (counts != 0) & (counts >= sizes)
+    counts[takeall] = sizes[takeall]
+    counts[sizes == 0] = 0  # Nothing can be sampled from empty states
+
+    # For every drawn sample, its state and its position within the samples of that state
+    ends = np.cumsum(counts)
+    stateofsample = np.repeat(np.arange(len(states)), counts)
+    within = np.arange(ends[-1]) - (ends - counts)[stateofsample]
+    rnd = ~takeall[stateofsample]
+    within[rnd] = np.random.randint(sizes[stateofsample[rnd]])
+    frames = order[starts[stateofsample] + within]
+    return np.split(frames, ends[:-1])
 
 
 def _mergeSmallClusters(mergesmall, data, stconcat, centers, N, metric=None):
-    if data.dtype == 'bool':
-        metric = 'hamming'
-    else:
-        metric = 'euclidean'
     badclusters = N < mergesmall
     goodclusters = np.invert(badclusters)
     N[badclusters] = 0
@@ -1118,13 +1340,21 @@ def _mergeSmallClusters(mergesmall, data, stconcat, centers, N, metric=None):
     newidx[goodcluidx] = range(len(goodcluidx))
 
     # Find all frames which belong to bad clusters
-    frames = _ismember(stconcat, badcluidx)
-    badframeidx = np.where(frames >= 0)[0]
+    badframeidx = np.where(np.isin(stconcat, badcluidx))[0]
+
+    # Gather only the frames belonging to bad clusters instead of the whole dataset
+    if isinstance(data, MetricData):
+        badframes = data._getFrames(badframeidx)
+    else:
+        badframes = _as2d(data)[badframeidx, :]
+    if badframes.dtype == 'bool':
+        metric = 'hamming'
+    else:
+        metric = 'euclidean'
 
-    # Calculate distance of all frames belonging to bad clusters to the good cluster centers
-    from scipy.spatial import distance
-    dists = distance.cdist(np.atleast_2d(data[badframeidx, :]), np.atleast_2d(centers), metric)
-    minidx = np.argmin(dists, axis=1)  # Find closest center. Indexes are relative to goodidx
+    # Find the closest good cluster center of all frames belonging to bad clusters
+    from htmd.clustering.nearestcenter import NearestCenter
+    minidx = NearestCenter(np.atleast_2d(centers), metric=metric).predict(badframes)  # Indexes are relative to goodidx
     newclu = goodcluidx[minidx]  # Back to absolute cluster indexes
 
     # Reassign bad frames to good clusters
@@ -1136,6 +1366,13 @@ def _mergeSmallClusters(mergesmall, data, stconcat, centers, N, metric=None):
     return K, stconcat, centers, N, badclusters
 
 
+def _as2d(arr):
+    """ Turns 1D projections into single-column 2D arrays """
+    if np.ndim(arr) == 1:
+        return arr[:, np.newaxis]
+    return arr
+
+
 def _ismember(a, b):
     bind = {}
     for i, elt in enumerate(list(set(b))):
@@ -1193,6 +1430,44 @@ class _TestMetricData(unittest.TestCase):
         assert np.array_equal(data2.trajectories[0].projection.shape, (6, 9)), 'dropDimensions not working correct'
         assert len(np.where(data2.description.type == 'dihedral')[0]) == 9, 'dropDimensions not working correct'
 
+    def test_concatenation(self):
+        data1 = self.data1.copy()
+        datconcat = np.concatenate(data1.dat)
+        buffer = data1._concat('projection')
+        assert np.array_equal(buffer, datconcat)
+        assert data1._concat('projection') is buffer, 'Repeated concatenation should not copy the data'
+        assert np.array_equal(np.concatenate(data1.dat), datconcat)
+        assert data1.deconcatenate(buffer)[1].base is buffer
+
+        data1.dropTraj(idx=[0])
+        assert np.array_equal(data1._concat('projection'), datconcat[self.data1.trajLengths[0]:])
+
+    def test_batch_clustering(self):
+        from htmd.clustering.kcenters import KCenter
+        data2 = self.data2.copy()
+        datconcat = np.concatenate(data2.dat)
+        chunks = list(data2._iterChunks(50))
+        assert max([c.shape[0] for _, c in chunks]) <= 50
+        assert np.array_equal(np.concatenate([c for _, c in chunks]), datconcat)
+        assert np.array_equal(data2._getFrames([0, 3, data2.numFrames - 1]), datconcat[[0, 3, data2.numFrames - 1]])
+
+        data2.cluster(KCenter(n_clusters=4), batchsize=50, mergesmall=2)
+        assert data2.N.sum() == data2.numFrames
+        assert np.all(data2.N >= 2)
+
+    def test_frame_mapping(self):
+        data1 = self.data1
+        absframes = np.arange(data1.numFrames)
+        rel = data1.abs2rel(absframes)
+        expected = np.vstack([np.column_stack((np.full(l, i), np.arange(l))) for i, l in enumerate(data1.trajLengths)])
+        assert np.array_equal(rel, expected)
+
+        frames = data1.rel2sim(rel)
+        structframes = data1.abs2sim(absframes, structured=True)
+        for f, sf in zip(frames, structframes):
+            assert f.sim == sf.sim and f.piece == sf.piece and f.frame == sf.frame
+        assert np.array_equal(structframes.frame, np.concatenate(data1.ref)[:, 1])
+
     def test_saving_loading(self):
         from moleculekit.util import tempname
 
@@ -1218,6 +1493,28 @@ class _TestMetricData(unittest.TestCase):
         newdata = MetricData(file=savefile)
         checkCorrectness(newdata)
 
+        # Saving into a memory-mapped directory
+        savedir = tempname()
+        data1.save(savedir, mmap=True)
+        newdata = MetricData(file=savedir)
+        checkCorrectness(newdata)
+        assert isinstance(newdata.trajectories[0].projection, np.memmap)
+        for t1, t2 in zip(data1.trajectories, newdata.trajectories):
+            assert np.array_equal(t1.projection, t2.projection)
+            assert np.array_equal(t1.reference, t2.reference)
+            assert t1.sim == t2.sim
+        assert newdata.parent.numTrajectories == data1.parent.numTrajectories
+        assert newdata.parent.trajectories[0].projection.shape == (6, 888)
+
+        # Cached indexes are not saved
+        import os
+        data1._offsets()
+        data1.save(savefile)
+        data1.save(savedir, mmap=True)
+        for path in (savefile, os.path.join(savedir, 'metadata.dat')):
+            with open(path, 'rb') as f:
+                assert '_offsetcache' not in pickle.load(f)
+
 
 
 if __name__ == '__main__':
@@ -52,6 +52,7 @@ class Model(object):
             self.data = data
         self.hmm = None
         self._modelid = None
+        self._metastable = None
         if self.data._clusterid is None:
             raise NameError('You need to cluster your data before making a Markov model')
         if self.data._dataid != self.data._clusterid:
@@ -70,7 +71,9 @@ class Model(object):
         units : str
             The units of lag. Can be 'frames' or any time unit given as a string.
         sparse : bool
-            Make the transition matrix sparse. Useful if lots (> 4000) states are used for the MSM. Warning: untested.
+            Use sparse count and transition matrices. Useful if lots (> 4000) states are used for the MSM. The
+            macrostates are then calculated from the leading eigenvectors only, obtained with Lanczos iterations, so
+            that no dense microstate matrix is ever built. `coarsemsm` is not available for sparse models.
 
         Examples
         --------
@@ -86,8 +89,14 @@ class Model(object):
         self.msm = msm.estimate_markov_model(self.data.St.tolist(), self.lag, sparse=sparse)
         modelflag = False
         while not modelflag:
-            self.coarsemsm = self.msm.pcca(macronum)
-            if len(np.unique(self.msm.metastable_assignments)) != macronum:
+            pi = self.msm.stationary_distribution
+            if sparse:
+                self.coarsemsm = None
+                self._metastable = _Metastable(_sparsePCCA(self.P, pi, macronum), pi)
+            else:
+                self.coarsemsm = self.msm.pcca(macronum)
+                self._metastable = _Metastable(self.msm.metastable_memberships, pi)
+            if len(np.unique(self._metastable.assignments)) != macronum:
                 macronum -= 1
                 logger.warning('PCCA returned empty macrostates. Reducing the number of macrostates to {}.'.format(macronum))
             else:
@@ -120,39 +129,42 @@ class Model(object):
         """
         if microstates is not None and indexpairs is not None:
             raise AttributeError('microstates and indexpairs arguments are mutually exclusive')
+        self._frameindexcache = None
+        self.data._clusterindexcache = None
         if microstates is not None:
             newmacro = self.macronum
 
+            metastable = self._metastable
             # Fixing sets. Remove microstates from previous macrostates and add new set
-            for i, metset in enumerate(self.msm.metastable_sets):
-                self.msm.metastable_sets[i] = np.array(np.sort(list(set(metset) - set(microstates))))
-            self.msm.metastable_sets.append(np.array(microstates, dtype=np.int64))
+            for i, metset in enumerate(metastable.sets):
+                metastable.sets[i] = np.array(np.sort(list(set(metset) - set(microstates))))
+            metastable.sets.append(np.array(microstates, dtype=np.int64))
 
-            todelete = np.where([len(x) == 0 for x in self.msm.metastable_sets])[0]
+            todelete = np.where([len(x) == 0 for x in metastable.sets])[0]
 
             # Fixing hard assignments
-            self.msm.metastable_assignments[microstates] = newmacro
+            metastable.assignments[microstates] = newmacro
 
             # Fixing memberships. Padding the array with 0s for the new macrostate
-            self.msm._metastable_memberships = np.pad(self.msm.metastable_memberships, ((0, 0), (0, 1)), mode='constant', constant_values=(0))
-            self.msm._metastable_memberships[microstates, :] = 0
-            self.msm._metastable_memberships[microstates, -1] = 1
+            metastable.memberships = np.pad(metastable.memberships, ((0, 0), (0, 1)), mode='constant', constant_values=(0))
+            metastable.memberships[microstates, :] = 0
+            metastable.memberships[microstates, -1] = 1
 
             # Moving probabilities of empty states to new one
             othermicro = np.ones(self.micronum, dtype=bool)
             othermicro[microstates] = False
             othermicro = np.where(othermicro)[0]
-            self.msm._metastable_memberships[othermicro, -1] = np.sum(self.msm._metastable_memberships[othermicro[:, None], todelete], axis=1)
+            metastable.memberships[othermicro, -1] = np.sum(metastable.memberships[othermicro[:, None], todelete], axis=1)
 
             # Fixing distributions
-            self.msm._metastable_distributions = np.pad(self.msm.metastable_distributions, ((0, 1), (0, 0)), mode='constant', constant_values=(0))
-            self.msm._metastable_distributions[-1, microstates] = 1 / len(microstates)
+            metastable.distributions = np.pad(metastable.distributions, ((0, 1), (0, 0)), mode='constant', constant_values=(0))
+            metastable.distributions[-1, microstates] = 1 / len(microstates)
         if indexpairs is not None:
             newcluster = self.data.K
             for ip in indexpairs:
                 self.data.trajectories[ip[0]].cluster[ip[1]] = newcluster
             self.data.K += 1
-            self.data.N = np.bincount(np.concatenate(self.data.St))
+            self.data.N = np.bincount(self.data._concat('cluster'))
 
     @property
     def P(self):
@@ -190,7 +202,7 @@ class Model(object):
     def macronum(self):
         """ Number of macrostates """
         self._integrityCheck(postmsm=True)
-        return len(set(self.msm.metastable_assignments))
+        return len(set(self._metastable.assignments))
 
     @property
     def macro_ofmicro(self):
@@ -200,9 +212,10 @@ class Model(object):
         """
         self._integrityCheck(postmsm=True)
         # Fixing pyemma macrostate numbering
-        mask = np.ones(np.max(self.msm.metastable_assignments) + 1, dtype=int) * -1
-        mask[list(set(self.msm.metastable_assignments))] = range(self.macronum)
-        return mask[self.msm.metastable_assignments]
+        assignments = self._metastable.assignments
+        mask = np.ones(np.max(assignments) + 1, dtype=int) * -1
+        mask[list(set(assignments))] = range(self.macronum)
+        return mask[assignments]
 
     @property
     def macro_ofcluster(self):
@@ -233,7 +246,9 @@ class Model(object):
         units : str
             The units of lag. Can be 'frames' or any time unit given as a string.
         errors : errors
-            Calculate errors using Bayes (Refer to pyEMMA documentation)
+            Calculate errors using Bayes (Refer to pyEMMA documentation). Without errors the timescales are calculated
+            natively and cached on the Model, so later calls with the same lags (e.g. from `maxConnectedLag`) are
+            instant as long as the clustering does not change.
         nits : int
             Number of implied timescales to calculate. Default: all
         results : bool
@@ -261,8 +276,6 @@ class Model(object):
         >>> model.plotTimescales(lags=list(range(1,100,5)))
         >>> model.plotTimescales(minlag=0.1, maxlag=20, numlags=25, units='ns')
         """
-        import pyemma.plots as mplt
-        import pyemma.msm as msm
         self._integrityCheck()
         if lags is None:
             lags = self.data._defaultLags(minlag, maxlag, numlags, units)
@@ -272,14 +285,24 @@ class Model(object):
         if nits is None:
             nits = np.min((self.data.K, 20))
 
-        from htmd.config import _config
-        its = msm.its(self.data.St.tolist(), lags=lags, errors=errors, nits=nits, n_jobs=njobs) # Use all CPUs minus one
+        its = None
+        if errors is not None:
+            import pyemma.msm as msm
+            its = msm.its(self.data.St.tolist(), lags=lags, errors=errors, nits=nits, n_jobs=njobs) # Use all CPUs minus one
+            timescales, lags = its.get_timescales(), its.lags
+        else:
+            lags = np.array(lags, dtype=int)
+            timescales = self._impliedTimescales(lags, nits, njobs=njobs)
         if plot or (save is not None):
             from matplotlib import pylab as plt
             plt.ion()
             plt.figure()
             try:
-                mplt.plot_implied_timescales(its, dt=self.data.fstep, units='ns')
+                if its is not None:
+                    import pyemma.plots as mplt
+                    mplt.plot_implied_timescales(its, dt=self.data.fstep, units='ns')
+                else:
+                    _plotTimescales(lags, timescales, self.data.fstep, units='ns')
             except ValueError as ve:
                 plt.close()
                 raise ValueError('{} This is probably caused by badly set fstep in the data ({}). '.format(ve, self.data.fstep) +
@@ -289,7 +312,44 @@ class Model(object):
             if plot:
                 plt.show()
         if results:
-            return its.get_timescales(), its.lags
+            return timescales, lags
+
+    def _impliedTimescales(self, lags, nits, njobs=None):
+        """ Implied timescales of reversible Markov models at several lag times
+
+        Transitions are counted for all lag times with vectorized operations over the concatenated discrete
+        trajectories, and the transition matrices and their leading eigenvalues are estimated in parallel over the lag
+        times. The timescales are cached for each lag time until the data or its clustering change. If neither deeptime
+        nor msmtools are installed, pyemma's implied timescales estimator is used instead.
+
+        Returns
+        -------
+        its : np.ndarray
+            A (len(lags), nits) array of timescales in frames. Models with fewer than nits+1 states are padded with NaN.
+        """
+        from htmd.parallelprogress import ParallelExecutor, delayed
+        from htmd.config import _config
+        key = (getattr(self.data, '_dataid', None), getattr(self.data, '_clusterid', None), self.data.K)
+        cache = getattr(self, '_itscache', None)
+        if cache is None or cache[0] != key:
+            cache = (key, {})
+            self._itscache = cache
+
+        njobs = njobs if njobs is not None else _config['njobs']
+        lags = [int(lag) for lag in lags]
+        missing = [lag for lag in dict.fromkeys(lags) if lag not in cache[1] or len(cache[1][lag]) < nits]
+        if len(missing) and _markovTools() is None:
+            import pyemma.msm as msm
+            res = msm.its(self.data.St.tolist(), lags=missing, nits=nits, n_jobs=njobs).get_timescales()
+            for lag, its in zip(missing, res):
+                cache[1][lag] = np.concatenate((its, np.full(nits - len(its), np.nan)))
+        elif len(missing):
+            counts = _countMatrices(self.data.St, missing, self.data.K)
+            aprun = ParallelExecutor(n_jobs=njobs)
+            res = aprun(total=len(missing), desc='Estimating timescales')(delayed(_lagTimescales)(C, lag, nits) for C, lag in zip(counts, missing))
+            for lag, its in zip(missing, res):
+                cache[1][lag] = its
+        return np.vstack([cache[1][lag][:nits] for lag in lags])
 
     def maxConnectedLag(self, lags):
         """ Heuristic for getting the lagtime before a timescale drops.
@@ -318,8 +378,7 @@ class Model(object):
         if isinstance(lags, np.ndarray):
             lags = lags.astype(int)
 
-        import pyemma.msm as msm
-        itime = msm.its(self.data.St.tolist(), lags=lags, nits=2).get_timescales()
+        itime = self._impliedTimescales(lags, 2)
 
         for i in range(1, np.size(itime, 0)):
             if abs(itime[i, 0] - itime[i-1, 1]) < abs(itime[i, 0] - itime[i-1, 0]):
@@ -391,29 +450,44 @@ class Model(object):
         if frames is None or isinstance(frames, int):
             frames = np.repeat(frames, len(states))
 
-        stConcat = np.concatenate(self.data.St)
-        absFrames = []
+        from htmd.metricdata import _sampleIndex
+        if statetype == 'macro':
+            absFrames = _sampleMacro(self, states, samplemode, frames, replacement)
+        elif statetype == 'micro':
+            order, offsets = self._frameIndex('micro')
+            absFrames = _sampleIndex(order, offsets, states, frames, replacement)
+        else:
+            raise NameError('No valid state type given (read documentation)')
+
         relFrames = []
         for i in range(len(states)):
             if frames[i] == 0:
-                absFrames.append(np.array([], dtype=int))
+                absFrames[i] = np.array([], dtype=int)
                 relFrames.append(np.array([], dtype=int))
                 continue
+            if len(absFrames[i]) == 0:
+                raise NameError('No frames could be sampled from {} state {}. State is empty.'.format(statetype, states[i]))
+            relFrames.append(self.data.abs2rel(absFrames[i]))
+        return absFrames, relFrames
+
+    def _frameIndex(self, statetype):
+        """ Frames grouped by micro or macrostate (see `htmd.metricdata._frameIndex`)
 
-            st = states[i]
+        Built once and reused by all sampling calls until the model or the data change.
+        """
+        key = (self._modelid, self.data._dataid, self.data._clusterid, self.data.K, self.macronum)
+        cache = getattr(self, '_frameindexcache', None)
+        if cache is None or cache[0] != key:
+            cache = (key, {})
+            self._frameindexcache = cache
+        if statetype not in cache[1]:
+            from htmd.metricdata import _frameIndex
+            stConcat = self.data._concat('cluster')
             if statetype == 'macro':
-                (selFr, selMicro) = _sampleMacro(self, st, stConcat, samplemode, frames[i], replacement)
-                absFrames.append(selFr)
-            elif statetype == 'micro':
-                absFrames.append(_sampleMicro(self, st, stConcat, frames[i], replacement))
+                cache[1][statetype] = _frameIndex(self.macro_ofcluster[stConcat], self.macronum)
             else:
-                raise NameError('No valid state type given (read documentation)')
-
-            if len(absFrames[-1]) == 0:
-                raise NameError('No frames could be sampled from {} state {}. State is empty.'.format(statetype, st))
-
-            relFrames.append(self.data.abs2rel(absFrames[-1]))
-        return absFrames, relFrames
+                cache[1][statetype] = _frameIndex(self.micro_ofcluster[stConcat], self.micronum)
+        return cache[1][statetype]
 
     def eqDistribution(self, plot=True, save=None):
         """ Obtain and plot the equilibrium probabilities of each macrostate
@@ -440,10 +514,10 @@ class Model(object):
         #                'probabilities and hence your results might differ from analyses done before this change.')
         self._integrityCheck(postmsm=True)
         macroeq = np.ones(self.macronum) * -1
-        macroindexes = list(set(self.msm.metastable_assignments))
+        macroindexes = list(set(self._metastable.assignments))
         for i in range(self.macronum):
             # macroeq[i] = np.sum(self.msm.stationary_distribution[self.macro_ofmicro == i])
-            macroeq[i] = np.sum(self.msm.metastable_memberships[:, macroindexes[i]] * self.msm.stationary_distribution)
+            macroeq[i] = np.sum(self._metastable.memberships[:, macroindexes[i]] * self.msm.stationary_distribution)
 
         if plot or (save is not None):
             from matplotlib import pylab as plt
@@ -461,13 +535,13 @@ class Model(object):
         return macroeq
 
     def _coarseP(self):
-        M = self.msm.metastable_memberships
-        Pcoarse = np.linalg.inv(M.T.dot(M)).dot(M.T).dot(self.P).dot(M)
+        M = self._metastable.memberships
+        Pcoarse = np.linalg.inv(M.T.dot(M)).dot(M.T.dot(self.P.dot(M)))  # P.dot(M) also works for sparse P
         if len(np.where(Pcoarse < 0)[0]) != 0:
             raise NameError('Cannot produce coarse P matrix. Ended up with negative probabilities. Try using less macrostates.')
         return Pcoarse
 
-    def getStates(self, states=None, statetype='macro', wrapsel='protein', alignsel='name CA', alignmol=None, samplemode='weighted', numsamples=50, simlist=None):
+    def getStates(self, states=None, statetype='macro', wrapsel='protein', alignsel='name CA', alignmol=None, samplemode='weighted', numsamples=50, simlist=None, njobs=None):
         """ Get samples of MSM states in Molecule classes
 
         Parameters
@@ -490,6 +564,9 @@ class Model(object):
             Number of samples (conformations) for each state.
         simlist : numpy.ndarray of :class:`Sim <htmd.simlist.Sim>` objects
             Optionally pass a different (but matching, i.e. filtered) simlist for creating the Molecules.
+        njobs : int
+            Number of processes used to read the trajectory files. Each file is read only once for all states. If None
+            it will use the default from htmd.config.
 
         Returns
         -------
@@ -531,14 +608,30 @@ class Model(object):
             raise NameError('No ' + statetype + ' states exist in the model')
 
         (tmp, relframes) = self.sampleStates(states, numsamples, statetype=statetype, samplemode=samplemode)
+        # States without samples give empty 1D arrays
+        relframes = [rel if len(rel) else np.empty((0, 2), dtype=int) for rel in relframes]
 
-        from htmd.config import _config
-        from htmd.parallelprogress import ParallelExecutor, delayed
-        # This loop really iterates over states. sampleStates returns an array of arrays
-        # Don't increase njobs because it was giving errors on some systems.
-        aprun = ParallelExecutor(n_jobs=1)
-        mols = aprun(total=len(relframes), desc='Getting state Molecules')\
-            (delayed(_loadMols)(self, rel, molfile, wrapsel, alignsel, alignmol, simlist) for rel in relframes)
+        # All sampled frames are read in one pass over the unique trajectory files
+        from htmd.framereader import readFrames
+        from tqdm import tqdm
+        frames = self.data.rel2sim(np.concatenate(relframes), simlist=simlist, structured=True)
+        trajfiles = [sim.trajectory[piece] for sim, piece in zip(frames.sim, frames.piece)]
+        framedata = None
+        if len(trajfiles):
+            framedata = readFrames(trajfiles, frames.frame, njobs=njobs, desc='Reading state frames')
+
+        mol = Molecule(molfile)
+        mols = []
+        lengths = np.array([len(rel) for rel in relframes])
+        ends = np.cumsum(lengths)
+        for start, end in tqdm(zip(ends - lengths, ends), total=len(relframes), desc='Getting state Molecules'):
+            if start == end:  # The topology without any frames
+                statemol = mol.copy()
+                statemol.dropFrames(keep=[])
+                mols.append(statemol)
+                continue
+            mols.append(_prepareMol(mol.copy(), framedata, range(start, end), trajfiles, frames.frame, wrapsel,
+                                    alignsel, alignmol))
         return np.array(mols, dtype=object)
 
     def viewStates(self, states=None, statetype='macro', protein=None, ligand=None, viewer=None, mols=None,
@@ -741,6 +834,9 @@ class Model(object):
                 self.__dict__[k] = m
             else:
                 self.__dict__[k] = z[k]
+        if '_metastable' not in self.__dict__ and self.__dict__.get('_modelid') is not None:
+            # Models saved before the metastable decomposition was kept on the Model
+            self._metastable = _Metastable(self.msm.metastable_memberships, self.msm.stationary_distribution)
 
     def copy(self):
         """ Produces a deep copy of the object
@@ -835,7 +931,7 @@ class Model(object):
             #kept = np.array([i for i, x in enumerate(newdiscretetraj) if len(x) != 0])
             return np.array(newdiscretetraj, dtype=object), len(corestates), newcounts, frames
 
-        coreset = calcCoreSet(self.msm.metastable_distributions, self.msm.metastable_assignments, threshold)
+        coreset = calcCoreSet(self._metastable.distributions, self._metastable.assignments, threshold)
         newdata = self.data.copy()
         newSt, newdata.K, newdata.N, frames = coreDtraj(self.data, self.micro_ofcluster, coreset)
         for i, (s, fr) in enumerate(zip(newSt, frames)):
@@ -986,15 +1082,9 @@ class Model(object):
             raise NameError('After modifying the data in the MetricData object you need to recluster and reconstruct the markov model.')
 
 
-def _loadMols(self, rel, molfile, wrapsel, alignsel, refmol, simlist):
-    frames = self.data.rel2sim(rel, simlist=simlist)
-    mol = Molecule(molfile)
-    trajs = []
-    frs = []
-    for f in frames:
-        trajs.append(f.sim.trajectory[f.piece])
-        frs.append(f.frame)
-    mol.read(np.array(trajs), frames=np.array(frs))
+def _prepareMol(mol, framedata, idx, trajfiles, frames, wrapsel, alignsel, refmol):
+    from htmd.framereader import setFrames
+    setFrames(mol, framedata, idx, trajfiles, frames)
     if len(wrapsel) > 0:
         mol.wrap(wrapsel)
     if (refmol is not None) and (alignsel is not None):
@@ -1059,45 +1149,114 @@ def getStateStatistic(reference, data, states, statetype='macro', weighted=False
 
     if refdata.numTrajectories > 0 and np.any(refdata.trajLengths != data.trajLengths):
         raise NameError('Data trajectories need to match in size and number to the trajectories in the model')
-    stconcat = np.concatenate(refdata.St)
-    datconcat = np.concatenate(data.dat)
-
-    statistic = []
-    for i, st in enumerate(states):
-        if statetype == 'macro':
-            frames = reference.macro_ofcluster[stconcat] == st
-        elif statetype == 'micro':
-            frames = reference.micro_ofcluster[stconcat] == st
-        elif statetype == 'cluster':
-            frames = stconcat == st
-        else:
-            raise NameError('No valid state type given (read documentation)')
+    stconcat = refdata._concat('cluster')
+    datconcat = data._concat('projection')
+
+    if statetype == 'macro':
+        labels = reference.macro_ofcluster[stconcat]
+    elif statetype == 'micro':
+        labels = reference.micro_ofcluster[stconcat]
+    elif statetype == 'cluster':
+        labels = stconcat
+    else:
+        raise NameError('No valid state type given (read documentation)')
 
-        if statetype == 'macro' and weighted:
-            statistic.append(_weightedMethod(reference, method, stconcat, datconcat, st, axis))
-        else:
-            if axis is None:
-                statistic.append(method(datconcat[frames, ...]))
-            else:
-                statistic.append(method(datconcat[frames, ...], axis=axis))
-    return statistic
+    if statetype == 'macro' and weighted:
+        microsofmacro = [np.where(reference.macro_ofmicro == st)[0] for st in states]
+        micros = np.unique(np.concatenate(microsofmacro)) if len(states) else np.zeros(0, dtype=int)
+        microstat = _groupedStatistic(datconcat, reference.micro_ofcluster[stconcat], micros, method, axis)
+        microstat = dict(zip(micros, microstat))
+        return [_weightedMethod(reference, microstat, m, np.size(datconcat, 1)) for m in microsofmacro]
+    return _groupedStatistic(datconcat, labels, states, method, axis)
 
 
-def _weightedMethod(model, method, stconcat, datconcat, st, axis):
-    microsofmacro = np.where(model.macro_ofmicro == st)[0]
+def _weightedMethod(model, microstat, microsofmacro, numdims):
     eq = model.msm.stationary_distribution
     weights = eq / np.sum(eq[microsofmacro])
-    avgstatistic = np.zeros(np.size(datconcat, 1))
+    avgstatistic = np.zeros(numdims)
     for m in microsofmacro:
-        frames = model.micro_ofcluster[stconcat] == m
-        if axis is None:
-            stat = method(datconcat[frames, :])
-        else:
-            stat = method(datconcat[frames, :], axis=axis)
-        avgstatistic = avgstatistic + stat * weights[m]
+        avgstatistic = avgstatistic + microstat[m] * weights[m]
     return avgstatistic
 
 
+_GROUPREDUCTIONS = {np.mean: 'mean', np.std: 'std', np.var: 'var', np.sum: 'sum', np.min: 'min', np.amin: 'min',
+                    np.max: 'max', np.amax: 'max'}
+
+
+def _groupedStatistic(data, labels, states, method, axis, blocksize=2 ** 25):
+    """ Applies `method` to the frames of each state
+
+    The frames are sorted by state once and gathered in blocks of consecutive states (of up to about `blocksize`
+    elements), so that the frames of each state are a contiguous slice of the block. Means, standard deviations,
+    variances, sums, minima and maxima over the frames are computed for all states of a block at once with ufunc
+    reductions. Any other method is called on the slice of each state without copying it. Returns a list with the
+    statistic of each state in `states`.
+    """
+    from htmd.metricdata import _frameIndex
+    states = np.asarray(states, dtype=int).flatten()
+    if len(states) == 0:
+        return []
+    numstates = max(int(np.max(labels, initial=-1)), int(np.max(states))) + 1
+    order, offsets = _frameIndex(labels, numstates)
+    reduction = _GROUPREDUCTIONS.get(method) if axis == 0 else None
+
+    def apply(frames):
+        return method(frames) if axis is None else method(frames, axis=axis)
+
+    results = {}
+    for st in np.unique(states[states < 0]):  # Negative labels are not indexed, e.g. clusters outside of the model
+        results[st] = apply(data[labels == st, ...])
+
+    uqstates = np.unique(states[states >= 0])
+    sizes = offsets[uqstates + 1] - offsets[uqstates]
+    rowsize = max(int(np.prod(data.shape[1:])), 1)
+    start = 0
+    while start < len(uqstates):
+        end = start + 1
+        blockrows = sizes[start]
+        while end < len(uqstates) and (blockrows + sizes[end]) * rowsize <= blocksize:
+            blockrows += sizes[end]
+            end += 1
+        block = uqstates[start:end]
+        blocksizes = sizes[start:end]
+        frames = np.concatenate([order[offsets[st]:offsets[st + 1]] for st in block])
+        gathered = data[frames, ...]
+        bounds = np.concatenate(([0], np.cumsum(blocksizes)))
+
+        nonempty = blocksizes > 0
+        if reduction is not None and np.any(nonempty):
+            reduced = _reduceGroups(reduction, gathered, bounds[:-1][nonempty], blocksizes[nonempty])
+            # Same type as the method would return, e.g. float32 means of float32 data
+            reduced = reduced.astype(apply(gathered[:1]).dtype, copy=False)
+            for st, res in zip(block[nonempty], reduced):
+                results[st] = res
+        for k, st in enumerate(block):
+            if reduction is None or not nonempty[k]:
+                results[st] = apply(gathered[bounds[k]:bounds[k + 1]])
+        start = end
+    return [results[st] for st in states]
+
+
+def _reduceGroups(reduction, gathered, starts, counts):
+    """ Reduces consecutive groups of rows starting at `starts`, none of which are empty """
+    if reduction == 'min':
+        return np.minimum.reduceat(gathered, starts, axis=0)
+    if reduction == 'max':
+        return np.maximum.reduceat(gathered, starts, axis=0)
+    sums = np.add.reduceat(gathered, starts, axis=0, dtype=np.float64)
+    if reduction == 'sum':
+        return sums
+    counts = counts.reshape((-1,) + (1,) * (gathered.ndim - 1))
+    means = sums / counts
+    if reduction == 'mean':
+        return means
+    deviation = gathered - np.repeat(means, counts.flatten(), axis=0)
+    var = np.add.reduceat(deviation * deviation, starts, axis=0) / counts
+    if reduction == 'var':
+        return var
+    return np.sqrt(var)
+
+
 def macroAccumulate(model, microvalue):
     """ Accumulate values of macrostates from a microstate array
 
@@ -1120,53 +1279,44 @@ def macroAccumulate(model, microvalue):
     return res
 
 
-def _sampleMacro(obj, macro, stConcat, mode, numFrames, replacement):
-    from htmd.metricdata import _randomSample
+def _sampleMacro(obj, macros, mode, numFrames, replacement):
+    """ Samples frames of several macrostates. Returns a list with an array of absolute frames per macrostate. """
+    from htmd.metricdata import _sampleIndex
+    if len(macros) == 0:
+        return []
     if mode == 'random':
-        frames = np.where(obj.macro_ofcluster[stConcat] == macro)[0]
-        selFrames = _randomSample(frames, numFrames, replacement)
-        selMicro = obj.micro_ofcluster[stConcat[selFrames]]
-    elif mode == 'even':
-        micros = np.where(obj.macro_ofmicro == macro)[0]
-        selFrames = []
-        selMicro = []
-        for i in range(len(micros)):
-            selFrames.append(_sampleMicro(obj, micros[i], stConcat, numFrames, replacement))
-            selMicro.append(np.ones(numFrames) * micros[i])
-    elif mode == 'weighted':
-        micros = np.where(obj.macro_ofmicro == macro)[0]
-        eq = obj.msm.stationary_distribution
-        weights = eq[micros] / np.sum(eq[micros])
-        framespermicro = np.random.multinomial(numFrames, weights)
-        selFrames = []
-        selMicro = []
-        for i in range(len(micros)):
-            selFrames = np.append(selFrames, _sampleMicro(obj, micros[i], stConcat, framespermicro[i], replacement))
-            selMicro = np.append(selMicro, [micros[i]] * framespermicro[i])
-    elif mode == 'weightedTrunc':
-        micros = np.where(obj.macro_ofmicro == macro)[0]
-        eq = obj.msm.stationary_distribution
-        weights = eq[micros] / np.sum(eq[micros])
-        idx = np.argsort(weights)
-        cs = np.cumsum(weights[idx])
-        under50 = cs < 0.5
-        weights[idx[under50]] = 0
-        weights /= np.sum(weights)
-        framespermicro = np.random.multinomial(numFrames, weights)
-        selFrames = []
-        selMicro = []
-        for i in range(len(micros)):
-            selFrames = np.append(selFrames, _sampleMicro(obj, micros[i], stConcat, framespermicro[i], replacement))
-            selMicro = np.append(selMicro, [micros[i]] * framespermicro[i])
-    else:
-        raise NameError('No valid mode given (read documentation)')
-    return selFrames, selMicro
-
+        order, offsets = obj._frameIndex('macro')
+        return _sampleIndex(order, offsets, macros, numFrames, replacement)
+
+    # The other modes distribute the samples of each macrostate over its microstates and sample those in one pass
+    micros = []
+    microframes = []
+    for macro, nframes in zip(macros, numFrames):
+        macromicros = np.where(obj.macro_ofmicro == macro)[0]
+        if mode == 'even':
+            framespermicro = [nframes] * len(macromicros)
+        elif mode == 'weighted' or mode == 'weightedTrunc':
+            eq = obj.msm.stationary_distribution
+            weights = eq[macromicros] / np.sum(eq[macromicros])
+            if mode == 'weightedTrunc':
+                idx = np.argsort(weights)
+                cs = np.cumsum(weights[idx])
+                under50 = cs < 0.5
+                weights[idx[under50]] = 0
+                weights /= np.sum(weights)
+            framespermicro = list(np.random.multinomial(nframes, weights))
+        else:
+            raise NameError('No valid mode given (read documentation)')
+        micros.append(macromicros)
+        microframes += framespermicro
 
-def _sampleMicro(obj, micro, stConcat, numFrames, replacement):
-    from htmd.metricdata import _randomSample
-    frames = np.where(obj.micro_ofcluster[stConcat] == micro)[0]
-    return _randomSample(frames, numFrames, replacement)
+    order, offsets = obj._frameIndex('micro')
+    sampled = _sampleIndex(order, offsets, np.concatenate(micros).astype(int), microframes, replacement)
+    ends = np.cumsum([len(m) for m in micros])
+    selFrames = []
+    for start, end in zip(ends - np.array([len(m) for m in micros]), ends):
+        selFrames.append(np.concatenate(sampled[start:end]).astype(int) if end > start else np.array([], dtype=int))
+    return selFrames
 
 
 def _macroTrajectoriesReport(macronum, macrost, simlist=None):
@@ -1201,6 +1351,173 @@ def _macroTrajectoriesReport(macronum, macrost, simlist=None):
                     logger.info(simlist[s])
 
 
+def _sparsePCCA(P, pi, m):
+    """ PCCA+ memberships of a sparse reversible transition matrix
+
+    Only the `m` leading right eigenvectors are calculated, with Lanczos iterations on the matrix
+    D^1/2 P D^-1/2 (D = diag(pi)) which is symmetric for reversible matrices. The memberships are then obtained with
+    the PCCA+ inner simplex algorithm and the optimized rotation of Roeblitz and Weber (Adv Data Anal Classif 7, 2013)
+    as in the dense PCCA of pyemma.
+    """
+    from scipy.sparse import diags, issparse
+    n = P.shape[0]
+    sqrtpi = np.sqrt(pi)
+    S = diags(sqrtpi).dot(P).dot(diags(1 / sqrtpi))
+    S = (S + S.T) / 2  # Remove numerical asymmetry
+    if m < n - 1 and issparse(S):
+        from scipy.sparse.linalg import eigsh
+        # The slowest processes have the largest eigenvalues, not the ones closest to -1
+        vals, vecs = eigsh(S, k=m, which='LA')
+    else:
+        vals, vecs = np.linalg.eigh(S.toarray() if issparse(S) else S)
+    order = np.argsort(-vals)[:m]
+    evecs = vecs[:, order] / sqrtpi[:, np.newaxis]
+
+    # Normalize with respect to pi and make the stationary eigenvector positive
+    evecs /= np.sqrt(np.sum(evecs * evecs * pi[:, np.newaxis], axis=0))
+    evecs[:, 0] = np.abs(evecs[:, 0])
+
+    rotation = _pccaOptimizeRotation(evecs, _pccaInnerSimplex(evecs))
+    memberships = np.clip(evecs.dot(rotation), 0, 1)
+    memberships /= np.sum(memberships, axis=1)[:, np.newaxis]
+    return memberships
+
+
+def _pccaInnerSimplex(evecs):
+    """ Initial PCCA+ rotation matrix, which maps the eigenvectors onto the most distinct states of the inner simplex
+    algorithm """
+    m = evecs.shape[1]
+    representatives = np.zeros(m, dtype=int)
+    representatives[0] = np.argmax(np.linalg.norm(evecs, axis=1))
+    ortho = evecs - evecs[representatives[0]]
+    # Gram-Schmidt orthogonalization to the previous representative and pick the farthest state
+    for k in range(1, m):
+        previous = ortho[representatives[k - 1]].copy()
+        ortho -= np.outer(ortho.dot(previous), previous)
+        dist = np.linalg.norm(ortho, axis=1)
+        dist[representatives[:k]] = -1
+        representatives[k] = np.argmax(dist)
+        ortho /= np.linalg.norm(ortho[representatives[k]])
+    return np.linalg.inv(evecs[representatives])
+
+
+def _pccaOptimizeRotation(evecs, rotation):
+    """ Optimizes the PCCA+ rotation matrix so that the memberships are non-negative and as crisp as possible """
+    from scipy.optimize import fmin
+    m = evecs.shape[1]
+
+    def fill(crop):
+        # The first row and column of a feasible rotation matrix follow from the rest of it
+        crop = crop.reshape(m - 1, m - 1)
+        crop = np.hstack((-np.sum(crop, axis=1)[:, np.newaxis], crop))
+        first = np.max(-evecs[:, 1:].dot(crop), axis=0)
+        return np.vstack((first, crop)) / np.sum(first)
+
+    def objective(crop):
+        rot = fill(crop)
+        return -np.sum(rot * rot / rot[0])
+
+    return fill(fmin(objective, rotation[1:, 1:].ravel(), disp=False))
+
+
+class _Metastable(object):
+    """ Metastable decomposition of the microstates of a Markov model as given by PCCA
+
+    Attributes
+    ----------
+    memberships : np.ndarray
+        The (micronum, macronum) membership probabilities of each microstate to each macrostate
+    distributions : np.ndarray
+        The (macronum, micronum) probability distribution of the microstates in each macrostate
+    sets : list
+        The microstates of each macrostate
+    assignments : np.ndarray
+        The macrostate each microstate is assigned to
+    """
+    def __init__(self, memberships, pi):
+        memberships = np.array(memberships)
+        picoarse = memberships.T.dot(pi)
+        distributions = (memberships * pi[:, np.newaxis]).T / picoarse[:, np.newaxis]
+        self.memberships = memberships
+        self.distributions = distributions / np.sum(distributions, axis=1)[:, np.newaxis]
+        self.assignments = np.argmax(memberships, axis=1)
+        self.sets = [np.where(self.assignments == i)[0] for i in range(memberships.shape[1])]
+
+
+def _countMatrices(St, lags, K):
+    """ Sliding window transition count matrices of discrete trajectories at several lag times
+
+    Returns a list with a sparse (K, K) count matrix for each lag time.
+    """
+    from scipy.sparse import coo_matrix
+    lengths = np.array([len(s) for s in St], dtype=np.int64)
+    st = np.concatenate([np.asarray(s, dtype=np.int64) for s in St]) if len(St) else np.zeros(0, dtype=np.int64)
+    ends = np.repeat(np.cumsum(lengths), lengths)  # End of the trajectory of each frame
+    starts = np.arange(len(st))
+    counts = []
+    for lag in lags:
+        n = max(len(st) - lag, 0)
+        valid = starts[:n] + lag < ends[:n]
+        source = st[:n][valid]
+        sink = st[lag:lag + n][valid]
+        C = coo_matrix((np.ones(len(source)), (source, sink)), shape=(K, K)).tocsr()  # Duplicates are summed
+        counts.append(C)
+    return counts
+
+
+def _markovTools():
+    """ The estimation and analysis modules of deeptime, on which pyemma is built, or of msmtools for older pyemma
+    versions. None if neither is installed. """
+    try:
+        from deeptime.markov.tools import estimation, analysis
+    except ImportError:
+        try:
+            from msmtools import estimation, analysis
+        except ImportError:
+            return None
+    return estimation, analysis
+
+
+def _lagTimescales(C, lag, nits, densemax=2000):
+    """ Implied timescales of the reversible maximum likelihood Markov model of the largest connected set of a count
+    matrix. Dense matrices are used for up to `densemax` states. """
+    estimation, analysis = _markovTools()
+    its = np.full(nits, np.nan)
+    lcc = estimation.largest_connected_set(C, directed=True)
+    if len(lcc) < 2:
+        return its
+    C = C[lcc, :][:, lcc]
+    if len(lcc) <= densemax:
+        C = C.toarray()
+    T = estimation.transition_matrix(C, reversible=True)
+    k = min(nits + 1, len(lcc) if len(lcc) <= densemax else len(lcc) - 2)
+    ev = np.real(analysis.eigenvalues(T, k=k))
+    ev = ev[np.argsort(-np.abs(ev))][1:]
+    with np.errstate(divide='ignore'):
+        its[:len(ev)] = -lag / np.log(np.abs(ev))
+    return its
+
+
+def _plotTimescales(lags, its, dt, units='ns'):
+    """ Plots implied timescales in the same fashion as pyemma.plots.plot_implied_timescales """
+    from matplotlib import pylab as plt
+    if dt is None or dt <= 0:
+        raise ValueError('Invalid frame step {}.'.format(dt))
+    lags = np.asarray(lags) * dt
+    ax = plt.gca()
+    ax.set_yscale('log')
+    for i in range(its.shape[1]):
+        ax.plot(lags, its[:, i] * dt, marker='o', markersize=3)
+    ax.plot(lags, lags, linewidth=2, color='black')
+    # Timescales below the lag time cannot be resolved
+    bottom = ax.get_ylim()[0]
+    ax.fill_between(lags, bottom, lags, alpha=0.2, color='black')
+    ax.set_ylim(bottom=bottom)
+    ax.set_xlabel('lag time ({})'.format(units))
+    ax.set_ylabel('timescale ({})'.format(units))
+    return ax
+
+
 def _macroTrajSt(St, macro_ofcluster):
     mst = np.empty(np.shape(St), dtype=object)
     for i in range(len(St)):
@@ -1263,6 +1580,155 @@ class _TestModel(unittest.TestCase):
         assert newmodel.data.parent.numTrajectories == 2
         self.model.data.parent = None
 
+    def test_sample_states(self):
+        model = self.model.copy()
+        model.markovModel(1, 2)
+        stconcat = model.data._concat('cluster')
+        for statetype, labels in (('macro', model.macro_ofcluster), ('micro', model.micro_ofcluster)):
+            absframes, relframes = model.sampleStates(None, 5, statetype=statetype)
+            for i, fr in enumerate(absframes):
+                assert np.all(labels[stconcat[fr]] == i)
+                assert np.array_equal(relframes[i], model.data.abs2rel(fr))
+
+        absframes, _ = model.sampleStates([0], None, statetype='micro')
+        assert np.array_equal(absframes[0], np.where(model.micro_ofcluster[stconcat] == 0)[0])
+
+    def test_get_states(self):
+        model = self.model.copy()
+        model.markovModel(1, 2)
+        # States without samples give Molecules without frames
+        numsamples = [2] + [0] * (model.micronum - 1)
+        mols = model.getStates(statetype='micro', numsamples=numsamples, wrapsel='', njobs=1)
+        assert [m.numFrames for m in mols] == numsamples
+
+    def test_timescales(self):
+        import pyemma.msm as msm
+        model = self.model.copy()
+        lags = [1, 2, 5, 10]
+        its, itslags = model.plotTimescales(lags=lags, nits=3, results=True, plot=False, njobs=1)
+        ref = msm.its(model.data.St.tolist(), lags=lags, nits=3).get_timescales()
+        assert np.array_equal(itslags, lags)
+        assert np.allclose(its, ref, rtol=1e-5)
+
+        # The timescales are reused until the clustering changes
+        assert set(model._itscache[1].keys()) == set(lags)
+        lag, itime = model.maxConnectedLag(lags)
+        assert np.array_equal(itime, its[:, :2])
+        model.data._clusterid = -1
+        model._impliedTimescales([3], 2)
+        assert list(model._itscache[1].keys()) == [3]
+
+        # Without deeptime or msmtools the timescales are estimated by pyemma
+        from unittest import mock
+        model = self.model.copy()
+        with mock.patch('htmd.model._markovTools', return_value=None):
+            fallback = model._impliedTimescales(lags, 3, njobs=1)
+        assert np.allclose(fallback, ref, rtol=1e-5)
+
+    def test_state_statistic(self):
+        model = self.model.copy()
+        model.markovModel(1, 2)
+        stconcat = model.data._concat('cluster')
+        datconcat = model.data._concat('projection')
+        for statetype, labels, states in (('macro', model.macro_ofcluster, range(model.macronum)),
+                                          ('micro', model.micro_ofcluster, range(model.micronum)),
+                                          ('cluster', np.arange(model.data.K), range(model.data.K))):
+            for method in (np.mean, np.std, np.max, np.median):
+                stats = getStateStatistic(model, model.data, states, statetype=statetype, method=method)
+                for st, stat in zip(states, stats):
+                    assert np.allclose(stat, method(datconcat[labels[stconcat] == st], axis=0), atol=1e-6)
+
+        stats = getStateStatistic(model, model.data, range(model.macronum), weighted=True)
+        eq = model.msm.stationary_distribution
+        for st, stat in zip(range(model.macronum), stats):
+            micros = np.where(model.macro_ofmicro == st)[0]
+            ref = np.sum([datconcat[model.micro_ofcluster[stconcat] == m].mean(axis=0) * eq[m] for m in micros], axis=0)
+            assert np.allclose(stat, ref / np.sum(eq[micros]), atol=1e-6)
+
+    def test_sparse_model(self):
+        from scipy.sparse import issparse
+        from htmd.kinetics import Kinetics
+        dense = self.model.copy()
+        dense.markovModel(1, 2)
+        sparse = self.model.copy()
+        sparse.markovModel(1, 2, sparse=True)
+        assert issparse(sparse.P)
+        assert np.array_equal(dense.micro_ofcluster, sparse.micro_ofcluster)
+        assert np.allclose(dense._metastable.memberships, sparse._metastable.memberships, atol=1e-6)
+        assert np.array_equal(dense.macro_ofmicro, sparse.macro_ofmicro)
+        assert np.allclose(dense.eqDistribution(plot=False), sparse.eqDistribution(plot=False))
+        assert np.allclose(dense._coarseP(), sparse._coarseP())
+        rdense = Kinetics(dense, temperature=300, source=0, sink=1).getRates()
+        rsparse = Kinetics(sparse, temperature=300, source=0, sink=1).getRates()
+        assert np.isclose(rdense.mfpton, rsparse.mfpton) and np.isclose(rdense.mfptoff, rsparse.mfptoff)
+
+    def test_sparse_pcca(self):
+        from scipy.sparse import csr_matrix
+        # Two metastable blocks of 10 states. Within each block the states alternate between its two halves, which
+        # gives eigenvalues close to -1 that are larger in magnitude than the slow exchange between the blocks.
+        P = np.zeros((20, 20))
+        for i in range(20):
+            block = i // 10
+            other = [j for j in range(block * 10, block * 10 + 10) if (j // 5) % 2 != (i // 5) % 2]
+            P[i, other] = 0.999 / len(other)
+            P[i, [j for j in range(20) if j // 10 != block]] = 0.001 / 10
+        memberships = _sparsePCCA(csr_matrix(P), np.ones(20) / 20, 2)
+        assignments = np.argmax(memberships, axis=1)
+        assert len(set(assignments[:10])) == 1 and len(set(assignments[10:])) == 1
+        assert assignments[0] != assignments[10]
+
+    def test_rate_matrix(self):
+        from htmd.kinetics import Kinetics, Rates
+        model = self.model.copy()
+        model.markovModel(1, 3)
+        for sparse in (False, True):
+            if sparse:
+                model.markovModel(1, 3, sparse=True)
+            kin = Kinetics(model, temperature=300, concentration=0.015, source=1, sink=0)
+            rates = kin.getRateMatrix()
+            assert rates.shape == (model.macronum, model.macronum)
+            for i in range(model.macronum):
+                for j in range(model.macronum):
+                    r = kin.getRates(source=i, sink=j, _logger=False)
+                    for f in Rates._fields:
+                        assert np.isclose(rates[f][i, j], getattr(r, f), rtol=1e-6), (i, j, f)
+
+    def test_bootstrap(self):
+        from htmd.kinetics import Kinetics
+        from htmd.bootstrap import bootstrapModel
+        model = self.model.copy()
+        model.markovModel(1, 2)
+        kin = Kinetics(model, temperature=300, source=0, sink=1)
+        boot = bootstrapModel(model, numboot=4, ratio=1, kinetics=kin, njobs=1, seed=0)
+        # Without replacement and a ratio of 1 every replica has all the data and reproduces the model
+        assert boot.numBootstraps == 4
+        mean, low, high = boot.confidenceInterval('eq')
+        assert np.allclose(mean, model.eqDistribution(plot=False)) and np.allclose(low, high)
+        mean, low, high = boot.confidenceInterval('mfpton')
+        assert np.isclose(mean, kin.getRates(_logger=False).mfpton)
+        assert np.allclose(boot.confidenceInterval('timescales')[0], model.msm.timescales(1) * model.data.fstep)
+
+        parallel = bootstrapModel(model, numboot=4, ratio=0.5, replacement=True, kinetics=kin, njobs=2, seed=0)
+        serial = bootstrapModel(model, numboot=4, ratio=0.5, replacement=True, kinetics=kin, njobs=1, seed=0)
+        assert np.allclose(parallel.eq, serial.eq, equal_nan=True)
+        assert np.allclose(parallel.rates['koff'], serial.rates['koff'], equal_nan=True)
+
+        # Replicas whose estimation fails are discarded and the replicas are built as sparse as the reference model
+        from unittest import mock
+        markovModel = Model.markovModel
+        calls = []
+
+        def failFirst(self, *args, **kwargs):
+            calls.append(kwargs['sparse'])
+            if len(calls) == 1:
+                raise ValueError('Too few connected states')
+            return markovModel(self, *args, **kwargs)
+
+        model.markovModel(1, 2, sparse=True)
+        with mock.patch.object(Model, 'markovModel', autospec=True, side_effect=failFirst):
+            boot = bootstrapModel(model, numboot=3, ratio=1, njobs=1, seed=0)
+        assert boot.numBootstraps == 2 and calls == [True] * 3
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
 
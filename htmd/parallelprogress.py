@@ -16,4 +16,191 @@ def ParallelExecutor(**joblib_args):
     def aprun(**tq_args):
         tqdm_f = lambda x, args: tqdm(x, **args)
         return lambda x: Parallel(**joblib_args)(tqdm_f(x, tq_args))
-    return aprun
\ No newline at end of file
+    return aprun
+
+
+def memoryBoundedRun(func, tasks, memory, budget=None, n_jobs=1, desc=None):
+    """ Runs a function over a list of tasks in a process pool while keeping their estimated memory within a budget
+
+    Tasks are started largest first. A task is only started if the estimated memory of the running tasks plus its own
+    fits in the budget, and smaller tasks further down the queue are started when the next larger one does not fit.
+    A task larger than the whole budget runs on its own.
+
+    Parameters
+    ----------
+    func : function
+        The function to run. It is sent to the worker processes with pickle, so it must be defined at module level.
+    tasks : list of tuples
+        The arguments of each call to the function
+    memory : list of float
+        The estimated memory in bytes which each task needs. NaN for unknown estimates, which are taken to be as large
+        as the largest known one.
+    budget : float
+        The memory budget in bytes. If None there is no budget and only `n_jobs` limits the number of running tasks.
+    n_jobs : int
+        Maximum number of tasks to run at the same time. Negative numbers are relative to the number of CPUs as in joblib.
+    desc : str
+        Description of the progress bar
+
+    Returns
+    -------
+    results : list
+        The results of each task in the order of `tasks`
+    """
+    import numpy as np
+    from joblib import effective_n_jobs
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+    n_jobs = effective_n_jobs(n_jobs)
+    memory = np.array(memory, dtype=float)
+    if len(memory) and np.all(np.isnan(memory)):
+        memory[:] = 0
+    elif len(memory):
+        memory[np.isnan(memory)] = np.nanmax(memory)
+    if budget is None:
+        budget = np.inf
+
+    results = [None] * len(tasks)
+    queue = list(np.argsort(-memory, kind='stable'))
+    if n_jobs == 1:
+        for i in tqdm(range(len(tasks)), desc=desc):
+            results[i] = func(*tasks[i])
+        return results
+
+    running = {}
+    used = 0
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor, tqdm(total=len(tasks), desc=desc) as bar:
+        while len(queue) or len(running):
+            while len(queue) and len(running) < n_jobs:
+                free = budget - used
+                pos = next((k for k, i in enumerate(queue) if memory[i] <= free), None)
+                if pos is None:
+                    if len(running):
+                        break
+                    pos = 0  # Nothing fits but nothing is running either
+                i = queue.pop(pos)
+                running[executor.submit(func, *tasks[i])] = i
+                used += memory[i]
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = running.pop(future)
+                used -= memory[i]
+                results[i] = future.result()
+                bar.update(1)
+    return results
+
+
+class SharedState(object):
+    """ Read-only state shared with the worker processes of a process pool
+
+    The state is pickled once into a file in shared memory (/dev/shm where available). Pickling this object only
+    sends the path of the file, and each worker process loads the file once and reuses it for all its tasks.
+    If `share` is False (e.g. when running in a single process) the state is used directly.
+
+    Parameters
+    ----------
+    state : object
+        Any picklable object
+    share : bool
+        Write the state to a file for the worker processes
+    prefix : str
+        Prefix of the temporary folder holding the file
+
+    Examples
+    --------
+    >>> with SharedState((mol, projections), share=True) as shared:
+    ...     results = Parallel(n_jobs=4)(delayed(func)(shared, i) for i in range(100))  # func calls shared.get()
+    """
+    _workercache = {}
+
+    def __init__(self, state, share=True, prefix='htmdshared'):
+        self.path = None
+        self._local = state
+        self._tmpdir = None
+        if share:
+            import os
+            import pickle
+            import tempfile
+            shmdir = '/dev/shm' if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK) else None
+            self._tmpdir = tempfile.mkdtemp(prefix=prefix, dir=shmdir)
+            self.path = os.path.join(self._tmpdir, 'state.pkl')
+            with open(self.path, 'wb') as f:
+                pickle.dump(self._local, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def get(self):
+        if self.path is None or self._local is not None:
+            return self._local
+        cache = SharedState._workercache
+        if self.path not in cache:
+            import pickle
+            cache.clear()  # Only keep the state of the current pool in the worker
+            with open(self.path, 'rb') as f:
+                cache[self.path] = pickle.load(f)
+        return cache[self.path]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.path is not None:
+            state['_local'] = None
+        state['_tmpdir'] = None
+        return state
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        if self._tmpdir is not None:
+            import shutil
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+
+
+import unittest
+import numpy as np
+
+
+class _TestParallelProgress(unittest.TestCase):
+    @staticmethod
+    def _workerState(shared):
+        import os
+        state = shared.get()
+        return os.getpid(), id(state), state['value']
+
+    def test_shared_state(self):
+        import os
+        import pickle
+        state = {'value': 42, 'data': list(range(10000))}
+
+        with SharedState(state, share=False) as shared:
+            assert shared.path is None and shared.get() is state
+
+        with SharedState(state, prefix='htmdtest') as shared:
+            tmpdir = os.path.dirname(shared.path)
+            assert os.path.basename(tmpdir).startswith('htmdtest') and os.path.isfile(shared.path)
+            assert shared.get() is state  # The creating process uses the state directly
+            sent = pickle.dumps(shared)
+            assert len(sent) < len(pickle.dumps(state))  # Only the path is pickled
+            received = pickle.loads(sent)
+            assert received.get() == state and received.get() is received.get()  # Loaded once and reused
+
+            # Each worker loads the state once and reuses it for all its tasks
+            results = Parallel(n_jobs=2)(delayed(_TestParallelProgress._workerState)(shared) for _ in range(20))
+            assert all(r[2] == 42 for r in results)
+            for pid in set(r[0] for r in results):
+                assert len(set(r[1] for r in results if r[0] == pid)) == 1
+        assert not os.path.exists(tmpdir)
+        assert received.get() == state  # Already loaded states remain usable after the file is removed
+
+        # A new state replaces the previous one in the worker cache
+        with SharedState({'value': 1}) as other:
+            assert pickle.loads(pickle.dumps(other)).get() == {'value': 1}
+            assert list(SharedState._workercache.keys()) == [other.path]
+
+    def test_memory_bounded_run(self):
+        import operator
+        tasks = [(i, 10) for i in range(8)]
+        memory = [5, np.nan, 50, 1, 1, 200, np.nan, 3]
+        for n_jobs in (1, 2):
+            for budget in (None, 100, 1):  # One task is larger than the budget of 100
+                results = memoryBoundedRun(operator.add, tasks, memory, budget=budget, n_jobs=n_jobs)
+                assert results == [i + 10 for i in range(8)]
+        assert memoryBoundedRun(operator.add, [], [], n_jobs=2) == []
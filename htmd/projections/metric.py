@@ -10,7 +10,7 @@ from htmd.metricdata import MetricData
 from scipy import stats
 from moleculekit.projections.projection import Projection
 from joblib import Parallel, delayed
-from htmd.parallelprogress import ParallelExecutor
+from htmd.parallelprogress import memoryBoundedRun, SharedState
 import logging
 logger = logging.getLogger(__name__)
 
@@ -27,6 +27,16 @@ class Metric:
     metricdata : :class:`MetricData <htmd.metricdata.MetricData>` object
         If a MetricData object is passed in the constructor, Metric will try to update it by only adding simulations
         which don't exist in it yet.
+    cachedir : str
+        Directory in which to cache the projected data of each trajectory. Trajectories whose files, topology, skip and
+        projection parameters have not changed since they were cached are loaded from the cache instead of being
+        projected again. Functions are identified by their code, arguments and closure but not by any global variables
+        they use. If None, no caching is performed.
+    chunksize : int
+        Number of frames to read and project at a time. This bounds the memory used for each simulation by the chunk size
+        instead of the length of the simulation, which allows projecting very long trajectories. It can only be used
+        with projections which calculate each frame independently of the others (i.e. not MetricFluctuation without
+        a reference structure or functions which combine frames). If None, whole simulations are projected at once.
 
     Examples
     --------
@@ -45,6 +55,11 @@ class Metric:
     >>> metr = Metric(sims)
     >>> metr.set( (foo, (ref,)) )
     >>> data2 = metr.project()
+    >>>
+    >>> # Only project trajectories which were not already projected in previous calls
+    >>> metr = Metric(sims, cachedir='./projcache')
+    >>> metr.set(MetricSelfDistance('protein and name CA', metric='contacts'))
+    >>> data3 = metr.project()
 
     .. rubric:: Methods
     .. autoautosummary:: htmd.projections.metric.Metric
@@ -53,11 +68,13 @@ class Metric:
     .. autoautosummary:: htmd.projections.metric.Metric
         :attributes:
     """
-    def __init__(self, simulations, skip=1, metricdata=None):
+    def __init__(self, simulations, skip=1, metricdata=None, cachedir=None, chunksize=None):
         self.simulations = simulations
         self.skip = skip
         self.projectionlist = []
         self.metricdata = metricdata
+        self.cachedir = cachedir
+        self.chunksize = chunksize
 
     def set(self, projection):
         """ Sets the projection to be applied to the simulations.
@@ -79,6 +96,57 @@ class Metric:
             raise AttributeError('Metric.set only accepts Projection objects, functions, function/argument tuples or '
                                  'lists and tuples thereof.')
 
+    def dropTraj(self, limits=None, multiple=None, idx=None):
+        """ Drops simulations based on their lengths before projecting them
+
+        The lengths are calculated from the frame counts of the simlist (see the `probe` option of
+        :func:`simlist <htmd.simlist.simlist>`) taking into account frame skipping, so that dropped simulations are
+        never loaded or projected. The options are the same as in
+        :func:`MetricData.dropTraj <htmd.metricdata.MetricData.dropTraj>`. Simulations whose length cannot be determined
+        without reading them are kept.
+
+        By default, drops all simulations which are not of statistical mode (most common) length.
+
+        Parameters
+        ----------
+        limits : list, optional
+            Lower and upper limits of projected trajectory lengths we want to keep. e.g. [100, 500]
+        multiple : list, optional
+            Drops simulations whose projected length is not a multiple of lengths in the list. e.g. [50, 80]
+        idx : list, optional
+            A list of simulation indexes to drop
+
+        Examples
+        --------
+        >>> metr = Metric(sims)
+        >>> metr.dropTraj(limits=[100, 1000])
+        >>> metr.set(MetricSelfDistance('protein and name CA'))
+        >>> data = metr.project()
+        """
+        from htmd.simlist import _probeSimFrames
+        numframes = _probeSimFrames(self.simulations, persist=False)  # Never write into the data folders here
+        lengths = np.array([_projectedLength(n, self.skip) for n in numframes], dtype=float)
+        known = ~np.isnan(lengths)
+        orgNum = len(self.simulations)
+
+        drop = np.zeros(orgNum, dtype=bool)
+        if limits is not None:
+            drop = known & ((lengths < limits[0]) | (lengths > limits[1]))
+        elif multiple is not None:
+            drop = known.copy()
+            for m in multiple:
+                drop &= np.mod(lengths, m) != 0
+        elif idx is not None:
+            drop[idx] = True
+        elif np.any(known):
+            drop = known & (lengths != stats.mode(lengths[known]).mode)
+
+        if np.any(~known):
+            logger.warning('The lengths of {} simulations could not be determined without reading them. They will not '
+                           'be dropped before projection.'.format(np.sum(~known)))
+        self.simulations = np.array([self.simulations[i] for i in np.where(~drop)[0]], dtype=object)
+        logger.info('Dropped {} simulations before projection. Using {} simulations.'.format(np.sum(drop), orgNum - np.sum(drop)))
+
     def getMapping(self, mol):
         """ Returns the description of each projected dimension.
 
@@ -101,15 +169,21 @@ class Metric:
                 pandamap = pandamap.append(proj.getMapping(mol), ignore_index=True)
         return pandamap
 
-    def project(self, njobs=None):
+    def project(self, njobs=None, memory=None):
         """
         Applies all projections stored in Metric on all simulations.
 
         Parameters
         ----------
         njobs : int
-            Number of parallel jobs to spawn for projection of trajectories. Take care that this can use large amounts 
-            of memory as multiple trajectories are loaded at once.  If None it will use the default from htmd.config.
+            Maximum number of parallel jobs to spawn for projection of trajectories. Take care that this can use large
+            amounts of memory as multiple trajectories are loaded at once.  If None it will use the default from
+            htmd.config.
+        memory : float
+            Memory budget in bytes for projecting trajectories in parallel. The memory needed by each trajectory is
+            estimated from its number of frames and atoms and trajectories are projected largest first, starting new
+            ones only while the estimated memory of the running ones fits the budget. If None it will use 80% of the
+            currently available memory. Set it to `np.inf` to only limit the parallelism with `njobs`.
 
         Returns
         -------
@@ -141,10 +215,40 @@ class Metric:
             logger.warning('Cannot calculate description of dimensions due to different topology files for each trajectory.')
         mapping = self.getMapping(uqMol)
 
+        results = [None] * numSim
+        cachekeys = [None] * numSim
+        if self.cachedir is not None:
+            results, cachekeys = self._loadCache()
+
         logger.debug('Metric: Starting projection of trajectories.')
         from htmd.config import _config
-        aprun = ParallelExecutor(n_jobs=njobs if njobs is not None else _config['njobs'])
-        results = aprun(total=numSim, desc='Projecting trajectories')(delayed(_processSim)(self.simulations[i], self.projectionlist, uqMol, self.skip) for i in range(numSim))
+        toproject = [i for i in range(numSim) if results[i] is None]
+        if len(toproject) != 0:
+            njobs = njobs if njobs is not None else _config['njobs']
+            # The topology and projections are sent to each worker process once instead of with every trajectory
+            projmol, projections, atoms = uqMol, self.projectionlist, None
+            if uqMol is not None:
+                atoms = _atomSubset(self.projectionlist, uqMol)
+            if atoms is not None:
+                # Only the atoms used by the projections are kept in memory after reading each trajectory file
+                logger.info('Projections use {} of {} atoms. Only those will be kept when reading the trajectories.'
+                            ''.format(np.sum(atoms), uqMol.numAtoms))
+                projmol = uqMol.copy()
+                projmol.filter(atoms, _logger=False)
+                projections = _subsetProjections(self.projectionlist, atoms)
+            estimates = self._memoryEstimates(toproject, uqMol, atoms, njobs)
+            if memory is None:
+                from htmd.util import _availableMemory
+                memory = _availableMemory()
+                memory = memory * 0.8 if memory is not None else None
+            with SharedState((projmol, projections, atoms), share=(njobs != 1), prefix='htmdmetric') as shared:
+                tasks = [(self.simulations[i], shared, self.skip, self.chunksize) for i in toproject]
+                projected = memoryBoundedRun(_processSharedSim, tasks, estimates, budget=memory, n_jobs=njobs,
+                                             desc='Projecting trajectories')
+            for i, res in zip(toproject, projected):
+                results[i] = res
+                if cachekeys[i] is not None and not res[3]:
+                    _saveCached(self.cachedir, cachekeys[i], res)
 
         metrics = np.empty(numSim, dtype=object)
         ref = np.empty(numSim, dtype=object)
@@ -181,8 +285,36 @@ class Metric:
 
         return data
 
+    def _loadCache(self):
+        import os
+        os.makedirs(self.cachedir, exist_ok=True)
+        projhash = _fingerprint(self.projectionlist)
+        results = []
+        cachekeys = []
+        for sim in self.simulations:
+            key = _simCacheKey(sim, self.skip, projhash)
+            cachekeys.append(key)
+            results.append(_loadCached(self.cachedir, key) if key is not None else None)
+        numcached = len(results) - results.count(None)
+        logger.info('Loaded {} of {} trajectories from the projection cache in {}'.format(numcached, len(results),
+                                                                                        self.cachedir))
+        return results, cachekeys
+
+    def _memoryEstimates(self, toproject, uqMol, atoms, njobs):
+        """ Estimated peak memory in bytes for projecting each simulation or NaN if unknown """
+        from joblib import effective_n_jobs
+        sims = [self.simulations[i] for i in toproject]
+        njobs = effective_n_jobs(njobs)
+        if uqMol is None or njobs == 1:
+            return np.full(len(sims), np.nan)
+        from htmd.simlist import _probeSimFrames
+        numframes = _probeSimFrames(sims, njobs, persist=False)  # Never write into the data folders here
+        numkept = np.sum(atoms) if atoms is not None else uqMol.numAtoms
+        return np.array([_simMemory(n, self.skip, uqMol.numAtoms, numkept, self.chunksize) for n in numframes])
+
     def _projectSingle(self, index):
-        data, ref, fstep, _ = _processSim(self.simulations[index], self.projectionlist, None, self.skip)
+        data, ref, fstep, _ = _processSim(self.simulations[index], self.projectionlist, None, self.skip,
+                                         chunksize=self.chunksize)
         return data, ref, fstep
 
     def _removeEmpty(self, metrics, ref, deletesims, fstep):
@@ -239,29 +371,211 @@ def _highfreqFilter(mol,steps):
     mol.coords=X
 
 
-def _processSim(sim, projectionlist, uqmol, skip):
+def _processSharedSim(sim, shared, skip, chunksize):
+    uqmol, projectionlist, atoms = shared.get()
+    return _processSim(sim, projectionlist, uqmol, skip, atoms, chunksize)
+
+
+def _projectedLength(numframes, skip):
+    """ Number of frames a simulation will have after projection or NaN if unknown """
+    if numframes is None or any([n is None for n in numframes]):
+        return np.nan
+    return int(np.ceil(np.sum(numframes) / skip))
+
+
+_MEMORYFACTOR = 3  # Projections and readers typically hold a couple of copies of the coordinates they work on
+
+
+def _simMemory(numframes, skip, numatoms, numkept, chunksize):
+    """ Estimated peak memory in bytes for reading and projecting a simulation or NaN if its length is unknown
+
+    Accounts for the frames kept in memory after skipping with `numkept` atoms and for the frames which are read at
+    once with all `numatoms` atoms, i.e. a chunk or a whole trajectory piece.
+    """
+    if numframes is None or any([n is None for n in numframes]):
+        return np.nan
+    bytesperatom = 3 * 4  # float32 coordinates
+    if chunksize is not None:
+        return _MEMORYFACTOR * bytesperatom * numatoms * min(chunksize, np.max(numframes))
+    kept = _projectedLength(numframes, skip) * numkept
+    read = np.max(numframes) * numatoms
+    return _MEMORYFACTOR * bytesperatom * (kept + read)
+
+
+def _trajectorySelections(proj):
+    """ The cached selections of a projection which does not use any atoms outside of them
+
+    Returns None for projections which may need other atoms, such as user functions or projections which wrap
+    the coordinates as wrapping uses the bonds of the whole system.
+    """
+    from moleculekit.projections.metricdistance import MetricDistance
+    from moleculekit.projections.metriccoordinate import MetricCoordinate
+    from moleculekit.projections.metricrmsd import MetricRmsd
+    if isinstance(proj, MetricDistance):
+        return 'sel1', 'sel2'
+    if isinstance(proj, MetricCoordinate) and not proj._pbc:
+        return 'trajalnsel', 'atomsel'
+    if isinstance(proj, MetricRmsd) and not proj._pbc:
+        return 'trajalnsel', 'trajrmsdsel'
+    return None
+
+
+def _atomSubset(projectionlist, mol):
+    """ Atoms required by the projections or None if all atoms are required
+
+    The projections need to have their cache set on `mol`.
+    """
+    atoms = np.zeros(mol.numAtoms, dtype=bool)
+    for proj in projectionlist:
+        keys = _trajectorySelections(proj)
+        if keys is None:
+            return None
+        for key in keys:
+            if key not in proj._cache:
+                return None
+            sel = proj._cache[key]
+            if sel is None:
+                continue
+            sel = np.asarray(sel)
+            if sel.dtype != bool or sel.ndim not in (1, 2) or sel.shape[-1] != mol.numAtoms:
+                return None
+            atoms |= sel if sel.ndim == 1 else np.any(sel, axis=0)
+    if np.all(atoms):
+        return None
+    return atoms
+
+
+def _subsetProjections(projectionlist, atoms):
+    """ Copies of the projections with their cached selections restricted to a subset of atoms """
+    subset = []
+    for proj in projectionlist:
+        proj = proj.copy()
+        for key in _trajectorySelections(proj):
+            if proj._cache[key] is not None:
+                proj._cache[key] = np.ascontiguousarray(proj._cache[key][..., atoms])
+        subset.append(proj)
+    return subset
+
+
+def _iterFrames(pieces, numframes, skip, numatoms, atoms=None, chunksize=None):
+    """ Reads the frames of trajectory pieces
+
+    Yields dictionaries with the frame fields and the fileloc of up to `chunksize` frames at a time. Pieces whose number
+    of frames is unknown, or all pieces if `chunksize` is None, are read whole and then split. Frames are skipped over
+    the concatenation of the pieces as in `Molecule.read`. If `atoms` is given only those atoms are kept, which are
+    dropped right after reading so that at most one piece is held in memory with all of its atoms.
+    """
+    offset = 0
+    for piece, n in zip(pieces, numframes):
+        if n is None or chunksize is None:
+            piecemol = Molecule()
+            piecemol.read(piece)
+            keep = np.arange((-offset) % skip, piecemol.numFrames, skip)
+            offset += piecemol.numFrames
+            step = chunksize if chunksize is not None else max(len(keep), 1)
+            for start in range(0, len(keep), step):
+                yield _frameFields(piecemol, keep[start:start+step], numatoms, atoms, piece, keep[start:start+step])
+        else:
+            keep = np.arange((-offset) % skip, n, skip)
+            offset += n
+            for start in range(0, len(keep), chunksize):
+                frames = keep[start:start+chunksize]
+                chunkmol = Molecule()
+                chunkmol.read(piece, frames=frames)
+                yield _frameFields(chunkmol, np.arange(chunkmol.numFrames), numatoms, atoms, piece, frames)
+
+
+def _frameFields(mol, frames, numatoms, atoms, piece, pieceframes):
+    if mol.numAtoms != numatoms:
+        raise RuntimeError('Trajectory {} has {} atoms while the topology has {}'.format(piece, mol.numAtoms, numatoms))
+    coords = mol.coords if atoms is None else mol.coords[atoms]
+    return {'coords': np.ascontiguousarray(coords[:, :, frames]),
+            'box': mol.box[:, frames],
+            'boxangles': mol.boxangles[:, frames],
+            'step': mol.step[frames],
+            'time': mol.time[frames],
+            'fileloc': [[piece, int(f)] for f in pieceframes]}
+
+
+def _setFrames(mol, chunks):
+    """ Sets the frames of a Molecule to the concatenation of chunks produced by `_iterFrames` """
+    if len(chunks) == 0:
+        raise RuntimeError('No frames were read')
+    for f in ('coords', 'box', 'boxangles', 'step', 'time'):
+        setattr(mol, f, chunks[0][f] if len(chunks) == 1 else np.concatenate([c[f] for c in chunks], axis=-1))
+    mol.fileloc = [loc for c in chunks for loc in c['fileloc']]
+    mol.frame = 0
+
+
+def _projectFrames(projectionlist, mol, sim):
+    data = []
+    for proj in projectionlist:
+        result = _project(proj, mol)
+        if result.ndim == 1:
+            result = np.atleast_2d(result).T
+        if result.size == 0:
+            logger.warning(f'No data was produced by projection {proj.__class__} of simulation id: {sim.simid}')
+        data.append(result)
+
+    data = np.hstack(data)
+    if data.dtype == np.float64:
+        data = data.astype(np.float32)
+    return data
+
+
+def _shareTopology(mol):
+    """ A shallow copy of a Molecule whose frames can be replaced without copying or modifying its topology
+
+    Reading and setting frames rebinds the trajectory fields of the copy, so the topology arrays of `mol` are shared
+    rather than duplicated for every trajectory or chunk. They must not be modified in place.
+    """
+    import copy
+    return copy.copy(mol)
+
+
+def _processSim(sim, projectionlist, uqmol, skip, atoms=None, chunksize=None):
     pieces = sim.trajectory
     try:
         if uqmol is not None:
-            mol = uqmol.copy()
+            # The unique molecule is cached by the workers and reused for all of their simulations
+            mol = _shareTopology(uqmol)
         else:
             mol = Molecule(sim.molfile)
         logger.debug(pieces[0])
 
-        mol.read(pieces, skip=skip)
- 
-        data = []
-        for proj in projectionlist:
-            result = _project(proj, mol)
-            if result.ndim == 1:
-                result = np.atleast_2d(result).T
-            if result.size == 0:
-                logger.warning(f'No data was produced by projection {proj.__class__} of simulation id: {sim.simid}')
-            data.append(result)
-
-        data = np.hstack(data)
-        if data.dtype == np.float64:
-            data = data.astype(np.float32)
+        if atoms is None and chunksize is None:
+            mol.read(pieces, skip=skip)
+            data = _projectFrames(projectionlist, mol, sim)
+        else:
+            numframes = sim.numframes
+            if numframes is None or len(numframes) != len(pieces):
+                numframes = [None] * len(pieces)
+            if chunksize is not None:
+                from htmd.simlist import _probeNumFrames
+                numframes = [n if n is not None else _probeNumFrames(p) for p, n in zip(pieces, numframes)]
+            numatoms = mol.numAtoms if atoms is None else len(atoms)
+            frames = _iterFrames(pieces, numframes, skip, numatoms, atoms, chunksize)
+            if chunksize is None:
+                _setFrames(mol, list(frames))
+                data = _projectFrames(projectionlist, mol, sim)
+            else:
+                # Only one chunk of frames is held in memory at a time
+                data = []
+                time = []
+                fileloc = []
+                for chunk in frames:
+                    chunkmol = _shareTopology(mol)
+                    _setFrames(chunkmol, [chunk])
+                    data.append(_projectFrames(projectionlist, chunkmol, sim))
+                    time.append(chunk['time'])
+                    fileloc += chunk['fileloc']
+                    del chunkmol, chunk
+                if len(data) == 0:
+                    raise RuntimeError('No frames were read')
+                data = np.vstack(data)
+                # The frame step and the references are calculated over the whole simulation
+                mol.time = np.concatenate(time)
+                mol.fileloc = fileloc
 
     except Exception as e:
         logger.warning(f'Error while projecting simulation id: {sim.simid}. "{e}"')
@@ -270,6 +584,110 @@ def _processSim(sim, projectionlist, uqmol, skip):
     return data, _calcRef(pieces, mol.fileloc), mol.fstep, False
 
 
+def _fingerprint(obj):
+    """ Computes a hash of an object's contents which is stable across python sessions """
+    import hashlib
+    h = hashlib.sha256()
+    _updateFingerprint(h, obj, set())
+    return h.hexdigest()
+
+
+def _updateFingerprint(h, obj, seen):
+    import types
+    if obj is None or isinstance(obj, (str, bytes, bool, int, float, complex, np.generic)):
+        h.update(repr((type(obj).__name__, obj)).encode())
+        return
+    if id(obj) in seen:  # Guard against reference cycles
+        h.update(b'<cycle>')
+        return
+    seen.add(id(obj))
+    if isinstance(obj, np.ndarray):
+        h.update('ndarray{}{}'.format(obj.dtype.str, obj.shape).encode())
+        if obj.dtype == object:
+            for x in obj.flat:
+                _updateFingerprint(h, x, seen)
+        else:
+            h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, dict):
+        h.update(b'dict')
+        for k in sorted(obj, key=repr):
+            if k == '_cache':  # Cached topology properties are not parameters of the projection
+                continue
+            _updateFingerprint(h, k, seen)
+            _updateFingerprint(h, obj[k], seen)
+    elif isinstance(obj, (list, tuple)):
+        h.update(type(obj).__name__.encode())
+        for x in obj:
+            _updateFingerprint(h, x, seen)
+    elif isinstance(obj, (set, frozenset)):
+        h.update(b'set')
+        for x in sorted(obj, key=repr):
+            _updateFingerprint(h, x, seen)
+    elif isinstance(obj, types.CodeType):
+        h.update(obj.co_code)
+        _updateFingerprint(h, obj.co_consts, seen)
+        _updateFingerprint(h, obj.co_names, seen)
+    elif isinstance(obj, (types.FunctionType, types.MethodType)):
+        func = obj.__func__ if isinstance(obj, types.MethodType) else obj
+        h.update('{}.{}'.format(func.__module__, func.__qualname__).encode())
+        _updateFingerprint(h, func.__code__, seen)
+        _updateFingerprint(h, func.__defaults__, seen)
+        if func.__closure__ is not None:
+            _updateFingerprint(h, [c.cell_contents for c in func.__closure__], seen)
+        if isinstance(obj, types.MethodType):
+            _updateFingerprint(h, obj.__self__, seen)
+    elif hasattr(obj, '__dict__'):
+        h.update('{}.{}'.format(type(obj).__module__, type(obj).__qualname__).encode())
+        _updateFingerprint(h, vars(obj), seen)
+    else:
+        h.update(repr(obj).encode())
+
+
+def _simCacheKey(sim, skip, projhash):
+    import os
+    import hashlib
+    from htmd.util import ensurelist
+    h = hashlib.sha256()
+    h.update(projhash.encode())
+    h.update('skip{}'.format(skip).encode())
+    try:
+        for f in list(sim.trajectory) + ensurelist(sim.molfile):
+            f = os.path.abspath(f)
+            st = os.stat(f)
+            h.update('{}:{}:{}'.format(f, st.st_size, st.st_mtime_ns).encode())
+    except (OSError, TypeError):
+        return None
+    return h.hexdigest()
+
+
+def _loadCached(cachedir, key):
+    import os
+    fname = os.path.join(cachedir, key + '.npz')
+    if not os.path.exists(fname):
+        return None
+    try:
+        with np.load(fname) as f:
+            return f['data'], f['ref'], float(f['fstep']), False
+    except Exception as e:
+        logger.warning('Could not read cached projection {}. Projecting again. "{}"'.format(fname, e))
+        return None
+
+
+def _saveCached(cachedir, key, result):
+    import os
+    data, ref, fstep, _ = result
+    fname = os.path.join(cachedir, key + '.npz')
+    tmpname = '{}.{}.tmp'.format(fname, os.getpid())
+    try:
+        with open(tmpname, 'wb') as f:
+            np.savez(f, data=data, ref=ref, fstep=np.float64(fstep if fstep is not None else 0))
+        os.replace(tmpname, fname)  # Atomic so that concurrent readers never see partial files
+    except Exception as e:
+        logger.warning('Could not write projection cache file {}. "{}"'.format(fname, e))
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+
+
 def _calcRef(pieces, fileloc):
     locs = np.array(list([x[0] for x in fileloc]))
     frames = list([x[1] for x in fileloc])
@@ -346,6 +764,192 @@ class _TestMetric(unittest.TestCase):
         metr.set((foo, (ref,)))
         assert len(metr.projectionlist) == 1
 
+    def test_projection_cache(self):
+        from htmd.util import tempname
+        from htmd.simlist import simlist
+        from glob import glob
+        import os
+
+        # Write some small synthetic simulations to disk
+        tmpdir = tempname()
+        mol = Molecule()
+        mol.empty(5)
+        mol.name[:] = 'CA'
+        mol.resname[:] = 'ALA'
+        mol.resid[:] = np.arange(5)
+        os.makedirs(os.path.join(tmpdir, 'input', 'e1s1'))
+        mol.coords = np.zeros((5, 3, 1), dtype=np.float32)
+        mol.write(os.path.join(tmpdir, 'input', 'e1s1', 'structure.pdb'))
+        for i in range(3):
+            simdir = os.path.join(tmpdir, 'data', 'e1s{}'.format(i+1))
+            os.makedirs(simdir)
+            nframes = 10 + i
+            mol.coords = np.random.rand(5, 3, nframes).astype(np.float32) * 10
+            mol.box = np.zeros((3, nframes), dtype=np.float32)
+            mol.step = np.arange(1, nframes + 1) * 25000
+            mol.time = mol.step * 4.0
+            mol.write(os.path.join(simdir, 'traj.xtc'))
+        sims = simlist(glob(os.path.join(tmpdir, 'data', '*', '')), os.path.join(tmpdir, 'input', 'e1s1', 'structure.pdb'))
+
+        def coordsum(mol):
+            return mol.coords.sum(axis=(0, 1))
+
+        cachedir = os.path.join(tmpdir, 'cache')
+        metr = Metric(sims, cachedir=cachedir)
+        metr.set(coordsum)
+        data1 = metr.project()
+        assert len(glob(os.path.join(cachedir, '*.npz'))) == 3
+
+        # Cached results are returned without projecting again
+        from unittest import mock
+        with mock.patch('htmd.projections.metric._processSim', side_effect=_processSim) as processmock:
+            data2 = metr.project()
+            assert processmock.call_count == 0
+            for t1, t2 in zip(data1.trajectories, data2.trajectories):
+                assert np.array_equal(t1.projection, t2.projection)
+                assert np.array_equal(t1.reference, t2.reference)
+
+            # Changing the projection parameters invalidates the cache
+            metr = Metric(sims, skip=2, cachedir=cachedir)
+            metr.set(coordsum)
+            metr.project()
+            assert processmock.call_count == 3
+
+    def test_atom_subset(self):
+        from htmd.util import synthesizeSimulations
+        from htmd.util import tempname
+        from moleculekit.projections.metricdistance import MetricDistance, MetricSelfDistance
+        from moleculekit.projections.metricrmsd import MetricRmsd
+        from unittest import mock
+
+        sims = synthesizeSimulations(tempname(), numatoms=30, numframes=20, numtrajs=3)
+        sims[0].trajectory = [sims[0].trajectory[0], sims[1].trajectory[0]]
+        ref = Molecule(sims[0].molfile)
+        projections = [MetricSelfDistance('resid 0 to 5', periodic=None),
+                       MetricDistance('resid 3', 'resid 20 to 22', periodic=None, groupsel2='residue'),
+                       MetricRmsd(ref, 'resid 10 to 15', pbc=False)]
+
+        metr = Metric(sims, skip=3)
+        metr.set(projections)
+        for proj in projections:
+            proj._setCache(ref)
+        assert np.array_equal(np.where(_atomSubset(projections, ref))[0], [0, 1, 2, 3, 4, 5, 10, 11, 12, 13, 14, 15, 20, 21, 22])
+        assert _atomSubset(projections + [lambda mol: mol.coords[0, 0, :]], ref) is None
+
+        data1 = metr.project()
+        with mock.patch('htmd.projections.metric._atomSubset', return_value=None):
+            data2 = metr.project()
+        for t1, t2 in zip(data1.trajectories, data2.trajectories):
+            assert np.allclose(t1.projection, t2.projection, atol=1e-4)
+            assert np.array_equal(t1.reference, t2.reference)
+        assert data1.fstep == data2.fstep
+
+    def test_shared_topology(self):
+        from htmd.util import synthesizeSimulations
+        from htmd.util import tempname
+        from unittest import mock
+
+        sims = synthesizeSimulations(tempname(), numatoms=10, numframes=25, numtrajs=2)
+        uqmol = Molecule(sims[0].molfile)
+        coords = uqmol.coords.copy()
+
+        def coordsum(mol):
+            return mol.coords.sum(axis=(0, 1))
+
+        # The cached molecule is neither copied nor modified
+        with mock.patch.object(Molecule, 'copy', side_effect=AssertionError('Molecule copied')):
+            for chunksize in (None, 4):
+                for sim in sims:
+                    data, ref, fstep, err = _processSim(sim, [coordsum], uqmol, 2, chunksize=chunksize)
+                    assert not err
+                    mol = Molecule(sim.molfile)
+                    mol.read(sim.trajectory, skip=2)
+                    assert np.allclose(data[:, 0], coordsum(mol), atol=1e-3)
+        assert np.array_equal(uqmol.coords, coords)
+        assert uqmol.numFrames == 1
+
+    def test_chunked_projection(self):
+        from htmd.util import synthesizeSimulations
+        from htmd.util import tempname
+        from moleculekit.projections.metricdistance import MetricSelfDistance
+
+        sims = synthesizeSimulations(tempname(), numatoms=10, numframes=25, numtrajs=3)
+        sims[0].trajectory = [sims[0].trajectory[0], sims[1].trajectory[0]]
+        sims[0].numframes = None
+
+        def coordsum(mol):
+            return mol.coords.sum(axis=(0, 1))
+
+        for projection in (MetricSelfDistance('name CA', periodic=None), coordsum):
+            metr = Metric(sims, skip=3)
+            metr.set(projection)
+            data1 = metr.project()
+            metr = Metric(sims, skip=3, chunksize=4)
+            metr.set(projection)
+            data2 = metr.project()
+            for t1, t2 in zip(data1.trajectories, data2.trajectories):
+                assert np.allclose(t1.projection, t2.projection, atol=1e-4)
+                assert np.array_equal(t1.reference, t2.reference)
+            assert data1.fstep == data2.fstep
+
+    def test_drop_traj(self):
+        import os
+        from htmd.util import synthesizeSimulations
+        from htmd.simlist import Sim
+        from htmd.util import tempname
+
+        tmpdir = tempname()
+        sims = np.concatenate([synthesizeSimulations(os.path.join(tmpdir, str(n)), numatoms=5, numframes=n, numtrajs=k)
+                               for n, k in ((30, 3), (20, 1), (45, 1))])
+        # A simulation in a format whose length can only be known by reading it
+        sims = np.append(sims, Sim(simid=5, parent=None, input=[], trajectory=[os.path.join(tmpdir, 'traj.foo')],
+                                   molfile=sims[0].molfile))
+        numframes = [s.numframes for s in sims]
+
+        def dropped(skip=1, **kwargs):
+            metr = Metric(sims, skip=skip)
+            metr.dropTraj(**kwargs)
+            return [i for i, s in enumerate(sims) if s not in metr.simulations]
+
+        assert dropped() == [3, 4]  # Not of the most common length
+        assert dropped(skip=2) == [3, 4]  # 15 frames after skipping
+        assert dropped(limits=[25, 40]) == [3, 4]
+        assert dropped(skip=2, limits=[10, 15]) == [4]  # 23 frames after skipping
+        assert dropped(multiple=[15]) == [3]
+        assert dropped(multiple=[20, 9]) == [0, 1, 2]
+        assert dropped(idx=[1, 5]) == [1, 5]
+
+        # Dropping does not modify the simulations or write into their folders
+        assert [s.numframes for s in sims] == numframes
+        for s in sims[:5]:
+            assert not os.path.exists(os.path.join(os.path.dirname(s.trajectory[0]), '.traj.xtc.numframes'))
+
+    def test_memory_scheduling(self):
+        import os
+        from htmd.util import synthesizeSimulations
+        from htmd.util import tempname
+        from moleculekit.projections.metricdistance import MetricSelfDistance
+
+        sims = synthesizeSimulations(tempname(), numatoms=10, numframes=20, numtrajs=4)
+        metr = Metric(sims)
+        metr.set(MetricSelfDistance('name CA', periodic=None))
+        data1 = metr.project(njobs=1)
+        numframes = [sim.numframes for sim in sims]
+        def folders():
+            dirs = [os.path.dirname(sim.trajectory[0]) for sim in sims]
+            return [{f: os.stat(os.path.join(d, f)).st_mtime_ns for f in os.listdir(d)} for d in dirs]
+        before = folders()
+        estimates = metr._memoryEstimates(range(len(sims)), Molecule(sims[0].molfile), None, 2)
+        assert np.all(estimates == _simMemory([20], 1, 10, 10, None)) and np.all(estimates > 0)
+        # Estimating only probes the trajectories without touching the simulations or their folders
+        assert [sim.numframes for sim in sims] == numframes
+        assert folders() == before
+        # A budget smaller than any trajectory projects them one at a time
+        data2 = metr.project(njobs=2, memory=1)
+        for t1, t2 in zip(data1.trajectories, data2.trajectories):
+            assert np.array_equal(t1.projection, t2.projection)
+            assert np.array_equal(t1.reference, t2.reference)
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
@@ -3,6 +3,7 @@
 # Distributed under HTMD Software License Agreement
 # No redistribution in whole or part
 #
+import os
 import warnings
 import numpy as np
 import random
@@ -33,6 +34,15 @@ class TICA(object):
         If None is given, it will apply on all dimensions.
     njobs : int
         Number of jobs to spawn for parallel computation of TICA components. If None it will use the default from htmd.config.
+    store : str
+        Only used when `data` is a :class:`Metric <htmd.projections.metric.Metric>` object. Directory in which the
+        projected trajectories are stored while fitting so that `project` does not need to project them again. The
+        directory must be empty or not exist. If None a temporary directory is used which is removed together with the
+        TICA object.
+    chunksize : int
+        Maximum number of frames which are passed at once to the TICA estimator when fitting and projecting data from a
+        Metric object. Each projected trajectory is still held in memory as a whole while it is being fitted, so this
+        bounds the temporary memory of the estimator but not the size of the individual trajectories.
 
     Example
     -------
@@ -42,7 +52,8 @@ class TICA(object):
     >>> data = metr.project()
     >>> tica = TICA(data, 20)
     >>> datatica = tica.project(3)
-    Alternatively you can pass a Metric object to TICA. Uses less memory but is slower.
+    Alternatively you can pass a Metric object to TICA. Uses less memory but is slower. The trajectories are projected
+    only once and kept on disk until the TICA projection is calculated.
     >>> metr = Metric(sims)
     >>> metr.set(MetricSelfDistance('protein and name CA'))
     >>> slowtica = TICA(metr, 20)
@@ -56,7 +67,7 @@ class TICA(object):
     for Markov model construction. J. Chem. Phys., 139 . 015102.
     """
 
-    def __init__(self, data, lag, units='frames', dimensions=None, njobs=None):
+    def __init__(self, data, lag, units='frames', dimensions=None, njobs=None, store=None, chunksize=10000):
         from pyemma.coordinates.transform.tica import TICA as TICApyemma
         from tqdm import tqdm
         from htmd.util import _getNjobs
@@ -64,22 +75,33 @@ class TICA(object):
         self.data = data
         self.dimensions = dimensions
         self.njobs = njobs if njobs is not None else _getNjobs()
+        self.chunksize = chunksize
 
         if isinstance(data, Metric):  # Memory efficient TICA projecting trajectories on the fly
             if units != 'frames':
                 raise RuntimeError('Cannot use delayed projection TICA with units other than frames for now. Report this to HTMD issues.')
             self.tic = TICApyemma(lag)
+            self.tic.chunksize = chunksize
             metr = data
+            self._createStore(store)
 
             pbar = tqdm(total=len(metr.simulations))
             for proj in _projectionGenerator(metr, self.njobs):
                 for pro in proj:
-                    if pro is None:
+                    if pro is None or pro[0] is None:
+                        self._storefiles.append(None)
+                        self._storerefs.append(None)
                         continue
+                    fname = os.path.join(self._store, '{}.npy'.format(len(self._storefiles)))
+                    np.save(fname, pro[0])
+                    self._storefiles.append(fname)
+                    self._storerefs.append(pro[1])
+                    if self._storefstep is None:
+                        self._storefstep = pro[2]
                     if self.dimensions is None:
-                        self.tic.partial_fit(pro[0])
+                        self._partialFit(pro[0])
                     else:  # Sub-select dimensions for fitting
-                        self.tic.partial_fit(pro[0][:, self.dimensions])
+                        self._partialFit(pro[0][:, self.dimensions])
                 pbar.update(len(proj))
             pbar.close()
         else:  # In-memory TICA
@@ -94,6 +116,41 @@ class TICA(object):
                 datalist = [x[:, self.dimensions].copy() for x in data.dat]
             self.tic.fit(datalist)
 
+    def _createStore(self, store):
+        import tempfile
+        import shutil
+        import weakref
+        if store is None:
+            self._store = tempfile.mkdtemp(prefix='htmdtica')
+            weakref.finalize(self, shutil.rmtree, self._store, ignore_errors=True)
+        else:
+            if os.path.isdir(store) and len(os.listdir(store)) != 0:
+                raise RuntimeError('The TICA store directory {} is not empty. Please give an empty or new '
+                                   'directory.'.format(store))
+            os.makedirs(store, exist_ok=True)
+            self._store = store
+        self._storefiles = []
+        self._storerefs = []
+        self._storefstep = None
+
+    def _partialFit(self, X):
+        # Chunks overlap by the lag time so that every time-lagged pair of frames is counted exactly once
+        lag = self.tic.lag
+        if X.shape[0] <= self.chunksize + lag:
+            self.tic.partial_fit(X)
+            return
+        for i in range(0, X.shape[0] - lag, self.chunksize):
+            self.tic.partial_fit(X[i:i+self.chunksize+lag])
+
+    def _transform(self, X):
+        res = []
+        for i in range(0, X.shape[0], self.chunksize):
+            chunk = np.asarray(X[i:i+self.chunksize])
+            if self.dimensions is not None:
+                chunk = chunk[:, self.dimensions]
+            res.append(self.tic.transform(chunk).astype(np.float32))
+        return np.concatenate(res)
+
     def project(self, ndim=None):
         """ Projects the data object given to the constructor onto the top `ndim` TICA dimensions
 
@@ -124,30 +181,20 @@ class TICA(object):
         if isinstance(self.data, Metric):  # Memory efficient TICA projecting trajectories on the fly
             proj = []
             refs = []
-            fstep = None
+            fstep = self._storefstep
 
             metr = self.data
-            k = -1
             droppedsims = []
-            pbar = tqdm(total=len(metr.simulations))
-            for projecteddata in _projectionGenerator(metr, self.njobs):
-                for pro in projecteddata:
-                    k += 1
-                    if pro is None:
-                        droppedsims.append(k)
-                        continue
-                    if self.dimensions is not None:
-                        numDimensions = pro[0].shape[1]
-                        keepdim = np.setdiff1d(range(numDimensions), self.dimensions)
-                        keepdata.append(pro[0][:, keepdim])
-                        proj.append(self.tic.transform(pro[0][:, self.dimensions]).astype(np.float32))  # Sub-select dimensions for projecting
-                    else:
-                        proj.append(self.tic.transform(pro[0]).astype(np.float32))
-                    refs.append(pro[1])
-                    if fstep is None:
-                        fstep = pro[2]
-                pbar.update(len(projecteddata))
-            pbar.close()
+            for k, (fname, ref) in enumerate(tqdm(list(zip(self._storefiles, self._storerefs)))):
+                if fname is None:
+                    droppedsims.append(k)
+                    continue
+                X = np.load(fname, mmap_mode='r')
+                if self.dimensions is not None:
+                    keepdim = np.setdiff1d(range(X.shape[1]), self.dimensions)
+                    keepdata.append(np.array(X[:, keepdim]))
+                proj.append(self._transform(X))
+                refs.append(ref)
 
             simlist = self.data.simulations
             simlist = np.delete(simlist, droppedsims)
@@ -205,6 +252,37 @@ class TICA(object):
         return datatica
 
 
+import unittest
+
+
+class _TestTICA(unittest.TestCase):
+    def test_store(self):
+        import shutil
+        from htmd.util import tempname
+        from htmd.util import synthesizeSimulations
+        from moleculekit.projections.metricdistance import MetricSelfDistance
+
+        tmpdir = tempname()
+        sims = synthesizeSimulations(tmpdir, numatoms=8, numframes=300, numtrajs=4)
+        metr = Metric(sims)
+        metr.set(MetricSelfDistance('name CA', periodic=None))
+        data = metr.project()
+        ref = TICA(data, 5).project(2)
+
+        store = os.path.join(tmpdir, 'store')
+        tica = TICA(metr, 5, store=store, chunksize=70)  # Chunks smaller than the trajectories
+        assert len(os.listdir(store)) == len(sims)
+        datatica = tica.project(2)
+        for a, b in zip(ref.dat, datatica.dat):
+            assert np.allclose(np.abs(a), np.abs(b), atol=1e-3)  # The sign of TICA components is arbitrary
+        assert np.array_equal(np.concatenate(ref.ref), np.concatenate(datatica.ref))
+
+        # A store which already contains files is never overwritten
+        with self.assertRaises(RuntimeError):
+            TICA(metr, 5, store=store)
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
 if __name__ == '__main__':
     from htmd.simlist import simlist
     from glob import glob
@@ -120,7 +120,7 @@ class _simlist2(np.ndarray):
         pass
 
 
-def simlist(datafolders, topologies, inputfolders=None):
+def simlist(datafolders, topologies, inputfolders=None, index=None, njobs=None, probe=False):
     """Creates a list of simulations
 
     Parameters
@@ -132,6 +132,15 @@ def simlist(datafolders, topologies, inputfolders=None):
         Can also be a single string to a single structure which corresponds to all trajectories.
     inputfolders : optional, str list
         A list of directories, each containing the input files used to produce the trajectories in dataFolders
+    index : str
+        A file in which to keep a persistent index of the contents of the data and topology folders (trajectories,
+        topologies and frame counts). On subsequent calls only folders which are new or were modified since are
+        scanned again.
+    njobs : int
+        Number of threads used for scanning the folders. If None it will use the default from htmd.config.
+    probe : bool
+        Count the frames of trajectories without a .numframes file by reading the XTC, DCD or NetCDF frame headers and
+        write the .numframes file so that later calls do not need to count them again.
 
     Return
     ------
@@ -142,6 +151,7 @@ def simlist(datafolders, topologies, inputfolders=None):
     --------
     >>> simlist(glob('./test/data/*/'), glob('./test/input/*/'), glob('./test/input/*/'))
     >>> simlist(glob('./test/data/*/'), glob('./test/input/*/*.pdb'), glob('./test/input/*/'))
+    >>> simlist(glob('./test/data/*/'), glob('./test/input/*/'), glob('./test/input/*/'), index='./test/simlist.idx')
     """
     from htmd.util import ensurelist
     import natsort
@@ -185,26 +195,39 @@ def simlist(datafolders, topologies, inputfolders=None):
             inputnames[_simName(inputf)] = inputf
 
     logger.debug('Starting listing of simulations.')
-    sims = []
-
     keys = natsort.natsorted(datanames.keys())
-    i = 0
-    from tqdm import tqdm
-    for k in tqdm(keys, desc='Creating simlist'):
-        trajectories = _autoDetectTrajectories(datanames[k])
+    folderindex = _FolderIndex(index)
+    scanned = folderindex.scan('data', [datanames[k] for k in keys], _scanDataFolder, njobs, desc='Creating simlist')
 
+    molfiles = {}
+    topofolders = []
+    for k, (trajectories, _) in zip(keys, scanned):
         if not trajectories:
             continue
 
         if len(topologies) > 1:
             if k not in molnames:
                 raise FileNotFoundError('Did not find molfile with folder name ' + k + ' in the given glob')
-            molfile = molnames[k]
+            molfiles[k] = molnames[k]
         else:
-            molfile = topologies[0]
+            molfiles[k] = topologies[0]
+        if os.path.isdir(molfiles[k]):
+            topofolders.append(molfiles[k])
 
+    # Topology folders are detected only once each, even if shared by all simulations
+    topofolders = list(dict.fromkeys(topofolders))
+    detected = dict(zip(topofolders, folderindex.scan('topology', topofolders, _autoDetectTopology, njobs)))
+    folderindex.save()
+
+    sims = []
+    i = 0
+    for k, (trajectories, numframes) in zip(keys, scanned):
+        if not trajectories:
+            continue
+
+        molfile = molfiles[k]
         if os.path.isdir(molfile):
-            molfile = _autoDetectTopology(molfile)
+            molfile = detected[molfile]
 
         inputf = []
         if inputfolders:
@@ -212,13 +235,139 @@ def simlist(datafolders, topologies, inputfolders=None):
                 raise FileNotFoundError('Did not find input with folder name ' + k + ' in the given glob')
             inputf = inputnames[k]
 
-        numframes = [_readNumFrames(f) for f in trajectories]
         sims.append(Sim(simid=i, parent=None, input=inputf, trajectory=trajectories, molfile=molfile, numframes=numframes))
         i += 1
+    if probe:
+        _probeSimFrames(sims, njobs)
     logger.debug('Finished listing of simulations.')
     return np.array(sims, dtype=object)
 
 
+def _probeSimFrames(sims, njobs=None, persist=True):
+    """ Probes the trajectory files for the frame counts which are unknown in the simulations
+
+    If `persist` is True the counts are filled into the simulations and written to .numframes files. .numframes files
+    are not written for trajectories modified in the last minute as they may still be written to. Otherwise nothing is
+    modified.
+
+    Returns
+    -------
+    numframes : list
+        The frame counts of the pieces of each simulation. None for pieces which could not be probed.
+    """
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from htmd.util import _getNjobs
+    numframes = []
+    missing = []
+    for s, sim in enumerate(sims):
+        counts = list(sim.numframes) if sim.numframes is not None else [None] * len(sim.trajectory)
+        numframes.append(counts)
+        missing += [(s, i) for i, n in enumerate(counts) if n is None]
+    if len(missing) != 0:
+        def probeTrajectory(simtraj):
+            s, i = simtraj
+            traj = sims[s].trajectory[i]
+            count = _probeNumFrames(traj)
+            if persist and count is not None and time.time() - os.path.getmtime(traj) > 60:
+                _writeNumFrames(traj, count)
+            return count
+
+        njobs = njobs if njobs is not None else _getNjobs()
+        with ThreadPoolExecutor(max_workers=max(njobs, 1)) as pool:
+            counts = list(pool.map(probeTrajectory, missing))
+        for (s, i), count in zip(missing, counts):
+            numframes[s][i] = count
+    if persist:
+        for sim, counts in zip(sims, numframes):
+            sim.numframes = counts
+    return numframes
+
+
+class _FolderIndex(object):
+    """ Persistent index of the results of scanning folders, invalidated by the modification time of each folder
+
+    Adding, removing or renaming files in a folder (e.g. a new trajectory or .numframes file) updates its modification
+    time, so only new or modified folders need to be scanned again. File names are stored relative to their folder.
+    """
+    _version = 1
+    _settle = 2e9  # Folders modified in the last 2 seconds are not indexed as they may still change within the mtime resolution
+
+    def __init__(self, filename=None):
+        import json
+        self.filename = filename
+        self.entries = {'data': {}, 'topology': {}}
+        self._modified = False
+        if filename is not None and os.path.exists(filename):
+            try:
+                with open(filename, 'r') as f:
+                    content = json.load(f)
+                if content['version'] == self._version:
+                    self.entries = content['folders']
+            except Exception as e:
+                logger.warning('Could not read simlist index {} due to error: {}. Rebuilding it.'.format(filename, e))
+
+    def scan(self, kind, folders, scanfunc, njobs=None, desc=None):
+        """ Returns scanfunc(folder) for each folder, using the indexed result if the folder was not modified """
+        import time
+        from tqdm import tqdm
+        from concurrent.futures import ThreadPoolExecutor
+        from htmd.util import _getNjobs
+        entries = self.entries[kind]
+
+        def scanFolder(folder):
+            abspath = os.path.abspath(folder)
+            mtime = os.stat(abspath).st_mtime_ns
+            entry = entries.get(abspath)
+            if entry is not None and entry['mtime'] == mtime:
+                return _relocate(kind, folder, entry['value'])
+            value = scanfunc(folder)
+            if time.time_ns() - mtime > self._settle:
+                entries[abspath] = {'mtime': mtime, 'value': _relocate(kind, None, value)}
+                self._modified = True
+            return value
+
+        njobs = njobs if njobs is not None else _getNjobs()
+        with ThreadPoolExecutor(max_workers=max(njobs, 1)) as pool:
+            return list(tqdm(pool.map(scanFolder, folders), total=len(folders), desc=desc, disable=desc is None))
+
+    def save(self):
+        import json
+        if self.filename is None or not self._modified:
+            return
+        tmpfile = '{}.{}.tmp'.format(self.filename, os.getpid())
+        with open(tmpfile, 'w') as f:
+            json.dump({'version': self._version, 'folders': self.entries}, f)
+        os.replace(tmpfile, self.filename)
+        self._modified = False
+
+
+def _relocate(kind, folder, value):
+    """ Strips (folder=None) or prepends the folder to the file names of a scan result """
+    def convert(names):
+        if not names:
+            return names
+        if folder is None:
+            return [os.path.basename(n) for n in names]
+        return [path.join(folder, n) for n in names]
+    if kind == 'data':  # (trajectories, numframes)
+        return convert(value[0]), value[1]
+    return convert(value)
+
+
+def _listFolder(folder):
+    """ Names of the entries of a folder which are matched by glob('*') """
+    with os.scandir(folder) as it:
+        return [e.name for e in it if not e.name.startswith('.')]
+
+
+def _scanDataFolder(folder):
+    trajectories = _autoDetectTrajectories(folder)
+    if not trajectories:
+        return trajectories, None
+    return trajectories, [_readNumFrames(f) for f in trajectories]
+
+
 def simfilter(sims, outfolder, filtersel, njobs=None):
     """ Filters a list of simulations generated by :func:`simlist`
 
@@ -353,6 +502,110 @@ def _readNumFrames(filepath):
     return numframes
 
 
+def _writeNumFrames(filepath, numframes):
+    """ Writes the .numframes file of a trajectory. Failures (e.g. read-only data) are not fatal. """
+    filepath = os.path.abspath(filepath)
+    numframefile = os.path.join(os.path.dirname(filepath), '.{}.numframes'.format(os.path.basename(filepath)))
+    tmpfile = '{}.{}.tmp'.format(numframefile, os.getpid())
+    try:
+        with open(tmpfile, 'w') as f:
+            f.write('{}\n'.format(numframes))
+        os.replace(tmpfile, numframefile)  # Atomic so that concurrent readers never see partial files
+    except OSError as e:
+        logger.debug('Could not write {}: {}'.format(numframefile, e))
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+
+
+def _probeNumFrames(filepath):
+    """ Counts the frames of a trajectory from its headers without decoding the coordinates
+
+    Supports XTC, DCD and NetCDF trajectories. Returns None for other formats or unreadable files. Incomplete frames at
+    the end of a trajectory (e.g. of a crashed simulation) are not counted.
+    """
+    ext = os.path.splitext(filepath)[1][1:].lower()
+    probe = {'xtc': _probeXTC, 'dcd': _probeDCD, 'nc': _probeNetCDF, 'netcdf': _probeNetCDF, 'ncdf': _probeNetCDF}
+    if ext not in probe:
+        return None
+    try:
+        return probe[ext](filepath)
+    except Exception as e:
+        logger.warning('Could not count the frames of {}: {}'.format(filepath, e))
+        return None
+
+
+def _probeXTC(filepath):
+    import struct
+    filesize = os.path.getsize(filepath)
+    numframes = 0
+    pos = 0
+    with open(filepath, 'rb') as f:
+        while pos < filesize:
+            f.seek(pos)
+            header = f.read(92)
+            if len(header) < 56:
+                break
+            magic, natoms = struct.unpack('>ii', header[:8])
+            if magic not in (1995, 2023):
+                raise RuntimeError('Invalid XTC frame header at byte {}'.format(pos))
+            if natoms <= 9:  # Small systems are stored uncompressed
+                pos += 56 + 12 * natoms
+            elif magic == 1995:
+                if len(header) < 92:
+                    break
+                nbytes = struct.unpack('>i', header[88:92])[0]
+                pos += 92 + 4 * ((nbytes + 3) // 4)
+            else:  # XTC files of large systems store a 64-bit byte count
+                header += f.read(4)
+                if len(header) < 96:
+                    break
+                nbytes = struct.unpack('>q', header[88:96])[0]
+                pos += 96 + 4 * ((nbytes + 3) // 4)
+            if pos > filesize:
+                break
+            numframes += 1
+    return numframes
+
+
+def _probeDCD(filepath):
+    import struct
+    filesize = os.path.getsize(filepath)
+    with open(filepath, 'rb') as f:
+        head = f.read(92)
+        for endian in ('<', '>'):
+            if struct.unpack(endian + 'i', head[:4])[0] == 84 and head[4:8] == b'CORD':
+                break
+        else:
+            raise RuntimeError('Invalid DCD header')
+        icntrl = struct.unpack(endian + '20i', head[8:88])
+        titlesize = struct.unpack(endian + 'i', f.read(4))[0]
+        f.seek(titlesize + 4, 1)
+        natoms = struct.unpack(endian + 'iii', f.read(12))[1]
+        headersize = f.tell()
+    charmm = icntrl[19] != 0
+    nfixed = icntrl[8]
+    if nfixed != 0:
+        raise RuntimeError('DCD files with fixed atoms are not supported')
+    framesize = 3 * (4 * natoms + 8)
+    if charmm and icntrl[10] != 0:  # Unit cell block
+        framesize += 48 + 8
+    if charmm and icntrl[11] != 0:  # Fourth dimension
+        framesize += 4 * natoms + 8
+    return (filesize - headersize) // framesize
+
+
+def _probeNetCDF(filepath):
+    import struct
+    with open(filepath, 'rb') as f:
+        head = f.read(8)
+    if head[:3] != b'CDF' or head[3] not in (1, 2):
+        raise RuntimeError('Only NetCDF3 trajectories are supported')
+    numrecs = struct.unpack('>I', head[4:8])[0]
+    if numrecs == 0xFFFFFFFF:  # Streaming file with unknown number of records
+        return None
+    return numrecs
+
+
 def _renameSims(trajectory, simname, outfolder):
     traj = list()
     outtraj = list()
@@ -396,10 +649,11 @@ def _filterTopology(sim, outfolder, filtsel):
 def _autoDetectTrajectories(folder):
     from moleculekit.readers import _TRAJECTORY_READERS
     import natsort
+    names = _listFolder(folder)
     for tt in _TRAJECTORY_READERS:
         if tt in ("xsc",):  # Some trajectory readers don't really load trajectories like xsc
             continue
-        trajectories = glob(path.join(folder, '*.{}'.format(tt)))
+        trajectories = [path.join(folder, n) for n in names if n.endswith('.{}'.format(tt))]
         if len(trajectories) > 0:
             return natsort.natsorted(trajectories)
 
@@ -412,8 +666,9 @@ __topotypes =  __defaultReaders + __otherReaders  # Prepending PDB, PSF, PRMTOP
 
 def _autoDetectTopology(folder):
     topo = {}
+    names = _listFolder(folder)
     for tt in __topotypes:
-        files = glob(path.join(folder, '*.{}'.format(tt)))
+        files = [path.join(folder, n) for n in names if n.endswith('.{}'.format(tt))]
         if len(files) > 0:
             if len(files) > 1:
                 logger.warning('Multiple "{}" files were found in folder {}. '
@@ -470,6 +725,52 @@ class _TestSimlist(unittest.TestCase):
         assert _singleMolfile(sims)[0]
 
 
+    def test_simlist_index(self):
+        from htmd.home import home
+        from moleculekit.util import tempname
+
+        datafolders = glob(path.join(home(dataDir='adaptive'), 'data', '*', ''))
+        inputfolders = glob(path.join(home(dataDir='adaptive'), 'input', '*', ''))
+        index = tempname(suffix='.json')
+        sims = simlist(datafolders, inputfolders, inputfolders)
+        for _ in range(2):  # Building and then reusing the index
+            isims = simlist(datafolders, inputfolders, inputfolders, index=index)
+            assert len(isims) == len(sims)
+            for s, i in zip(sims, isims):
+                assert s == i
+                assert s.numframes == i.numframes
+        os.remove(index)
+
+    def test_probe_numframes(self):
+        from htmd.home import home
+        from moleculekit.molecule import Molecule
+
+        sims = simlist(glob(path.join(home(dataDir='adaptive'), 'data', '*', '')), glob(path.join(home(dataDir='adaptive'), 'input', '*')))
+        for traj in sims[0].trajectory:
+            mol = Molecule(sims[0].molfile)
+            mol.read(traj)
+            assert _probeNumFrames(traj) == mol.numFrames
+
+    def test_write_numframes(self):
+        from moleculekit.util import tempname
+        from unittest import mock
+        import shutil
+
+        folder = tempname()
+        os.makedirs(folder)
+        traj = path.join(folder, 'traj.xtc')
+        _writeNumFrames(traj, 42)
+        assert _readNumFrames(traj) == 42
+        assert os.listdir(folder) == ['.traj.xtc.numframes']  # No temporary files are left behind
+
+        # A failed replacement keeps the previous file intact and removes the temporary one
+        with mock.patch('os.replace', side_effect=OSError('Interrupted')):
+            _writeNumFrames(traj, 7)
+        assert _readNumFrames(traj) == 42
+        assert os.listdir(folder) == ['.traj.xtc.numframes']
+        shutil.rmtree(folder)
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
 
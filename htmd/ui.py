@@ -31,6 +31,7 @@ from htmd.adaptive.adaptivegoal import AdaptiveGoal
 from htmd.adaptive.adaptive import reconstructAdaptiveTraj
 from htmd.model import Model, getStateStatistic
 from htmd.kinetics import Kinetics
+from htmd.bootstrap import bootstrapModel
 from moleculekit.vmdviewer import viewer, getCurrentViewer
 from htmd.builder.solvate import solvate
 from htmd.mdengine.acemd.acemd import Acemd, Acemd2, AtomRestraint, GroupRestraint
@@ -23,6 +23,23 @@ def _getNjobs():
     return njobs
 
 
+def _availableMemory():
+    """ Memory in bytes available for new processes without swapping or None if it cannot be determined """
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
 def tempname(suffix='', create=False):
     if create:
         file = tempfile.NamedTemporaryFile(delete=False, suffix=suffix)
@@ -166,6 +183,67 @@ def assertSameAsReferenceDir(compareDir, outdir="."):
         raise Exception('Mismatch in regression testing.')
 
 
+def synthesizeSimulations(outdir, numatoms=50, numframes=1000, numtrajs=20, numstates=3, seed=0):
+    """ Writes synthetic simulations to disk and returns their simlist
+
+    The atoms jump between `numstates` metastable conformations with some thermal noise, which gives the Markov model
+    some kinetics to resolve.
+
+    Parameters
+    ----------
+    outdir : str
+        The folder in which to write the simulations
+    numatoms : int
+        Number of atoms of the system. All atoms are named CA.
+    numframes : int
+        Number of frames of each trajectory
+    numtrajs : int
+        Number of trajectories
+    numstates : int
+        Number of metastable conformations
+    seed : int
+        Random seed
+
+    Returns
+    -------
+    sims : np.ndarray of :class:`Sim <htmd.simlist.Sim>` objects
+        The simulations
+    """
+    from moleculekit.molecule import Molecule
+    from htmd.simlist import simlist
+    from glob import glob
+    rng = np.random.RandomState(seed)
+
+    mol = Molecule().empty(numatoms)
+    mol.name[:] = 'CA'
+    mol.resname[:] = 'ALA'
+    mol.resid[:] = np.arange(numatoms)
+    mol.element[:] = 'C'
+    # Metastable conformations are random walks of 3.8A steps so that distances look like a protein chain
+    conformations = np.cumsum(rng.randn(numstates, numatoms, 3) * 2.2, axis=1).astype(np.float32)
+
+    inputdir = os.path.join(outdir, 'input', 'e1s1')
+    os.makedirs(inputdir, exist_ok=True)
+    mol.coords = conformations[0][:, :, np.newaxis].copy()
+    mol.write(os.path.join(inputdir, 'structure.pdb'))
+
+    for i in range(numtrajs):
+        # Markov chain over the conformations with rare transitions
+        jumps = rng.rand(numframes) < 0.02
+        states = np.cumsum(jumps * rng.randint(1, numstates, size=numframes)) % numstates
+        states = (states + rng.randint(numstates)) % numstates
+        coords = conformations[states] + rng.randn(numframes, numatoms, 3).astype(np.float32) * 0.5
+        mol.coords = np.ascontiguousarray(coords.transpose((1, 2, 0)))
+        mol.box = np.zeros((3, numframes), dtype=np.float32)
+        mol.step = np.arange(1, numframes + 1) * 25000
+        mol.time = mol.step * 4.0
+        trajdir = os.path.join(outdir, 'data', 'e1s{}'.format(i + 1))
+        os.makedirs(trajdir, exist_ok=True)
+        mol.write(os.path.join(trajdir, 'traj.xtc'))
+
+    return simlist(glob(os.path.join(outdir, 'data', '*', '')), os.path.join(inputdir, 'structure.pdb'))
+
+
 def testDHFR():
     import conda
     import shutil